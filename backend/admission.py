@@ -0,0 +1,343 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import Response, jsonify, request
+
+# Admission control for the routes that run the story pipeline
+# (ADMISSION_ENABLED=true). Every parent (Firebase localId) and child
+# (username) has a token bucket of ADMISSION_BURST requests refilled at
+# ADMISSION_RATE_PER_MINUTE, and each conversation runs at most
+# ADMISSION_MAX_PER_CONVERSATION generations at a time. Requests for a busy
+# conversation wait up to ADMISSION_MAX_WAIT_SECONDS in a bounded queue;
+# anything over a limit gets 429 with Retry-After.
+#
+# ADMISSION_BACKEND=memory keeps the state in the worker process, sqlite
+# shares it between the worker processes of a host through ADMISSION_DB_PATH.
+# Slots and queue places are leases, so a crashed worker cannot hold them
+# for longer than ADMISSION_LEASE_SECONDS.
+
+
+def refill(tokens, updated_at, now, rate_per_second, burst):
+    return min(burst, tokens + (now - updated_at) * rate_per_second)
+
+
+class MemoryAdmissionBackend:
+    """Admission state of this worker process only."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.slots = {}
+        self.waiters = {}
+
+    def take_token(self, key, rate_per_second, burst):
+        """Take a token from the key's bucket, returning 0 or the seconds until one is available."""
+        now = time.time()
+        with self.lock:
+            tokens, updated_at = self.buckets.get(key, (burst, now))
+            tokens = refill(tokens, updated_at, now, rate_per_second, burst)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return (1 - tokens) / rate_per_second
+            self.buckets[key] = (tokens - 1, now)
+            return 0.0
+
+    def try_acquire(self, conversation_id, limit, lease_seconds):
+        now = time.time()
+        with self.lock:
+            slots = {slot: expires for slot, expires in self.slots.get(conversation_id, {}).items() if expires > now}
+            self.slots[conversation_id] = slots
+            if len(slots) >= limit:
+                return None
+            slot = uuid.uuid4().hex
+            slots[slot] = now + lease_seconds
+            return slot
+
+    def release(self, conversation_id, slot):
+        with self.lock:
+            slots = self.slots.get(conversation_id, {})
+            slots.pop(slot, None)
+            if not slots:
+                self.slots.pop(conversation_id, None)
+
+    def join_queue(self, conversation_id, per_conversation, total, lease_seconds):
+        now = time.time()
+        with self.lock:
+            self.waiters = {waiter: entry for waiter, entry in self.waiters.items() if entry[1] > now}
+            waiting = sum(1 for entry in self.waiters.values() if entry[0] == conversation_id)
+            if len(self.waiters) >= total or waiting >= per_conversation:
+                return None
+            waiter = uuid.uuid4().hex
+            self.waiters[waiter] = (conversation_id, now + lease_seconds)
+            return waiter
+
+    def leave_queue(self, waiter):
+        with self.lock:
+            self.waiters.pop(waiter, None)
+
+
+class SQLiteAdmissionBackend:
+    """Admission state in a SQLite file shared by the worker processes of a host."""
+
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS admission_buckets ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS admission_slots ("
+                "slot TEXT PRIMARY KEY, conversation_id TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_admission_slots_conversation ON admission_slots (conversation_id)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS admission_waiters ("
+                "waiter TEXT PRIMARY KEY, conversation_id TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    @contextmanager
+    def connect(self):
+        """Open a short-lived connection and commit the enclosed statements."""
+        connection = sqlite3.connect(self.path, timeout=5)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @contextmanager
+    def transaction(self):
+        """Like connect, holding the write lock from the first read so check-and-update is atomic."""
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            yield connection
+
+    def take_token(self, key, rate_per_second, burst):
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT tokens, updated_at FROM admission_buckets WHERE key = ?", (key,)).fetchone()
+            tokens = refill(*row, now, rate_per_second, burst) if row else burst
+            wait = 0.0
+            if tokens < 1:
+                wait = (1 - tokens) / rate_per_second
+            else:
+                tokens -= 1
+            connection.execute(
+                "INSERT OR REPLACE INTO admission_buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                (key, tokens, now))
+        return wait
+
+    def try_acquire(self, conversation_id, limit, lease_seconds):
+        now = time.time()
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM admission_slots WHERE expires_at <= ?", (now,))
+            (held,) = connection.execute(
+                "SELECT COUNT(*) FROM admission_slots WHERE conversation_id = ?", (conversation_id,)).fetchone()
+            if held >= limit:
+                return None
+            slot = uuid.uuid4().hex
+            connection.execute(
+                "INSERT INTO admission_slots (slot, conversation_id, expires_at) VALUES (?, ?, ?)",
+                (slot, conversation_id, now + lease_seconds))
+        return slot
+
+    def release(self, conversation_id, slot):
+        with self.connect() as connection:
+            connection.execute("DELETE FROM admission_slots WHERE slot = ?", (slot,))
+
+    def join_queue(self, conversation_id, per_conversation, total, lease_seconds):
+        now = time.time()
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM admission_waiters WHERE expires_at <= ?", (now,))
+            (waiting_total,) = connection.execute("SELECT COUNT(*) FROM admission_waiters").fetchone()
+            (waiting,) = connection.execute(
+                "SELECT COUNT(*) FROM admission_waiters WHERE conversation_id = ?", (conversation_id,)).fetchone()
+            if waiting_total >= total or waiting >= per_conversation:
+                return None
+            waiter = uuid.uuid4().hex
+            connection.execute(
+                "INSERT INTO admission_waiters (waiter, conversation_id, expires_at) VALUES (?, ?, ?)",
+                (waiter, conversation_id, now + lease_seconds))
+        return waiter
+
+    def leave_queue(self, waiter):
+        with self.connect() as connection:
+            connection.execute("DELETE FROM admission_waiters WHERE waiter = ?", (waiter,))
+
+
+class Ticket:
+    def __init__(self, conversation_id=None, slot=None):
+        self.conversation_id = conversation_id
+        self.slot = slot
+
+
+class AdmissionController:
+    """Decides whether a story request may run now, may wait for its conversation, or gets a 429."""
+
+    def __init__(self, backend, rate_per_minute, burst, max_per_conversation, queue_per_conversation,
+                 max_waiting, max_wait_seconds, lease_seconds, poll_seconds=0.05):
+        self.backend = backend
+        self.rate_per_second = rate_per_minute / 60
+        self.burst = burst
+        self.max_per_conversation = max_per_conversation
+        self.queue_per_conversation = queue_per_conversation
+        self.max_waiting = max_waiting
+        self.max_wait_seconds = max_wait_seconds
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.rate_limited = 0
+        self.queue_full = 0
+        self.wait_timeouts = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+
+    def _count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def admit(self, key, conversation_id=None):
+        """Return (ticket, 0) when the request may run, or (None, seconds to wait before retrying)."""
+        wait = self.backend.take_token(key, self.rate_per_second, self.burst)
+        if wait > 0:
+            self._count("rate_limited")
+            return None, wait
+        if conversation_id is None:
+            self._count("admitted")
+            return Ticket(), 0.0
+
+        conversation_id = str(conversation_id)
+        slot = self.backend.try_acquire(conversation_id, self.max_per_conversation, self.lease_seconds)
+        if slot is None:
+            slot = self._wait_for_slot(conversation_id)
+            if slot is None:
+                return None, self.max_wait_seconds
+        self._count("admitted")
+        return Ticket(conversation_id, slot), 0.0
+
+    def _wait_for_slot(self, conversation_id):
+        waiter = self.backend.join_queue(
+            conversation_id, self.queue_per_conversation, self.max_waiting, self.max_wait_seconds + self.poll_seconds)
+        if waiter is None:
+            self._count("queue_full")
+            return None
+        start = time.time()
+        try:
+            while time.time() - start < self.max_wait_seconds:
+                time.sleep(self.poll_seconds)
+                slot = self.backend.try_acquire(conversation_id, self.max_per_conversation, self.lease_seconds)
+                if slot is not None:
+                    with self.lock:
+                        self.waited += 1
+                        self.wait_seconds += time.time() - start
+                    return slot
+        finally:
+            self.backend.leave_queue(waiter)
+        self._count("wait_timeouts")
+        return None
+
+    def release(self, ticket):
+        if ticket.slot is not None:
+            self.backend.release(ticket.conversation_id, ticket.slot)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backend": type(self.backend).__name__,
+                "rate_per_minute": self.rate_per_second * 60,
+                "burst": self.burst,
+                "max_per_conversation": self.max_per_conversation,
+                "admitted": self.admitted,
+                "rate_limited": self.rate_limited,
+                "queue_full": self.queue_full,
+                "wait_timeouts": self.wait_timeouts,
+                "waited": self.waited,
+                "mean_wait_seconds": self.wait_seconds / self.waited if self.waited else None,
+            }
+
+
+def admission_from_env():
+    """Build the admission controller configured by the ADMISSION_* variables, or None when disabled."""
+    if os.getenv("ADMISSION_ENABLED", "false").lower() != "true":
+        return None
+    backend_name = os.getenv("ADMISSION_BACKEND", "memory").lower()
+    if backend_name == "sqlite":
+        backend = SQLiteAdmissionBackend(os.getenv(
+            "ADMISSION_DB_PATH", os.path.join(os.path.dirname(__file__), 'admission.sqlite3')))
+    elif backend_name == "memory":
+        backend = MemoryAdmissionBackend()
+    else:
+        raise ValueError(f"Unknown admission backend: {backend_name}")
+    return AdmissionController(
+        backend,
+        rate_per_minute=float(os.getenv("ADMISSION_RATE_PER_MINUTE", "20")),
+        burst=float(os.getenv("ADMISSION_BURST", "5")),
+        max_per_conversation=int(os.getenv("ADMISSION_MAX_PER_CONVERSATION", "1")),
+        queue_per_conversation=int(os.getenv("ADMISSION_QUEUE_PER_CONVERSATION", "1")),
+        max_waiting=int(os.getenv("ADMISSION_MAX_WAITING", "8")),
+        max_wait_seconds=float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "10")),
+        lease_seconds=float(os.getenv("ADMISSION_LEASE_SECONDS", "300")),
+    )
+
+
+admission_controller = admission_from_env()
+
+
+def admission_stats():
+    return admission_controller.stats() if admission_controller is not None else {"enabled": False}
+
+
+def admission_key():
+    """Rate limit key of the authenticated parent or child of this request."""
+    child_user = getattr(request, "child_user", None)
+    if child_user:
+        return f"child:{child_user.get('username')}"
+    firebase_user = getattr(request, "firebase_user", None)
+    if firebase_user:
+        return f"user:{firebase_user.get('localId')}"
+    return f"ip:{request.remote_addr}"
+
+
+def admission_required(f):
+    """
+    Decorator to apply admission control to a route, placed below the auth
+    decorator so the user is known. Streamed responses keep their
+    conversation slot until the stream is closed.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if admission_controller is None:
+            return f(*args, **kwargs)
+
+        data = request.get_json(silent=True) or {}
+        ticket, retry_after = admission_controller.admit(admission_key(), data.get('conversation_id'))
+        if ticket is None:
+            response = jsonify({'error': 'Too many story requests, please try again shortly'})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+            return response
+
+        try:
+            result = f(*args, **kwargs)
+        except BaseException:
+            admission_controller.release(ticket)
+            raise
+        if isinstance(result, Response) and result.is_streamed:
+            result.call_on_close(lambda: admission_controller.release(ticket))
+        else:
+            admission_controller.release(ticket)
+        return result
+
+    return decorated_function
@@ -1,4 +1,4 @@
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, jsonify, request, send_file, Response, stream_with_context
 from flask_cors import CORS
 from db.db import db
 from pydub import AudioSegment
@@ -6,18 +6,35 @@ import io
 import base64
 
 # Clear only the 'story_assignment' table from the metadata
-from db.db import db, init_db, Conversation, Message, SenderType, ChildAccount, StoryAssignment, StoryTheme
-from llm.llm import handler, meta_prompt_generator, new_story_generator, add_to_story
+from db.db import db, init_db, Conversation, Message, SenderType, ChildAccount, StoryAssignment, StoryTheme, StoryJob, JobStatus
+from llm.llm import (
+    classify_with_speculation, meta_prompt_generator, new_story_generator, add_to_story, handler_cache_stats,
+    intent_classifier_stats, single_flight_stats, story_backend_stats, speculation_stats,
+    story_cache_stats, suggestion_stats, degraded_stats, log_queue_stats, stream_new_story, stream_add_to_story,
+    speculator
+)
+from llm.timing import start_request_timings, request_timings, format_timings
+from llm.gateway import gateway_stats
+from llm.circuit_breaker import CircuitOpenError
+from llm.usage import start_usage_attribution, attribute_usage, request_attribution, usage_store_from_env
+from db.story_state import append_story_part, delete_story_state
+from sqlalchemy.exc import IntegrityError
+from db.conversation_list import conversation_summaries, conversation_page, InvalidCursorError
+from story_pool import story_pool_from_env, random_prompt
+from story_jobs import story_jobs_from_env
 from firebase_auth import firebase_auth_required
+from admission import admission_required, admission_stats
 from child_auth import (
     save_child_account, verify_child_credentials, generate_child_token,
     child_auth_required
 )
 import os
+import math
 from dotenv import load_dotenv
 import random
 import ast
 import heapq
+import json
 
 # Load environment variables
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
@@ -28,24 +45,163 @@ CORS(app)  # Enable CORS for all routes
 # Initialize the SQLAlchemy db instance
 init_db(app)
 
+# Per-stage token, latency and cost records of every completion
+usage_store = usage_store_from_env()
+
+# Pre-generated themed stories for /generate_themed_story (STORY_POOL_ENABLED)
+story_pool = story_pool_from_env(app, usage_store)
+
+
+@app.before_request
+def warm_story_pool():
+    # Like the story job workers, refills start with the first request a
+    # process serves, so scripts importing app.py spend no tokens on them
+    if story_pool:
+        story_pool.warm()
+
+
+# Firebase users allowed to read the admin endpoints
+admin_uids = {uid.strip() for uid in os.getenv("ADMIN_UIDS", "").split(",") if uid.strip()}
+
+
+@app.before_request
+def begin_stage_timings():
+    start_request_timings()
+    start_usage_attribution()
+
+
+@app.teardown_request
+def report_stage_timings(exc):
+    # Report how long each LLM stage of this request took so that changes to
+    # the story pipeline can be measured
+    records = request_timings()
+    if records:
+        print(f"Stage timings for {request.path}: {format_timings(records)}")
+    if records and usage_store:
+        record_llm_usage(records)
+
+
+def usage_owner():
+    """The user and family the LLM usage of this request is billed to"""
+    firebase_user = getattr(request, "firebase_user", None)
+    child_user = getattr(request, "child_user", None)
+    if child_user:
+        return {"user_id": child_user.get("username"), "family_id": child_user.get("parent_uid")}
+    if firebase_user:
+        return {"user_id": firebase_user.get("localId"), "family_id": firebase_user.get("localId")}
+    return {"user_id": None, "family_id": None}
+
+
+def record_llm_usage(records):
+    """Persist the completions of this request with the conversation and family they belong to"""
+    attribution = request_attribution()
+    conversation_id = attribution.get("conversation_id")
+    if conversation_id is None:
+        data = request.get_json(silent=True) or {}
+        conversation_id = data.get("conversation_id") or request.args.get("conversation_id")
+    owner = usage_owner()
+    user_id, family_id = owner["user_id"], owner["family_id"]
+    try:
+        usage_store.record(records, route=request.path, conversation_id=conversation_id,
+                           user_id=user_id, family_id=family_id)
+    except Exception as e:
+        print(f"Error recording LLM usage: {e}")
+
+
+# Speculative completions are recorded when they finish, the request that
+# started them may already have been answered and recorded
+if speculator is not None and usage_store:
+    speculator.record_usage = usage_store.record
+    speculator.attribution = usage_owner
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Counters of the LLM pipeline optimizations for this worker process
+    return jsonify({
+        "handler_cache": handler_cache_stats(),
+        "intent_classifier": intent_classifier_stats(),
+        "story_pool": story_pool.stats() if story_pool else {"enabled": False},
+        "llm_gateway": gateway_stats(),
+        "single_flight": single_flight_stats(),
+        "story_backend": story_backend_stats(),
+        "speculation": speculation_stats(),
+        "story_cache": story_cache_stats(),
+        "suggestions": suggestion_stats(),
+        "degraded": degraded_stats(),
+        "admission": admission_stats(),
+        "story_jobs": story_jobs.stats() if story_jobs else {"enabled": False},
+        "prompt_log": log_queue_stats(),
+    })
+
+
+@app.route('/admin/llm_usage', methods=['GET'])
+@firebase_auth_required
+def admin_llm_usage():
+    """
+    LLM token, latency and cost rollups, e.g.
+    ?hours=24&group_by=stage,family_id or ?conversation_id=42 for the raw records
+    """
+    if request.firebase_user.get('localId') not in admin_uids:
+        return jsonify({"error": "Admin access required"}), 403
+    if not usage_store:
+        return jsonify({"error": "LLM usage accounting is disabled"}), 404
+
+    conversation_id = request.args.get('conversation_id', type=int)
+    if conversation_id is not None:
+        return jsonify({"conversation_id": conversation_id,
+                        "records": usage_store.conversation_usage(conversation_id)})
+    hours = request.args.get('hours', 24, type=int)
+    group_by = [d for d in request.args.get('group_by', 'stage').split(',') if d]
+    return jsonify({
+        "hours": hours,
+        "group_by": group_by,
+        "rollup": usage_store.rollup(since_hours=hours, group_by=group_by,
+                                     family_id=request.args.get('family_id')),
+    })
+
+def training_label(code, source):
+    """
+    The handler code to keep with a user message for retraining the intent
+    classifier: only answers of the LLM handler, never the classifier's own
+    or cached ones
+    """
+    return code if source == "llm" else None
+
+
 @app.route('/log_message', methods=['POST'])
-def log_message(conversation_id, sender_type, code, content):
+def log_message(conversation_id, sender_type, code, content, handler_code=None):
     # Process the data as needed
     # For example, you can log it or save it to a database
 
     try:
         print(
             f"Logging message with conversation_id: {conversation_id}, sender_type: {sender_type}, code: {code}, content: {content}")
-        message = Message(
-            conversation_id=conversation_id,
-            sender_type=sender_type,
-            code=code,
-            content=content
-        )
-        db.session.add(message)
-        db.session.commit()
+        for attempt in range(2):
+            message = Message(
+                conversation_id=conversation_id,
+                sender_type=sender_type,
+                code=code,
+                content=content,
+                handler_code=handler_code
+            )
+            db.session.add(message)
+            if sender_type == SenderType.MODEL and code in (2, 3) and isinstance(content, str):
+                # Keep the structured story state in step with the logged
+                # parts: the message and its story part commit together
+                append_story_part(conversation_id, content, commit=False)
+            try:
+                db.session.commit()
+                break
+            except IntegrityError:
+                # Another request took the same part number first
+                db.session.rollback()
+                if attempt:
+                    raise
         print(f"Message logged: {message}")
+        attribute_usage(conversation_id=conversation_id)
     except Exception as e:
+        db.session.rollback()
         print(f"Error logging message: {e}")
     return jsonify({'status': 'success', 'message': 'Log message received'}), 200
 
@@ -78,6 +234,18 @@ def generate_meta_prompt():
     else:
         return jsonify({"error": "User input is required"}), 400
 
+llm_unavailable_message = "Sorry, I can't tell stories right now. Please try again later."
+
+
+@app.errorhandler(CircuitOpenError)
+def llm_unavailable(e):
+    """The story stages can't run without the LLM, so ask the client to come back once the breaker may close."""
+    response = jsonify({"message": llm_unavailable_message})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+    return response
+
+
 def generate_new_story(query):
     try:
         story = new_story_generator(query)
@@ -94,8 +262,180 @@ def add_to_existing_story(conversation_id, query):
     return extended_story
 
 
+def run_story_job(job):
+    """
+    Generate and log the story part of a queued job, returning the response
+    its route would have sent. Parents get numbered parts, like /handle_request.
+    """
+    start_request_timings()
+    start_usage_attribution()
+    numbered_parts = job.audience == "parent"
+    if job.kind == "new_story":
+        code = 2
+        story_data = generate_new_story(job.prompt)
+        if isinstance(story_data, dict):
+            title = story_data.get("title", "New Story")
+            story = story_data.get("story", "")
+            if numbered_parts:
+                response = f"TITLE: {title}\n\n STORY, PART #1: {story}"
+            else:
+                response = f"TITLE: {title}\n\nSTORY: {story}"
+        elif isinstance(story_data, str) and numbered_parts:
+            response = story_data.replace('STORY:', 'STORY, PART #1:')
+        else:
+            response = story_data
+    else:
+        code = 3
+        story_data = add_to_existing_story(job.conversation_id, job.prompt)
+        if isinstance(story_data, dict):
+            title = story_data.get("title", "Continued Story" if numbered_parts else "New Story")
+            story = story_data.get("story", "")
+            if numbered_parts:
+                response = f"TITLE: {title}\n\n STORY, PART #{story_data.get('part', 1)}: {story}"
+            else:
+                response = f"TITLE: {title}\n\nSTORY: {story}"
+        else:
+            response = story_data
+    if not isinstance(response, str):
+        raise ValueError(f"Invalid response from the story pipeline for job {job.id}")
+    log_message(job.conversation_id, SenderType.MODEL, code, response)
+
+    records = request_timings()
+    if records:
+        print(f"Stage timings for story job {job.id}: {format_timings(records)}")
+    if records and usage_store:
+        try:
+            usage_store.record(records, route=f"job:{job.kind}", conversation_id=job.conversation_id,
+                               user_id=job.user_id, family_id=job.family_id)
+        except Exception as e:
+            print(f"Error recording LLM usage: {e}")
+    return response
+
+
+# Story requests sent with "async": true are answered with a job id and run
+# by these workers (STORY_JOBS_ENABLED), results are fetched from /jobs/<id>
+story_jobs = story_jobs_from_env(app, run_story_job)
+
+
+@app.before_request
+def start_story_job_workers():
+    # Started by the first request a process serves instead of at import, so
+    # scripts and the reloader process that import app.py run no workers
+    if story_jobs:
+        story_jobs.start()
+
+
+job_max_wait_seconds = float(os.getenv("STORY_JOB_MAX_WAIT_SECONDS", "30"))
+
+
+def enqueue_story_job(conversation_id, code, query, audience):
+    """Queue the story part of a request sent with "async": true and answer with the job id"""
+    if audience == "child":
+        user_id = request.child_user.get('username')
+        family_id = request.child_user.get('parent_uid')
+    else:
+        user_id = family_id = request.firebase_user.get('localId')
+    kind = "new_story" if code == 2 else "add_to_story"
+    job_id = story_jobs.enqueue(kind, audience, conversation_id, user_id, family_id, query)
+    return jsonify({"job_id": job_id, "status": JobStatus.QUEUED.value, "conversation_id": conversation_id}), 202
+
+
+def story_job_conflict(conversation_id):
+    """
+    429 while a story job of the conversation is queued or running, else None.
+    The request that queued the job gave its admission slot back with the
+    202, so this keeps the conversation to one story part at a time.
+    """
+    if not story_jobs or not conversation_id:
+        return None
+    job_id = story_jobs.pending(conversation_id)
+    if job_id is None:
+        return None
+    response = jsonify({"error": "The story is still being written, please try again shortly",
+                        "job_id": job_id, "conversation_id": conversation_id})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, math.ceil(story_jobs.poll_seconds)))
+    return response
+
+
+def story_job_response(job_id, user_id, wait):
+    """Status of a job of the user, after waiting up to ?timeout= seconds for it to finish when wait is set"""
+    if not story_jobs:
+        return jsonify({"error": "Story jobs are disabled"}), 404
+    job = db.session.get(StoryJob, job_id)
+    if job is None or job.user_id != user_id:
+        return jsonify({"error": "Job not found"}), 404
+    if wait:
+        try:
+            timeout = min(float(request.args.get('timeout', job_max_wait_seconds)), job_max_wait_seconds)
+            # Also rejects nan
+            if not timeout >= 0:
+                raise ValueError(timeout)
+        except ValueError:
+            return jsonify({"error": "timeout must be a number of seconds"}), 400
+        job = story_jobs.wait(job_id, timeout)
+    body = {
+        "job_id": job.id,
+        "status": job.status.value,
+        "conversation_id": job.conversation_id,
+        "attempts": job.attempts,
+    }
+    if job.status == JobStatus.SUCCEEDED:
+        body["response"] = job.response
+    if job.error:
+        body["error"] = job.error
+    return jsonify(body)
+
+
+def sse_event(event, data):
+    """Format a Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def sse_response(events):
+    return Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        # Tell proxies not to buffer the stream, the point is the first word arriving early
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def stream_story_events(conversation_id, code, query, numbered_parts):
+    """
+    Stream a new story (code 2) or a continuation (code 3) as SSE events:
+    title once the TITLE line is complete, story chunks as they arrive and
+    done with the conversation_id after the full message has been logged
+    """
+    if code == 2:
+        events = stream_new_story(query)
+    else:
+        events = stream_add_to_story(conversation_id, query)
+    try:
+        for kind, data in events:
+            if kind == "title":
+                yield sse_event("title", {"title": data})
+            elif kind == "story":
+                yield sse_event("story", {"text": data})
+            elif kind == "error":
+                yield sse_event("error", {"message": data, "conversation_id": conversation_id})
+                return
+            elif kind == "complete":
+                # Same message format as the non-streaming routes
+                if numbered_parts:
+                    response = f"TITLE: {data['title']}\n\n STORY, PART #{data['part']}: {data['story']}"
+                else:
+                    response = f"TITLE: {data['title']}\n\nSTORY: {data['story']}"
+                log_message(conversation_id, SenderType.MODEL, code, response)
+                yield sse_event("done", {"response": response, "conversation_id": conversation_id})
+    except CircuitOpenError:
+        # The 200 is already sent, so the client gets the 503 reply as an event
+        yield sse_event("error", {"message": llm_unavailable_message, "conversation_id": conversation_id})
+
+
 @app.route('/handle_request', methods=['POST'])
 @firebase_auth_required
+@admission_required
 def handle_request():
     data = request.get_json()
     query = data.get('query')
@@ -105,15 +445,21 @@ def handle_request():
     if query:
         print(f"Received query: {query}")
         try:
-            code = int(handler(query))
+            code, handler_source = classify_with_speculation(query, conversation_id)
+            code = int(code)
             print(f"Handler returned code: {code}")
         except ValueError:
             return jsonify({"message": "Invalid response from handler"})
+        handler_code = training_label(code, handler_source)
         
         if code == 2 and not conversation_id:  # If the user asks for a new story and there is not existing conversation
             return jsonify({"confirmation": "Are you sure you want to start a new story? Please respond with 'yes' or 'no'.", "conversation_id": conversation_id})
         if code == 2 and conversation_id:  # If the user asks for a new story and there is an existing conversation
             code = 3 # set the code to 3 to add to the existing story
+        if code == 3:
+            busy = story_job_conflict(conversation_id)
+            if busy is not None:
+                return busy
 
         if conversation_id:
             conversation = Conversation.query.get(conversation_id)
@@ -127,7 +473,9 @@ def handle_request():
 
         print(
             f"Calling log_message with conversation_id: {conversation.id}, sender_type: {SenderType.USER}, code: {code}, query: {query}")
-        log_message(conversation.id, SenderType.USER, code, query)
+        log_message(conversation.id, SenderType.USER, code, query, handler_code=handler_code)
+        if code in (2, 3) and story_jobs and data.get('async'):
+            return enqueue_story_job(conversation.id, code, query, "parent")
         ### the following is never reached if the code is 2 and is handled in CONFIRM_NEW_STORY_ROUTE ###
         if code == 0:  # If the user asks for something unrelated to telling a story
             response = "Sorry, I can only tell stories. Please ask me to tell you a story."
@@ -165,8 +513,67 @@ def handle_request():
         return jsonify({"message": "Query required"})
 
 
+@app.route('/handle_request_stream', methods=['POST'])
+@firebase_auth_required
+@admission_required
+def handle_request_stream():
+    """Streaming variant of /handle_request that sends the story as Server-Sent Events"""
+    data = request.get_json()
+    query = data.get('query')
+    # Use Firebase user ID from the token
+    user_id = request.firebase_user.get('localId', 'user_id_placeholder')
+    conversation_id = data.get('conversation_id')
+    if not query:
+        return jsonify({"message": "Query required"})
+
+    try:
+        code, handler_source = classify_with_speculation(query, conversation_id)
+        code = int(code)
+    except ValueError:
+        return jsonify({"message": "Invalid response from handler"})
+    if code in (2, 3):
+        busy = story_job_conflict(conversation_id)
+        if busy is not None:
+            return busy
+
+    handler_code = training_label(code, handler_source)
+
+    def events(code, conversation_id):
+        if code == 2 and not conversation_id:  # If the user asks for a new story and there is not existing conversation
+            yield sse_event("confirmation", {"confirmation": "Are you sure you want to start a new story? Please respond with 'yes' or 'no'.", "conversation_id": conversation_id})
+            return
+        if code == 2 and conversation_id:  # If the user asks for a new story and there is an existing conversation
+            code = 3 # set the code to 3 to add to the existing story
+
+        if conversation_id:
+            conversation = Conversation.query.get(conversation_id)
+            if not conversation:
+                yield sse_event("error", {"message": "Invalid conversation ID"})
+                return
+        else:
+            conversation = Conversation(user_id=user_id)
+            db.session.add(conversation)
+            db.session.commit()
+            conversation_id = conversation.id
+
+        log_message(conversation.id, SenderType.USER, code, query, handler_code=handler_code)
+        if code == 0:  # If the user asks for something unrelated to telling a story
+            response = "Sorry, I can only tell stories. Please ask me to tell you a story."
+        elif code == 1:  # If the user asks for something related to a story but violates safety rules
+            response = "Sorry, I can't tell that story. Please ask me to tell you a story."
+        elif code in (2, 3):
+            yield from stream_story_events(conversation.id, code, query, numbered_parts=True)
+            return
+        else:
+            response = f"Invalid code: {code}"
+        yield sse_event("done", {"response": response, "conversation_id": conversation_id})
+
+    return sse_response(events(code, conversation_id))
+
+
 @app.route('/confirm_new_story', methods=['POST'])
 @firebase_auth_required
+@admission_required
 def confirm_new_story_route():
     data = request.get_json()
     query = data.get('query')
@@ -182,6 +589,8 @@ def confirm_new_story_route():
             db.session.commit()
             # logging the user message
             log_message(conversation.id, SenderType.USER, 2, query)
+            if story_jobs and data.get('async'):
+                return enqueue_story_job(conversation.id, 2, query, "parent")
 
             story_data = generate_new_story(query)
             if isinstance(story_data, dict):
@@ -203,6 +612,18 @@ def confirm_new_story_route():
         return jsonify({"message": "Query and confirmation required"})
 
 
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+@firebase_auth_required
+def get_story_job(job_id):
+    return story_job_response(job_id, request.firebase_user.get('localId'), wait=False)
+
+
+@app.route('/jobs/<int:job_id>/wait', methods=['GET'])
+@firebase_auth_required
+def wait_for_story_job(job_id):
+    return story_job_response(job_id, request.firebase_user.get('localId'), wait=True)
+
+
 @app.route('/delete_conversation', methods=['DELETE'])
 @firebase_auth_required
 def delete_conversation():
@@ -227,6 +648,9 @@ def delete_conversation():
         # Delete all messages associated with this conversation
         Message.query.filter_by(conversation_id=conversation_id).delete()
 
+        # Delete the story title and parts of this conversation
+        delete_story_state(conversation_id)
+
         # Delete the conversation
         db.session.delete(conversation)
         db.session.commit()
@@ -237,6 +661,38 @@ def delete_conversation():
         return jsonify({"error": str(e)}), 500
 
 
+# Page size of the cursor-paginated conversation listings
+default_page_size = int(os.getenv("CONVERSATION_PAGE_SIZE", "20"))
+max_page_size = int(os.getenv("CONVERSATION_MAX_PAGE_SIZE", "100"))
+
+
+def conversation_page_response(conversations_query, cursor, limit, include_total):
+    """
+    Keyset-paginated conversation listing: the page after cursor with the
+    next_cursor to pass back, None on the last page. The total, a count of
+    every conversation, is only computed when include_total is set.
+    """
+    # The Flutter client sends a missing limit as null or None
+    if limit in (None, '', 'null', 'None'):
+        limit = default_page_size
+    try:
+        limit = min(max(int(limit), 1), max_page_size)
+    except ValueError:
+        return jsonify({"error": f"Invalid limit: {limit}"}), 400
+    try:
+        result, next_cursor = conversation_page(conversations_query, limit, cursor)
+    except InvalidCursorError as e:
+        return jsonify({"error": str(e)}), 400
+    response = {
+        "conversations": result,
+        "next_cursor": next_cursor,
+        "limit": limit
+    }
+    if include_total:
+        response["total_conversations"] = conversations_query.count()
+    return jsonify(response)
+
+
 @app.route('/get_conversations', methods=['GET'])
 @firebase_auth_required
 def get_conversations():
@@ -246,35 +702,27 @@ def get_conversations():
     # Get pagination parameters from the query string
     page = request.args.get('page')  # Optional
     limit = request.args.get('limit')  # Optional
+    # Keyset pagination: the page after cursor, empty for the first page
+    cursor = request.args.get('cursor')  # Optional
+    include_total = request.args.get('include_total', 'false').lower() == 'true'
 
     try:
         # Fetch conversations for the user
         conversations_query = Conversation.query.filter_by(user_id=user_id)
 
+        if cursor is not None:
+            return conversation_page_response(conversations_query, cursor, limit, include_total)
+
+        # The page of conversations with the preview of their first story
+        # message and their message count, in a single query
         if page is not None and limit is not None:
             # Apply pagination if both page and limit are provided
             page = int(page)
             limit = int(limit)
-            conversations = conversations_query.order_by(Conversation.created_at.desc()) \
-                .offset(page * limit).limit(limit).all()
+            result = conversation_summaries(conversations_query, offset=page * limit, limit=limit)
         else:
             # Fetch all conversations if pagination is not provided
-            conversations = conversations_query.order_by(Conversation.created_at.desc()).all()
-
-        result = []
-        for conversation in conversations:
-            # Get the first message (story) for each conversation
-            messages = Message.query.filter_by(
-                conversation_id=conversation.id).order_by(Message.created_at).all()
-            first_story = next(
-                (msg for msg in messages if msg.sender_type == SenderType.MODEL), None)
-
-            result.append({
-                'id': conversation.id,
-                'created_at': conversation.created_at.isoformat(),
-                'preview': first_story.content[:100] + '...' if first_story else 'No story content',
-                'message_count': len(messages)
-            })
+            result = conversation_summaries(conversations_query)
 
         # Include pagination metadata only if pagination is applied
         if page is not None and limit is not None:
@@ -400,13 +848,11 @@ def get_child_accounts():
     # Print the parent_uid for debugging
     print(f"Parent UID: {parent_uid}")
 
-    # Query all child accounts 
-    child_accounts = ChildAccount.query.all()
-    # Filter child accounts by parent UID
-    child_accounts = [account for account in child_accounts if account.parent_uid == parent_uid]
+    # Query the child accounts of the parent
+    child_accounts = ChildAccount.query.filter_by(parent_uid=parent_uid).all()
 
     # Print the number of child accounts found
-    print(f"Found {len(child_accounts)} child accounts (all)")
+    print(f"Found {len(child_accounts)} child accounts")
 
     # Format the results
     result = []
@@ -422,6 +868,7 @@ def get_child_accounts():
 
 @app.route('/handle_child_request', methods=['POST'])
 @child_auth_required
+@admission_required
 def handle_child_request():
     data = request.get_json()
     query = data.get('query')
@@ -432,9 +879,14 @@ def handle_child_request():
 
     if query:
         try:
-            code = int(handler(query))
+            code, handler_source = classify_with_speculation(query, conversation_id)
+            code = int(code)
         except ValueError:
             return jsonify({"message": "Invalid response from handler"})
+        if code == 3:
+            busy = story_job_conflict(conversation_id)
+            if busy is not None:
+                return busy
 
         if conversation_id:
             conversation = Conversation.query.get(conversation_id)
@@ -449,7 +901,9 @@ def handle_child_request():
         if code == 2 and conversation_id:  # If the user asks for a new story and there is an existing conversation
             return jsonify({"confirmation": "Are you sure you want to start a new story? Please respond with 'yes' or 'no'.", "conversation_id": conversation_id})
 
-        log_message(conversation.id, SenderType.USER, code, query)
+        log_message(conversation.id, SenderType.USER, code, query, handler_code=training_label(code, handler_source))
+        if code in (2, 3) and story_jobs and data.get('async'):
+            return enqueue_story_job(conversation.id, code, query, "child")
 
         if code == 0:  # If the user asks for something unrelated to telling a story
             response = "Sorry, I can only tell stories. Please ask me to tell you a story."
@@ -481,8 +935,64 @@ def handle_child_request():
         return jsonify({"message": "Query required"})
 
 
+@app.route('/handle_child_request_stream', methods=['POST'])
+@child_auth_required
+@admission_required
+def handle_child_request_stream():
+    """Streaming variant of /handle_child_request that sends the story as Server-Sent Events"""
+    data = request.get_json()
+    query = data.get('query')
+    conversation_id = data.get('conversation_id')
+
+    # Use parent UID from the child token for database operations
+    parent_uid = request.child_user.get('parent_uid', 'user_id_placeholder')
+    if not query:
+        return jsonify({"message": "Query required"})
+
+    try:
+        code, handler_source = classify_with_speculation(query, conversation_id)
+        code = int(code)
+    except ValueError:
+        return jsonify({"message": "Invalid response from handler"})
+    if code == 3:
+        busy = story_job_conflict(conversation_id)
+        if busy is not None:
+            return busy
+
+    def events(conversation_id):
+        if conversation_id:
+            conversation = Conversation.query.get(conversation_id)
+            if not conversation:
+                yield sse_event("error", {"message": "Invalid conversation ID"})
+                return
+        else:
+            conversation = Conversation(user_id=parent_uid)
+            db.session.add(conversation)
+            db.session.commit()
+            conversation_id = conversation.id
+
+        if code == 2 and conversation_id:  # If the user asks for a new story and there is an existing conversation
+            yield sse_event("confirmation", {"confirmation": "Are you sure you want to start a new story? Please respond with 'yes' or 'no'.", "conversation_id": conversation_id})
+            return
+
+        log_message(conversation.id, SenderType.USER, code, query, handler_code=training_label(code, handler_source))
+        if code == 0:  # If the user asks for something unrelated to telling a story
+            response = "Sorry, I can only tell stories. Please ask me to tell you a story."
+        elif code == 1:  # If the user asks for something related to a story but violates safety rules
+            response = "Sorry, I can't tell that story. Please ask me to tell you a story."
+        elif code in (2, 3):
+            yield from stream_story_events(conversation.id, code, query, numbered_parts=False)
+            return
+        else:
+            response = f"Invalid code: {code}"
+        yield sse_event("done", {"response": response, "conversation_id": conversation_id})
+
+    return sse_response(events(conversation_id))
+
+
 @app.route('/confirm_child_new_story', methods=['POST'])
 @child_auth_required
+@admission_required
 def confirm_child_new_story():
     data = request.get_json()
     query = data.get('query')
@@ -497,6 +1007,8 @@ def confirm_child_new_story():
             conversation = Conversation(user_id=parent_uid)
             db.session.add(conversation)
             db.session.commit()
+            if story_jobs and data.get('async'):
+                return enqueue_story_job(conversation.id, 2, query, "child")
 
             story_data = generate_new_story(query)
             if isinstance(story_data, dict):
@@ -518,6 +1030,18 @@ def confirm_child_new_story():
         return jsonify({"message": "Query and confirmation required"})
 
 
+@app.route('/child_jobs/<int:job_id>', methods=['GET'])
+@child_auth_required
+def get_child_story_job(job_id):
+    return story_job_response(job_id, request.child_user.get('username'), wait=False)
+
+
+@app.route('/child_jobs/<int:job_id>/wait', methods=['GET'])
+@child_auth_required
+def wait_for_child_story_job(job_id):
+    return story_job_response(job_id, request.child_user.get('username'), wait=True)
+
+
 @app.route('/get_child_conversations', methods=['GET'])
 @child_auth_required
 def get_child_conversations():
@@ -528,17 +1052,29 @@ def get_child_conversations():
     page = request.args.get('page')  # Optional
     limit = request.args.get('limit')  # Optional
     assigned_stories = request.args.get('assigned_stories')  # Optional
-    # convert string encoded list of strings to python list of strings
-    if assigned_stories:
-        assigned_stories = ast.literal_eval(assigned_stories)
+    # Keyset pagination: the page after cursor, empty for the first page
+    cursor = request.args.get('cursor')  # Optional
+    include_total = request.args.get('include_total', 'false').lower() == 'true'
+    # The cursor listing parses the limit itself, the page listing below clears it
+    keyset_limit = limit
+    # convert string encoded list of strings to python list of strings, a
+    # child without assigned_stories (null from dart) sees no conversations
+    if assigned_stories in (None, '', 'null', 'None'):
+        assigned_stories = []
+    else:
+        try:
+            assigned_stories = ast.literal_eval(assigned_stories)
+            if type(assigned_stories) != list:
+                raise ValueError(assigned_stories)
+            assigned_stories = [int(story_id) for story_id in assigned_stories]
+        except (ValueError, TypeError, SyntaxError):
+            return jsonify({"error": "Invalid assigned_stories"}), 400
     # if the args are strings it means they are not passed (type 'null' in dart -> None in python)
     if type(page) == str:
         page = None
     if type(limit) == str:
         limit = None
-    if type(assigned_stories) != list:
-        assigned_stories = None
-    if (type(assigned_stories) != None) & (len(assigned_stories) == 0):
+    if len(assigned_stories) == 0:
         print('returning none')
         return jsonify({
             "conversations": [],
@@ -550,23 +1086,23 @@ def get_child_conversations():
     
         # Fetch conversations for the parent
         conversations_query = Conversation.query.filter_by(user_id=parent_uid)
-        total_conversations = conversations_query.count()
-        # Filter conversations based on assigned stories if provided
-        if assigned_stories:
-            # Fetch only conversations with assigned stories
-            #app.logger.info(f"Assigned stories: {assigned_stories}")
-            assigned_stories = [int(story_id) for story_id in assigned_stories]
-            #app.logger.info(f"Assigned stories: {assigned_stories}")
-            conversations_query = conversations_query.filter(
-                Conversation.id.in_(assigned_stories)
-            )
-            # log message to flask
-            #app.logger.info(f"Conversations query: {conversations_query}")
+        # Fetch only conversations with assigned stories
+        #app.logger.info(f"Assigned stories: {assigned_stories}")
+        conversations_query = conversations_query.filter(
+            Conversation.id.in_(assigned_stories)
+        )
+        # log message to flask
+        #app.logger.info(f"Conversations query: {conversations_query}")
+        if cursor is not None:
+            return conversation_page_response(conversations_query, cursor, keyset_limit, include_total)
+        total_conversations = None
         if page is not None and limit is not None and len(assigned_stories) > limit:
             # Apply pagination if both page and limit are provided & lots of assigned stories
             page = int(page)
             limit = int(limit)
-            
+            # Counted once, after the assigned stories filter
+            total_conversations = conversations_query.count()
+
             # if limit is greather than the total_conversations, set it to total_conversations
             if limit >= total_conversations:
                 limit = total_conversations
@@ -580,32 +1116,16 @@ def get_child_conversations():
                     "page": page,
                     "limit": limit
                 })
-            conversations = conversations_query.order_by(Conversation.created_at.desc()) \
-                .offset(page * limit).limit(limit).all()
+            result = conversation_summaries(conversations_query, offset=page * limit, limit=limit)
         else:
             # Fetch all conversations if pagination is not provided
-            conversations = conversations_query.order_by(Conversation.created_at.desc()).all()
-
-        result = []
-        for conversation in conversations:
-            # Get the first message (story) for each conversation
-            messages = Message.query.filter_by(
-                conversation_id=conversation.id).order_by(Message.created_at).all()
-            first_story = next(
-                (msg for msg in messages if msg.sender_type == SenderType.MODEL), None)
-
-            result.append({
-                'id': conversation.id,
-                'created_at': conversation.created_at.isoformat(),
-                'preview': first_story.content[:100] + '...' if first_story else 'No story content',
-                'message_count': len(messages)
-            })
+            result = conversation_summaries(conversations_query)
 
         # Include pagination metadata only if pagination is applied
         if page is not None and limit is not None:
             return jsonify({
                 "conversations": result,
-                "total_conversations": conversations_query.count(),
+                "total_conversations": total_conversations if total_conversations is not None else conversations_query.count(),
                 "page": page,
                 "limit": limit
             })
@@ -727,6 +1247,7 @@ def get_assigned_stories():
 
 @app.route('/generate_themed_story', methods=['POST'])
 @child_auth_required
+@admission_required
 def generate_themed_story():
     data = request.get_json()
     theme = data.get('theme')
@@ -740,56 +1261,17 @@ def generate_themed_story():
     except ValueError:
         return jsonify({"error": "Invalid theme"}), 400
 
-    # Generate a prompt based on the theme
-    prompts = {
-        StoryTheme.DRAGONS: [
-            "Tell me a story about a friendly dragon who helps a village",
-            "Tell me a story about a dragon who can't breathe fire",
-            "Tell me a story about a baby dragon learning to fly"
-        ],
-        StoryTheme.SPACE: [
-            "Tell me a story about astronauts discovering a new planet",
-            "Tell me a story about aliens visiting Earth",
-            "Tell me a story about a space adventure with talking robots"
-        ],
-        StoryTheme.ANIMALS: [
-            "Tell me a story about talking animals in a forest",
-            "Tell me a story about a brave little mouse",
-            "Tell me a story about animals working together to solve a problem"
-        ],
-        StoryTheme.MAGIC: [
-            "Tell me a story about a child discovering they have magic powers",
-            "Tell me a story about a magical school",
-            "Tell me a story about a wizard's apprentice"
-        ],
-        StoryTheme.PIRATES: [
-            "Tell me a story about a kind pirate who helps others",
-            "Tell me a story about finding a treasure map",
-            "Tell me a story about a pirate adventure with a talking parrot"
-        ],
-        StoryTheme.DINOSAURS: [
-            "Tell me a story about friendly dinosaurs",
-            "Tell me a story about a time-traveling adventure to see dinosaurs",
-            "Tell me a story about a baby dinosaur finding its family"
-        ],
-        StoryTheme.FAIRY_TALE: [
-            "Tell me a fairy tale about a brave princess who saves a prince",
-            "Tell me a fairy tale with a happy ending",
-            "Tell me a fairy tale about magical creatures in an enchanted forest"
-        ],
-        StoryTheme.ADVENTURE: [
-            "Tell me an adventure story about exploring a mysterious cave",
-            "Tell me an adventure story about finding a lost city",
-            "Tell me an adventure story about a magical journey"
-        ]
-    }
-
-    # Select a random prompt for the chosen theme
-    prompt = random.choice(prompts[story_theme])
-
     # Use parent UID from the child token for database operations
     parent_uid = request.child_user.get('parent_uid', 'user_id_placeholder')
 
+    # Hand out a pre-generated story when one is ready
+    pooled = story_pool.take(story_theme) if story_pool else None
+    if pooled:
+        prompt = pooled["prompt"]
+    else:
+        # Select a random prompt for the chosen theme
+        prompt = random_prompt(story_theme)
+
     # Create a new conversation
     conversation = Conversation(user_id=parent_uid)
     db.session.add(conversation)
@@ -798,8 +1280,11 @@ def generate_themed_story():
     # Log the user message
     log_message(conversation.id, SenderType.USER, 2, prompt)
 
-    # Generate the story
-    story_data = generate_new_story(prompt)
+    if pooled:
+        story_data = {"title": pooled["title"], "story": pooled["story"]} if pooled["title"] else pooled["story"]
+    else:
+        # Generate the story
+        story_data = generate_new_story(prompt)
     if isinstance(story_data, dict):
         title = story_data.get("title", f"{story_theme.value.title()} Story")
         story = story_data.get("story", "")
@@ -811,6 +1296,10 @@ def generate_themed_story():
         title = f"{story_theme.value.title()} Story"
         log_message(conversation.id, SenderType.MODEL, 2, response)
 
+    if story_pool:
+        # Replace the story that was handed out (or warm up an empty pool)
+        story_pool.request_refill(story_theme, prompt)
+
     return jsonify({
         "response": response,
         "conversation_id": conversation.id,
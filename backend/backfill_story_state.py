@@ -0,0 +1,47 @@
+import argparse
+import os
+from flask import Flask
+from db.db import db, init_db, Conversation, Story
+from db.story_state import backfill_story_state
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
+
+# Create a Flask app
+app = Flask(__name__)
+
+# Initialize the database, this also creates the story and story_part tables
+init_db(app)
+
+
+def backfill(rebuild=False, batch_size=500):
+    """
+    Build the story title and parts of existing conversations from their
+    logged messages. Conversations that already have a story state are
+    skipped unless rebuild is set.
+    """
+    with app.app_context():
+        query = db.session.query(Conversation.id).order_by(Conversation.id)
+        if not rebuild:
+            query = query.outerjoin(Story, Story.conversation_id == Conversation.id) \
+                .filter(Story.conversation_id.is_(None))
+        conversation_ids = [row[0] for row in query.all()]
+        print(f"Backfilling story state for {len(conversation_ids)} conversations")
+
+        stories = 0
+        for index, conversation_id in enumerate(conversation_ids, start=1):
+            if backfill_story_state(conversation_id):
+                stories += 1
+            if index % batch_size == 0:
+                print(f"Processed {index} conversations")
+        print(f"Story state written for {stories} conversations")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Backfill the story and story_part tables from logged messages")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="rebuild the story state of every conversation")
+    args = parser.parse_args()
+    backfill(rebuild=args.rebuild)
@@ -0,0 +1,202 @@
+"""Compare the per-conversation message loading of the conversation listings with the single listing query.
+
+Seeds users with hundreds of conversations of long story messages, then
+lists them the way /get_conversations used to (one query for the page plus
+one query loading every message of each conversation) and with
+conversation_summaries, checking both return the same listing and counting
+the SQL statements each one runs. Then pages through the largest user's
+conversations by offset and by keyset cursor, and by cursor through
+conversations whose server timestamps share a second. Uses a scratch SQLite
+database unless BENCHMARK_DATABASE_URL points somewhere else. It is not
+DATABASE_URL, the app's database, since the benchmark drops the tables first.
+
+    python benchmarks/conversation_list_benchmark.py --conversations 100 300 1000
+    python benchmarks/conversation_list_benchmark.py --limit 50 --output listing.json
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask import Flask
+from sqlalchemy import event, text
+
+from db.db import db, Conversation, Message, SenderType
+from db.conversation_list import conversation_summaries, conversation_page
+from db.migrations import migrate
+
+story = ("Once upon a time, a little dragon named Sparky lived at the edge of a quiet village. " * 40)[:4000]
+
+
+def create_app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("BENCHMARK_DATABASE_URL", "sqlite:///conversation_list_benchmark.db")
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+
+def seed(user_counts, messages_per_conversation):
+    with db.engine.begin() as connection:
+        db.metadata.drop_all(bind=connection)
+        connection.execute(text("DROP TABLE IF EXISTS schema_version"))
+    migrate(db.engine)
+    start = datetime(2025, 1, 1)
+    conversations, messages = [], []
+    conversation_id = message_id = 0
+    for user, count in user_counts.items():
+        for i in range(count):
+            conversation_id += 1
+            created = start + timedelta(minutes=conversation_id)
+            conversations.append({"id": conversation_id, "user_id": user, "created_at": created})
+            # Every 20th conversation has no story yet
+            senders = [SenderType.USER] if i % 20 == 0 else \
+                [SenderType.USER if m % 2 == 0 else SenderType.MODEL for m in range(messages_per_conversation)]
+            for m, sender in enumerate(senders):
+                message_id += 1
+                messages.append({
+                    "id": message_id, "conversation_id": conversation_id, "sender_type": sender, "code": 0,
+                    "content": story if sender == SenderType.MODEL else f"Tell me story {conversation_id}",
+                    "created_at": created + timedelta(seconds=m),
+                })
+    with db.engine.begin() as connection:
+        for table, rows in ((Conversation.__table__, conversations), (Message.__table__, messages)):
+            for i in range(0, len(rows), 2000):
+                connection.execute(table.insert(), rows[i:i + 2000])
+
+
+def legacy_summaries(conversations_query, offset=None, limit=None):
+    """The listing as the routes built it before conversation_summaries."""
+    query = conversations_query.order_by(Conversation.created_at.desc())
+    conversations = query.offset(offset).limit(limit).all() if limit is not None else query.all()
+    result = []
+    for conversation in conversations:
+        messages = Message.query.filter_by(
+            conversation_id=conversation.id).order_by(Message.created_at).all()
+        first_story = next(
+            (msg for msg in messages if msg.sender_type == SenderType.MODEL), None)
+        result.append({
+            'id': conversation.id,
+            'created_at': conversation.created_at.isoformat(),
+            'preview': first_story.content[:100] + '...' if first_story else 'No story content',
+            'message_count': len(messages)
+        })
+    return result
+
+
+def measure(list_conversations, user, limit, iterations):
+    statements = []
+
+    def count_statement(*args):
+        statements.append(1)
+
+    event.listen(db.engine, "before_cursor_execute", count_statement)
+    samples = []
+    try:
+        for _ in range(iterations):
+            db.session.expunge_all()
+            del statements[:]
+            start = time.perf_counter()
+            listing = list_conversations(Conversation.query.filter_by(user_id=user),
+                                         offset=0 if limit else None, limit=limit)
+            samples.append((time.perf_counter() - start) * 1000)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count_statement)
+    return listing, {"mean_ms": statistics.mean(samples), "min_ms": min(samples), "statements": len(statements)}
+
+
+def deep_pages(user, count, limit, iterations):
+    """Time each page of the listing reached with offset and with the keyset cursor of the page before it."""
+    rows = []
+    for offset in range(0, count, limit * max(1, count // limit // 5)):
+        after = None
+        if offset:
+            previous = conversation_summaries(Conversation.query.filter_by(user_id=user), offset=offset - 1, limit=1)[0]
+            after = (datetime.fromisoformat(previous['created_at']), previous['id'])
+        timings = {}
+        for name, kwargs in (("offset", {"offset": offset}), ("keyset", {"after": after})):
+            samples = []
+            for _ in range(iterations):
+                start = time.perf_counter()
+                listing = conversation_summaries(Conversation.query.filter_by(user_id=user), limit=limit, **kwargs)
+                samples.append((time.perf_counter() - start) * 1000)
+            timings[name] = (statistics.mean(samples), listing)
+        if timings["offset"][1] != timings["keyset"][1]:
+            raise SystemExit(f"Offset and keyset pages of {user} differ at offset {offset}")
+        rows.append({"offset": offset, "offset_ms": timings["offset"][0], "keyset_ms": timings["keyset"][0]})
+    return rows
+
+
+def same_second_pages(limit):
+    """
+    Page by cursor through conversations created in one burst, whose
+    CURRENT_TIMESTAMP created_at share a second, checking every conversation
+    is listed exactly once.
+    """
+    user = "same_second"
+    count = limit * 3 + 1
+    with db.engine.begin() as connection:
+        # Without created_at the database's CURRENT_TIMESTAMP default sets it
+        connection.execute(Conversation.__table__.insert(), [{"user_id": user} for _ in range(count)])
+    seen, cursor, pages = [], None, 0
+    start = time.perf_counter()
+    while pages <= count:
+        page, cursor = conversation_page(Conversation.query.filter_by(user_id=user), limit, cursor)
+        seen.extend(summary['id'] for summary in page)
+        pages += 1
+        if cursor is None:
+            break
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if len(seen) != count or len(set(seen)) != count:
+        raise SystemExit(f"Cursor pages of {user} listed {len(set(seen))} of {count} conversations in {pages} pages")
+    return {"conversations": count, "pages": pages, "total_ms": elapsed_ms}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--conversations", type=int, nargs="+", default=[100, 300, 1000],
+                        help="conversations of each benchmarked user")
+    parser.add_argument("--messages", type=int, default=6, help="messages per conversation")
+    parser.add_argument("--limit", type=int, default=50, help="page size of the paginated listing")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    app = create_app()
+    results = []
+    with app.app_context():
+        users = {f"user{count}": count for count in args.conversations}
+        seed(users, args.messages)
+        for user, count in users.items():
+            for limit in (args.limit, None):
+                legacy, legacy_stats = measure(legacy_summaries, user, limit, args.iterations)
+                listing, listing_stats = measure(conversation_summaries, user, limit, args.iterations)
+                if listing != legacy:
+                    raise SystemExit(f"Listings of {user} differ (limit {limit})")
+                results.append({"conversations": count, "limit": limit, "legacy": legacy_stats, "query": listing_stats})
+                print(f"{count:>5} conversations, {'page of ' + str(limit) if limit else 'all':<11}"
+                      f"  legacy {legacy_stats['mean_ms']:8.1f} ms ({legacy_stats['statements']} statements)"
+                      f"  query {listing_stats['mean_ms']:7.1f} ms ({listing_stats['statements']} statements)")
+
+        user, count = max(users.items(), key=lambda item: item[1])
+        print(f"\nPages of {args.limit} of {user}, by offset and by cursor")
+        deep = deep_pages(user, count, args.limit, args.iterations)
+        for row in deep:
+            print(f"  offset {row['offset']:>5}  offset {row['offset_ms']:6.2f} ms  keyset {row['keyset_ms']:6.2f} ms")
+
+        same_second = same_second_pages(args.limit)
+        print(f"\n{same_second['conversations']} conversations created in the same second listed in "
+              f"{same_second['pages']} cursor pages in {same_second['total_ms']:.1f} ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"listings": results, "pages": deep, "same_second": same_second}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
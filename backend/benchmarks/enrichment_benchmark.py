@@ -0,0 +1,105 @@
+"""Compare end-to-end latency and token usage of the legacy and fused prompt enrichment modes.
+
+Runs new_story_generator for every query in both modes and reports the
+wall time and the prompt/completion tokens of all LLM stages involved. The
+handler cache, story cache and speculative enrichment are disabled so
+repeated queries are generated again instead of being served from them.
+
+    python benchmarks/enrichment_benchmark.py --runs 3
+    python benchmarks/enrichment_benchmark.py --queries queries.txt --output enrichment.json
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from llm import llm
+from llm.timing import start_request_timings, request_timings, percentile
+
+default_queries = [
+    "Tell me a story about a friendly dragon who helps a village",
+    "Tell me a story about astronauts discovering a new planet",
+    "Tell me a story about a brave little mouse",
+    "Tell me a fairy tale with a happy ending",
+    "Tell me a story about a pirate adventure with a talking parrot",
+]
+
+
+def run_mode(mode, queries, runs):
+    """Generate a story for every query in the given mode and collect measurements."""
+    llm.prompt_enrichment_mode = mode
+    samples = []
+    for _ in range(runs):
+        for query in queries:
+            start_request_timings()
+            start = time.perf_counter()
+            llm.new_story_generator(query)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            # Only the LLM stages report tokens, the wrapper stages report zero
+            records = request_timings()
+            samples.append({
+                "query": query,
+                "elapsed_ms": elapsed_ms,
+                "llm_calls": sum(1 for r in records if r.model),
+                "prompt_tokens": sum(r.prompt_tokens for r in records),
+                "completion_tokens": sum(r.completion_tokens for r in records),
+            })
+    latencies = [s["elapsed_ms"] for s in samples]
+    return {
+        "mode": mode,
+        "samples": len(samples),
+        "llm_calls_per_story": statistics.mean(s["llm_calls"] for s in samples),
+        "latency_ms": {
+            "mean": statistics.mean(latencies),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+        },
+        "tokens_per_story": {
+            "prompt": statistics.mean(s["prompt_tokens"] for s in samples),
+            "completion": statistics.mean(s["completion_tokens"] for s in samples),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", help="file with one story query per line")
+    parser.add_argument("--runs", type=int, default=1, help="repetitions of the query set per mode")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--log-to-db", action="store_true",
+                        help="keep the prompt_data/meta_prompt_data logging enabled")
+    args = parser.parse_args()
+
+    queries = default_queries
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+    if not args.log_to_db:
+        llm.add_to_prompt_table = lambda **kwargs: None
+        llm.add_to_meta_prompt_table = lambda **kwargs: None
+    # Every story must run the enrichment stages, whatever the caches of the
+    # environment hold or learn from the repeated queries
+    llm.handler_cache = None
+    llm.story_cache = None
+    llm.speculator = None
+
+    results = [run_mode(mode, queries, args.runs) for mode in ("legacy", "fused")]
+    for result in results:
+        print(
+            f"{result['mode']:>6}: {result['llm_calls_per_story']:.1f} LLM calls, "
+            f"mean {result['latency_ms']['mean']:.0f} ms, p50 {result['latency_ms']['p50']:.0f} ms, "
+            f"p95 {result['latency_ms']['p95']:.0f} ms, "
+            f"{result['tokens_per_story']['prompt']:.0f} prompt + "
+            f"{result['tokens_per_story']['completion']:.0f} completion tokens per story"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
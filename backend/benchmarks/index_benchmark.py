@@ -0,0 +1,161 @@
+"""Query plans and latency of the hot conversation/message/child queries before and after the migration 2 indexes.
+
+Seeds a database the way an existing deployment looks before the upgrade
+(migration 1 applied, the new indexes missing), then runs EXPLAIN and times
+each query, applies the remaining migrations and measures again. Uses a
+scratch SQLite database unless BENCHMARK_DATABASE_URL points somewhere else.
+It is not DATABASE_URL, the app's database, since the benchmark drops the
+tables first: never point it at a database with real data.
+
+    python benchmarks/index_benchmark.py --parents 200 --conversations 50
+    BENCHMARK_DATABASE_URL=mysql+mysqlconnector://user:pw@localhost/bench python benchmarks/index_benchmark.py
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import create_engine, select, text
+
+from db.db import db, Conversation, Message, ChildAccount, StoryAssignment, SenderType
+from db.migrations import migrate, model_index, lookup_indexes
+from llm.timing import percentile
+
+conversation = Conversation.__table__
+message = Message.__table__
+child_account = ChildAccount.__table__
+story_assignment = StoryAssignment.__table__
+
+
+def reset(engine):
+    """Drop everything and leave the schema of a database before migration 2."""
+    with engine.begin() as connection:
+        db.metadata.drop_all(bind=connection)
+        connection.execute(text("DROP TABLE IF EXISTS schema_version"))
+    migrate(engine, target=1)
+    with engine.begin() as connection:
+        for name in lookup_indexes:
+            model_index(name).drop(bind=connection, checkfirst=True)
+
+
+def seed(engine, parents, conversations_per_parent, messages_per_conversation, children_per_parent):
+    rng = random.Random(7)
+    start = datetime(2025, 1, 1)
+    conversations, messages, children, assignments = [], [], [], []
+    conversation_id = message_id = 0
+    for p in range(parents):
+        for c in range(children_per_parent):
+            children.append({"username": f"child{p}_{c}", "pin": "1234", "display_name": f"Child {c}",
+                             "age": 7, "parent_uid": f"parent{p}", "created_at": start})
+    # Interleave the users' conversations in time like real traffic
+    for i in range(conversations_per_parent):
+        for p in range(parents):
+            conversation_id += 1
+            created = start + timedelta(minutes=conversation_id)
+            conversations.append({"id": conversation_id, "user_id": f"parent{p}", "created_at": created})
+            for m in range(messages_per_conversation):
+                message_id += 1
+                messages.append({
+                    "id": message_id, "conversation_id": conversation_id,
+                    "sender_type": SenderType.USER if m % 2 == 0 else SenderType.MODEL,
+                    "code": 0, "content": f"Message {m} of conversation {conversation_id}",
+                    "created_at": created + timedelta(seconds=m),
+                })
+            if children_per_parent and rng.random() < 0.3:
+                assignments.append({"conversation_id": conversation_id,
+                                    "child_username": f"child{p}_{rng.randrange(children_per_parent)}",
+                                    "title": f"Story {conversation_id}", "assigned_at": created})
+    with engine.begin() as connection:
+        for table, rows in ((conversation, conversations), (message, messages),
+                            (child_account, children), (story_assignment, assignments)):
+            for i in range(0, len(rows), 5000):
+                connection.execute(table.insert(), rows[i:i + 5000])
+    return {"conversations": len(conversations), "messages": len(messages),
+            "child_accounts": len(children), "story_assignments": len(assignments)}
+
+
+def hot_queries(parents, conversation_count, children_per_parent):
+    """(name, builder of a query for a random user, conversation or child) of the routes' queries."""
+    return [
+        ("conversations of a user, newest first", lambda rng: select(conversation).where(
+            conversation.c.user_id == f"parent{rng.randrange(parents)}"
+        ).order_by(conversation.c.created_at.desc()).limit(10)),
+        ("messages of a conversation", lambda rng: select(message).where(
+            message.c.conversation_id == rng.randint(1, conversation_count)
+        ).order_by(message.c.created_at)),
+        ("child accounts of a parent", lambda rng: select(child_account).where(
+            child_account.c.parent_uid == f"parent{rng.randrange(parents)}")),
+        ("stories assigned to a child", lambda rng: select(story_assignment).where(
+            story_assignment.c.child_username == f"child{rng.randrange(parents)}_{rng.randrange(max(1, children_per_parent))}")),
+        ("assignments of a conversation", lambda rng: select(story_assignment).where(
+            story_assignment.c.conversation_id == rng.randint(1, conversation_count))),
+    ]
+
+
+def explain(connection, query):
+    sql = str(query.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True}))
+    prefix = "EXPLAIN QUERY PLAN " if connection.dialect.name == "sqlite" else "EXPLAIN "
+    result = connection.execute(text(prefix + sql))
+    if connection.dialect.name == "sqlite":
+        return [row[-1] for row in result]
+    return [dict(row._mapping) for row in result]
+
+
+def measure(engine, queries, iterations):
+    results = {}
+    with engine.connect() as connection:
+        for name, build in queries:
+            rng = random.Random(11)
+            plan = explain(connection, build(rng))
+            samples = []
+            for _ in range(iterations):
+                query = build(rng)
+                start = time.perf_counter()
+                connection.execute(query).fetchall()
+                samples.append((time.perf_counter() - start) * 1e6)
+            results[name] = {
+                "plan": plan,
+                "mean_us": sum(samples) / len(samples),
+                "p95_us": percentile(samples, 95),
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--parents", type=int, default=200)
+    parser.add_argument("--conversations", type=int, default=50, help="conversations per parent")
+    parser.add_argument("--messages", type=int, default=6, help="messages per conversation")
+    parser.add_argument("--children", type=int, default=2, help="child accounts per parent")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    engine = create_engine(os.getenv("BENCHMARK_DATABASE_URL", "sqlite:///index_benchmark.db"))
+    reset(engine)
+    counts = seed(engine, args.parents, args.conversations, args.messages, args.children)
+    print(f"Seeded {counts}")
+    queries = hot_queries(args.parents, counts["conversations"], args.children)
+
+    before = measure(engine, queries, args.iterations)
+    applied = migrate(engine)
+    after = measure(engine, queries, args.iterations)
+
+    print(f"\nApplied migrations {applied}")
+    for name, _ in queries:
+        print(f"\n{name}")
+        print(f"  before: mean {before[name]['mean_us']:8.1f} us  p95 {before[name]['p95_us']:8.1f} us  plan {before[name]['plan']}")
+        print(f"  after:  mean {after[name]['mean_us']:8.1f} us  p95 {after[name]['p95_us']:8.1f} us  plan {after[name]['plan']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"counts": counts, "before": before, "after": after}, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
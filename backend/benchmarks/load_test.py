@@ -0,0 +1,258 @@
+"""Replay realistic parent and child sessions against a running backend and report latency per route.
+
+A parent session asks for a new story, confirms it, adds 3-5 continuations
+from the app's suggestion buttons and lists its conversations. A child
+session logs in, asks for a themed story and lists its conversations. Both
+upload a recorded audio clip when --audio is set. Latency percentiles and
+throughput are written per route as JSON so runs can be diffed.
+
+Run the backend against the mock LLM and a throwaway database, e.g.
+
+    python mock_openai_server.py --port 8001 &
+    DATABASE_URL=sqlite:///loadtest.db OPENAI_BASE_URL=http://localhost:8001/v1 \\
+        OPENAI_API_KEY=mock FIREBASE_AUTH_EMULATOR_HOST=localhost:8001 python app.py &
+    python benchmarks/load_test.py --sessions 50 --concurrency 8 --output before.json
+    python benchmarks/load_test.py --sessions 50 --concurrency 8 --compare before.json
+"""
+import argparse
+import base64
+import glob
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from llm.timing import percentile
+
+# Same as llm.valid_additions, the continuation buttons of the app
+valid_additions = ['What happens next?', 'Different Ending', 'Make it funny', 'Add a twist']
+story_queries = [
+    "Tell me a story about a friendly dragon who helps a village",
+    "Tell me a story about astronauts discovering a new planet",
+    "Tell me a story about a brave little mouse",
+    "Tell me a story about a pirate adventure with a talking parrot",
+    "Tell me a story about a robot who learns to paint",
+    "Tell me a story about a lost kitten finding its way home",
+]
+themes = ["dragons", "space", "animals", "magic", "pirates", "dinosaurs", "fairy_tale", "adventure"]
+
+
+class Recorder:
+    """Latency samples and outcomes per route, shared by all session threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def add(self, route, elapsed_ms, ok):
+        with self.lock:
+            self.samples.setdefault(route, []).append(elapsed_ms)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def report(self, wall_seconds):
+        routes = {}
+        with self.lock:
+            for route, samples in sorted(self.samples.items()):
+                routes[route] = {
+                    "requests": len(samples),
+                    "errors": self.errors.get(route, 0),
+                    "throughput_rps": round(len(samples) / wall_seconds, 3),
+                    "mean_ms": round(sum(samples) / len(samples), 1),
+                    "p50_ms": round(percentile(samples, 50), 1),
+                    "p95_ms": round(percentile(samples, 95), 1),
+                    "p99_ms": round(percentile(samples, 99), 1),
+                    "max_ms": round(max(samples), 1),
+                }
+            total = sum(len(samples) for samples in self.samples.values())
+            errors = sum(self.errors.values())
+        return routes, {"requests": total, "errors": errors,
+                        "throughput_rps": round(total / wall_seconds, 3)}
+
+
+class Client:
+    """One simulated user, timing every call by route."""
+
+    def __init__(self, base_url, recorder, timeout, token=None):
+        self.base_url = base_url.rstrip("/")
+        self.recorder = recorder
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.token = token
+
+    def call(self, method, route, json_body=None, params=None, label=None):
+        headers = {"Authorization": f"Bearer {self.token}"} if self.token else {}
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + route, json=json_body, params=params,
+                                            headers=headers, timeout=self.timeout)
+            body = response.json() if response.headers.get("Content-Type", "").startswith("application/json") else None
+            ok = response.status_code < 400 and not (isinstance(body, dict) and "error" in body)
+        except (requests.RequestException, ValueError) as e:
+            print(f"{route} failed: {e}")
+            body, ok = None, False
+        self.recorder.add(label or route, (time.perf_counter() - start) * 1000, ok)
+        return body or {}
+
+
+def parent_session(index, args, recorder, rng, audio_clips):
+    client = Client(args.base_url, recorder, args.timeout, token=f"{args.run_id}-parent-{index}")
+    query = rng.choice(story_queries)
+    client.call("POST", "/handle_request", {"query": query}, label="/handle_request (new)")
+    confirmed = client.call("POST", "/confirm_new_story", {"query": query, "confirmation": "y"})
+    conversation_id = confirmed.get("conversation_id")
+    if conversation_id:
+        for _ in range(rng.randint(args.min_continuations, args.max_continuations)):
+            client.call("POST", "/handle_request",
+                        {"query": rng.choice(valid_additions), "conversation_id": conversation_id},
+                        label="/handle_request (continue)")
+    client.call("GET", "/get_conversations", params={"page": 1, "limit": 10})
+    if audio_clips:
+        upload_audio(client, index, args, rng, audio_clips)
+    return client.token
+
+
+def child_session(index, args, recorder, rng, audio_clips):
+    parent = Client(args.base_url, recorder, args.timeout)
+    username = f"{args.run_id}-child-{index}"
+    parent.call("POST", "/create_child_account", {
+        "username": username, "pin": "1234", "display_name": f"Child {index}", "age": 7,
+        "parent_uid": f"{args.run_id}-parent-{index}",
+    })
+    login = parent.call("POST", "/child_login", {"username": username, "pin": "1234"})
+    if not login.get("token"):
+        return None
+    child = Client(args.base_url, recorder, args.timeout, token=login["token"])
+    story = child.call("POST", "/generate_themed_story", {"theme": rng.choice(themes)})
+    # The app lists the stories assigned to the child, here the one just generated
+    assigned = [story["conversation_id"]] if story.get("conversation_id") else []
+    child.call("GET", "/get_child_conversations",
+               params={"page": 1, "limit": 10, "assigned_stories": json.dumps(assigned)})
+    if audio_clips:
+        upload_audio(child, index, args, rng, audio_clips)
+    return username
+
+
+def upload_audio(client, index, args, rng, audio_clips):
+    # A unique name per upload so the server does not answer from its cache
+    client.call("POST", "/upload_audio", {
+        "bytes": rng.choice(audio_clips),
+        "filename": f"{args.run_id}-{index}-{uuid.uuid4().hex[:8]}",
+    })
+
+
+def load_audio_clips(pattern):
+    clips = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, "rb") as f:
+            clips.append(base64.b64encode(f.read()).decode("ascii"))
+    return clips
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(__file__), text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline_path):
+    """Print the change of the latency percentiles against a previous report."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline_path} (commit {baseline.get('commit')}):")
+    print(f"{'route':36} {'p50':>18} {'p95':>18} {'p99':>18}")
+    for route, stats in report["routes"].items():
+        before = baseline.get("routes", {}).get(route)
+        if before is None:
+            print(f"{route:36} (new route)")
+            continue
+        cells = []
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            change = (stats[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            cells.append(f"{stats[key]:8.0f} ({change:+6.1f}%)")
+        print(f"{route:36} " + " ".join(f"{cell:>18}" for cell in cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the story endpoints of a running backend")
+    parser.add_argument("--base-url", default="http://localhost:5000")
+    parser.add_argument("--sessions", type=int, default=20, help="number of parent sessions")
+    parser.add_argument("--child-sessions", type=int, default=None,
+                        help="number of child sessions (default: same as --sessions)")
+    parser.add_argument("--concurrency", type=int, default=4, help="sessions run at the same time")
+    parser.add_argument("--min-continuations", type=int, default=3)
+    parser.add_argument("--max-continuations", type=int, default=5)
+    parser.add_argument("--audio", default=None,
+                        help="glob of mp3 files to upload, e.g. 'uploads/*.mp3' (no uploads when unset)")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--compare", help="JSON report of an earlier run to compare against")
+    args = parser.parse_args()
+    args.run_id = f"loadtest-{int(time.time())}"
+    child_sessions = args.sessions if args.child_sessions is None else args.child_sessions
+
+    audio_clips = load_audio_clips(args.audio) if args.audio else []
+    recorder = Recorder()
+    jobs = [(parent_session, i) for i in range(args.sessions)]
+    jobs += [(child_session, i) for i in range(child_sessions)]
+    random.Random(args.seed).shuffle(jobs)
+
+    print(f"Running {args.sessions} parent and {child_sessions} child sessions "
+          f"against {args.base_url} with concurrency {args.concurrency}")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(session, index, args, recorder, random.Random(args.seed * 100003 + n), audio_clips)
+                   for n, (session, index) in enumerate(jobs)]
+        failed_sessions = 0
+        for future in futures:
+            if future.exception() is not None:
+                print(f"Session failed: {future.exception()}")
+                failed_sessions += 1
+    wall_seconds = time.perf_counter() - start
+
+    routes, overall = recorder.report(wall_seconds)
+    overall["wall_seconds"] = round(wall_seconds, 2)
+    overall["failed_sessions"] = failed_sessions
+    try:
+        server_metrics = requests.get(args.base_url.rstrip("/") + "/metrics", timeout=10).json()
+    except (requests.RequestException, ValueError):
+        server_metrics = None
+    report = {
+        "commit": git_commit(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time() - wall_seconds)),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "overall": overall,
+        "routes": routes,
+        "server_metrics": server_metrics,
+    }
+
+    print(f"\n{'route':36} {'n':>5} {'err':>4} {'rps':>7} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for route, stats in routes.items():
+        print(f"{route:36} {stats['requests']:5d} {stats['errors']:4d} {stats['throughput_rps']:7.2f} "
+              f"{stats['p50_ms']:8.0f} {stats['p95_ms']:8.0f} {stats['p99_ms']:8.0f}")
+    print(f"\n{overall['requests']} requests in {overall['wall_seconds']} s, "
+          f"{overall['throughput_rps']} req/s, {overall['errors']} errors")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
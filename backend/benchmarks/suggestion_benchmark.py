@@ -0,0 +1,171 @@
+"""Compare the LLM and local (TinyStories occurrence table) sources of vocabulary and narrative features.
+
+Times the local suggestion index on its own, then writes a story for every
+query with each combination of sources and reports the enrichment latency,
+the LLM calls and signals of the resulting story: how many suggested words
+made it into the story, its length and lexical diversity, and how much of
+it uses the TinyStories vocabulary.
+
+    python benchmarks/suggestion_benchmark.py --runs 3
+    python benchmarks/suggestion_benchmark.py --skip-stories --output suggestions.json
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from llm import llm
+from llm.suggestions import suggestion_index_from_env
+from llm.timing import start_request_timings, request_timings, percentile
+
+default_queries = [
+    "Tell me a story about a friendly dragon who helps a village",
+    "Tell me a story about astronauts discovering a new planet",
+    "Tell me a story about a brave little mouse",
+    "Tell me a fairy tale with a happy ending",
+    "Tell me a story about a pirate adventure with a talking parrot",
+]
+# (vocabulary source, features source)
+source_pairs = [("llm", "llm"), ("local", "llm"), ("llm", "local"), ("local", "local")]
+
+
+def story_words(text):
+    return re.findall(r"[a-z']+", text.lower())
+
+
+def vocabulary_used(vocabulary, story):
+    """Fraction of the suggested words whose stem appears in the story."""
+    suggested = [word.strip().lower() for word in vocabulary.split(",") if word.strip()]
+    if not suggested:
+        return None
+    text = story.lower()
+    return sum(1 for word in suggested if word[:max(4, len(word) - 2)] in text) / len(suggested)
+
+
+def time_index(index, queries, iterations):
+    """Latency of the local lookups in microseconds."""
+    samples = []
+    for _ in range(iterations):
+        for query in queries:
+            start = time.perf_counter()
+            index.vocabulary(query)
+            index.narrative_features(query)
+            samples.append((time.perf_counter() - start) * 1e6)
+    return {"p50_us": percentile(samples, 50), "p99_us": percentile(samples, 99), "mean_us": statistics.mean(samples)}
+
+
+def record_suggestions(suggested):
+    """Keep what the sources suggested, before the meta prompt rewrites it."""
+    story_prompt_generator = llm.story_prompt_generator
+
+    def recording_story_prompt_generator(query):
+        vocabulary, features, formatted_prompt = story_prompt_generator(query)
+        suggested["vocabulary"], suggested["features"] = vocabulary, features
+        return vocabulary, features, formatted_prompt
+
+    llm.story_prompt_generator = recording_story_prompt_generator
+
+
+def run_sources(vocabulary_source, features_source, queries, runs, write_stories, table_words, suggested):
+    """Enrich (and write a story for) every query with the given sources and collect measurements."""
+    llm.vocabulary_source = vocabulary_source
+    llm.features_source = features_source
+    samples = []
+    for _ in range(runs):
+        for query in queries:
+            start_request_timings()
+            start = time.perf_counter()
+            messages, _, _ = llm.new_story_messages(query)
+            enrichment_ms = (time.perf_counter() - start) * 1000
+            vocabulary = suggested["vocabulary"]
+            sample = {"query": query, "vocabulary": vocabulary, "features": suggested["features"],
+                      "enrichment_ms": enrichment_ms}
+            if write_stories:
+                story = llm.story_backend.generate("story", messages)
+                words = story_words(story)
+                sample.update({
+                    "total_ms": (time.perf_counter() - start) * 1000,
+                    "vocabulary_used": vocabulary_used(vocabulary, story),
+                    "story_words": len(words),
+                    "distinct_word_ratio": len(set(words)) / len(words) if words else 0.0,
+                    "tinystories_coverage": (
+                        sum(1 for word in words if word in table_words) / len(words) if words else 0.0),
+                })
+            sample["llm_calls"] = sum(1 for r in request_timings() if r.model)
+            samples.append(sample)
+
+    enrichment = [s["enrichment_ms"] for s in samples]
+    result = {
+        "vocabulary_source": vocabulary_source,
+        "features_source": features_source,
+        "samples": len(samples),
+        "llm_calls_per_story": statistics.mean(s["llm_calls"] for s in samples),
+        "enrichment_ms": {"mean": statistics.mean(enrichment), "p50": percentile(enrichment, 50),
+                          "p95": percentile(enrichment, 95)},
+        "examples": [{"query": s["query"], "vocabulary": s["vocabulary"], "features": s["features"]}
+                     for s in samples[:len(queries)]],
+    }
+    if write_stories:
+        used = [s["vocabulary_used"] for s in samples if s["vocabulary_used"] is not None]
+        result["story"] = {
+            "total_ms_p50": percentile([s["total_ms"] for s in samples], 50),
+            "vocabulary_used": statistics.mean(used) if used else None,
+            "words": statistics.mean(s["story_words"] for s in samples),
+            "distinct_word_ratio": statistics.mean(s["distinct_word_ratio"] for s in samples),
+            "tinystories_coverage": statistics.mean(s["tinystories_coverage"] for s in samples),
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", help="file with one story query per line")
+    parser.add_argument("--runs", type=int, default=1, help="repetitions of the query set per source pair")
+    parser.add_argument("--iterations", type=int, default=2000, help="repetitions of the local lookup timing")
+    parser.add_argument("--skip-stories", action="store_true", help="only run the enrichment, no story completion")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    queries = default_queries
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+    # The sources are compared on the legacy enrichment, the fused mode asks for both in one completion
+    llm.prompt_enrichment_mode = "legacy"
+    llm.single_flight_enabled = False
+    llm.add_to_prompt_table = lambda **kwargs: None
+    llm.add_to_meta_prompt_table = lambda **kwargs: None
+    if llm.suggestion_index is None:
+        llm.suggestion_index = suggestion_index_from_env()
+    table_words = set(llm.suggestion_index.words)
+    suggested = {}
+    record_suggestions(suggested)
+
+    lookup = time_index(llm.suggestion_index, queries, args.iterations)
+    print(f"local lookup: p50 {lookup['p50_us']:.1f} us, p99 {lookup['p99_us']:.1f} us")
+    results = [run_sources(vocabulary_source, features_source, queries, args.runs, not args.skip_stories, table_words,
+                           suggested)
+               for vocabulary_source, features_source in source_pairs]
+    for result in results:
+        line = (f"vocabulary={result['vocabulary_source']:>5} features={result['features_source']:>5}: "
+                f"{result['llm_calls_per_story']:.1f} LLM calls, enrichment p50 {result['enrichment_ms']['p50']:.0f} ms, "
+                f"p95 {result['enrichment_ms']['p95']:.0f} ms")
+        story = result.get("story")
+        if story:
+            vocabulary_rate = "n/a" if story["vocabulary_used"] is None else f"{story['vocabulary_used']:.0%}"
+            line += (f", story p50 {story['total_ms_p50']:.0f} ms, vocabulary used {vocabulary_rate}, "
+                     f"{story['words']:.0f} words, distinct {story['distinct_word_ratio']:.2f}, "
+                     f"TinyStories coverage {story['tinystories_coverage']:.2f}")
+        print(line)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"local_lookup": lookup, "sources": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import String, func, literal, or_, select
+
+from db.db import db, Conversation, Message, SenderType
+
+preview_length = 100
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+def encode_cursor(created_at, conversation_id):
+    """Opaque cursor of the position after a conversation of a listing."""
+    position = json.dumps([created_at.isoformat(), conversation_id])
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, conversation_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(created_at), int(conversation_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursorError(f"Invalid cursor: {cursor}") from e
+
+
+def cursor_bounds(created_at):
+    """
+    The first and last stored created_at of the second of a keyset position.
+    MySQL's DATETIME holds whole seconds. SQLite keeps datetimes as strings,
+    whole seconds from CURRENT_TIMESTAMP but with microseconds when bound by
+    SQLAlchemy, so there the second is a range of text. Either way the bare
+    column is compared and keeps using the index.
+    """
+    created_at = created_at.replace(microsecond=0)
+    if db.engine.dialect.name == "sqlite":
+        second = created_at.strftime("%Y-%m-%d %H:%M:%S")
+        return literal(second, String), literal(second + ".999999", String)
+    return created_at, created_at
+
+
+def conversation_summaries(conversations_query, offset=None, limit=None, after=None):
+    """
+    The conversations of conversations_query, newest first, with the preview
+    of their first story (MODEL) message and their message count, in one
+    query instead of loading the messages of every conversation.
+
+    The preview and count are correlated subqueries on the page of
+    conversations. Each is an index seek on (conversation_id, created_at),
+    and only the first preview_length characters of one message per
+    conversation are read back.
+
+    after is the (created_at, id) of the last conversation of the previous
+    page for keyset pagination, which seeks to the page on the
+    (user_id, created_at) index instead of counting off offset rows.
+    """
+    if after is not None:
+        created_at, conversation_id = after
+        first, last = cursor_bounds(created_at)
+        # The redundant created_at <= bound is what lets the index seek
+        conversations_query = conversations_query.filter(
+            Conversation.created_at <= last,
+            or_(Conversation.created_at < first, Conversation.id < conversation_id),
+        )
+    page = conversations_query.with_entities(Conversation.id, Conversation.created_at) \
+        .order_by(Conversation.created_at.desc(), Conversation.id.desc())
+    if offset:
+        page = page.offset(offset)
+    if limit is not None:
+        page = page.limit(limit)
+    page = page.subquery("page")
+
+    first_story = select(func.substr(Message.content, 1, preview_length)) \
+        .where(Message.conversation_id == page.c.id, Message.sender_type == SenderType.MODEL) \
+        .order_by(Message.created_at, Message.id).limit(1) \
+        .correlate(page).scalar_subquery()
+    message_count = select(func.count(Message.id)) \
+        .where(Message.conversation_id == page.c.id) \
+        .correlate(page).scalar_subquery()
+
+    rows = db.session.execute(
+        select(page.c.id, page.c.created_at, first_story.label("preview"), message_count.label("message_count"))
+        .order_by(page.c.created_at.desc(), page.c.id.desc())
+    ).all()
+
+    return [{
+        'id': row.id,
+        'created_at': row.created_at.isoformat(),
+        'preview': row.preview + '...' if row.preview is not None else 'No story content',
+        'message_count': row.message_count,
+    } for row in rows]
+
+
+def conversation_page(conversations_query, limit, cursor=None):
+    """
+    A page of at most limit conversation summaries after cursor (the first
+    page without one) and the cursor of the next page, None on the last page
+    """
+    after = decode_cursor(cursor) if cursor else None
+    # One extra row tells whether there is a next page
+    summaries = conversation_summaries(conversations_query, limit=limit + 1, after=after)
+    if len(summaries) <= limit:
+        return summaries, None
+    last = summaries[limit - 1]
+    return summaries[:limit], encode_cursor(datetime.fromisoformat(last['created_at']), last['id'])
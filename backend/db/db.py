@@ -1,6 +1,6 @@
 from flask_sqlalchemy import SQLAlchemy
 import os
-from sqlalchemy import Enum, inspect
+from sqlalchemy import Enum
 import enum
 
 db = SQLAlchemy()
@@ -22,13 +22,28 @@ class StoryTheme(enum.Enum):
     ADVENTURE = "adventure"
 
 
+class JobStatus(enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    DEAD = "dead"
+
+
 class Conversation(db.Model):
+    __table_args__ = (
+        # Conversations of a user, newest first
+        db.Index('ix_conversation_user_created', 'user_id', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     user_id = db.Column(db.String(255), nullable=False)
 
 
 class Message(db.Model):
+    __table_args__ = (
+        # Messages of a conversation in order
+        db.Index('ix_message_conversation_created', 'conversation_id', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     conversation_id = db.Column(db.Integer, db.ForeignKey(
         'conversation.id'), nullable=False)
@@ -36,12 +51,21 @@ class Message(db.Model):
     code = db.Column(db.Integer, nullable=False)
     content = db.Column(db.String(5000), nullable=False)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    # Code the LLM handler classified a user message as, before the routes
+    # turn a new story request in an existing conversation into a
+    # continuation. Null for codes answered by the handler cache or the local
+    # classifier, for messages that were not classified, e.g. confirmed or
+    # themed story prompts, and for messages logged before it was recorded.
+    handler_code = db.Column(db.Integer, nullable=True)
 
     conversation = db.relationship(
         'Conversation', backref=db.backref('messages', lazy=True))
 
 
 class ChildAccount(db.Model):
+    __table_args__ = (
+        db.Index('ix_child_account_parent', 'parent_uid'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(255), unique=True, nullable=False)
     pin = db.Column(db.String(255), nullable=False)
@@ -52,6 +76,10 @@ class ChildAccount(db.Model):
 
 
 class StoryAssignment(db.Model):
+    __table_args__ = (
+        db.Index('ix_story_assignment_child', 'child_username', 'assigned_at'),
+        db.Index('ix_story_assignment_conversation', 'conversation_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     conversation_id = db.Column(db.Integer, db.ForeignKey(
         'conversation.id'), nullable=False)
@@ -65,24 +93,139 @@ class StoryAssignment(db.Model):
         'ChildAccount', backref=db.backref('assigned_stories', lazy=True))
 
 
-def init_db(app):
-    db_user = os.getenv("DB_USER")
-    db_password = os.getenv("DB_PASSWORD")
-    db_host = os.getenv("DB_HOST")
-    db_name = os.getenv("DB_NAME")
+class Story(db.Model):
+    # Title and number of parts of the story told in a conversation, kept up
+    # to date as parts are logged so continuations don't re-parse messages
+    conversation_id = db.Column(db.Integer, db.ForeignKey(
+        'conversation.id'), primary_key=True)
+    title = db.Column(db.String(255), nullable=False)
+    part_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(),
+                           onupdate=db.func.current_timestamp())
 
-    print(f"Connecting to database at {db_host} with user {db_user}")
-    print(f"Using database {db_name}")
 
-    app.config['SQLALCHEMY_DATABASE_URI'] = (
-        f"mysql+mysqlconnector://{db_user}:{db_password}@{db_host}/{db_name}"
+class StoryPart(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('conversation_id', 'part_number',
+                            name='uq_story_part_conversation_part'),
     )
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.Integer, db.ForeignKey(
+        'conversation.id'), nullable=False)
+    part_number = db.Column(db.Integer, nullable=False)
+    content = db.Column(db.String(5000), nullable=False)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+
+class StorySummary(db.Model):
+    # Rolling summary of the oldest parts of a long story, so continuation
+    # prompts can stay within a token budget
+    conversation_id = db.Column(db.Integer, db.ForeignKey(
+        'conversation.id'), primary_key=True)
+    summary = db.Column(db.Text, nullable=False)
+    summarized_parts = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(),
+                           onupdate=db.func.current_timestamp())
+
+
+class PooledStory(db.Model):
+    # Pre-generated themed stories waiting to be handed out by /generate_themed_story
+    id = db.Column(db.Integer, primary_key=True)
+    theme = db.Column(Enum(StoryTheme), nullable=False)
+    prompt = db.Column(db.String(255), nullable=False)
+    title = db.Column(db.String(255), nullable=True)
+    story = db.Column(db.String(5000), nullable=False)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class StoryPoolRefill(db.Model):
+    # Lease of the worker topping up the pool of a (theme, prompt), so the
+    # story pools of several worker processes don't all refill it at once
+    theme = db.Column(Enum(StoryTheme), primary_key=True)
+    prompt = db.Column(db.String(255), primary_key=True)
+    locked_by = db.Column(db.String(64), nullable=True)
+    locked_until = db.Column(db.DateTime, nullable=False)
+
+
+class StoryJob(db.Model):
+    # Story generation requested with "async": true, run by the workers of
+    # story_jobs.StoryJobQueue. locked_by/locked_until are the lease of the
+    # worker running it, run_after delays retries.
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    audience = db.Column(db.String(16), nullable=False)
+    conversation_id = db.Column(db.Integer, db.ForeignKey(
+        'conversation.id'), nullable=False)
+    user_id = db.Column(db.String(255), nullable=False)
+    family_id = db.Column(db.String(255), nullable=True)
+    prompt = db.Column(db.String(5000), nullable=False)
+    status = db.Column(Enum(JobStatus), nullable=False, default=JobStatus.QUEUED)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_after = db.Column(db.DateTime, nullable=False)
+    locked_by = db.Column(db.String(64), nullable=True)
+    locked_until = db.Column(db.DateTime, nullable=True)
+    response = db.Column(db.String(5000), nullable=True)
+    error = db.Column(db.String(1000), nullable=True)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+# Analytics rows of the prompt enrichment, inserted by the prompt logging of
+# llm/llm.py. db/process_model_data.py first built them from the message
+# history, so they are plain tables rather than models.
+prompt_data = db.Table(
+    'prompt_data',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('features', db.Text),
+    db.Column('vocabulary', db.Text),
+    db.Column('user_prompt', db.Text),
+    db.Column('model_response', db.Text),
+)
+
+meta_prompt_data = db.Table(
+    'meta_prompt_data',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('user_meta_prompt', db.Text),
+    db.Column('prompt_vocabulary', db.Text),
+    db.Column('prompt_narratives', db.Text),
+    db.Column('model_meta_response', db.Text),
+    db.Column('model_meta_vocabulary', db.Text),
+    db.Column('model_meta_narratives', db.Text),
+)
+
+
+def database_uri():
+    """DATABASE_URL, e.g. sqlite:///loadtest.db for load tests, or the MySQL database of the DB_* variables"""
+    return os.getenv("DATABASE_URL") or (
+        f"mysql+mysqlconnector://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}"
+        f"@{os.getenv('DB_HOST')}/{os.getenv('DB_NAME')}"
+    )
+
+
+def engine_options():
+    """
+    Pool options shared by every engine of the backend: connections are
+    pinged before use and replaced before MySQL's wait_timeout drops them
+    """
+    return {
+        "pool_pre_ping": True,
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800")),
+    }
+
+
+def init_db(app):
+    print(f"Connecting to database at {os.getenv('DB_HOST')} with user {os.getenv('DB_USER')}")
+    print(f"Using database {os.getenv('DB_NAME')}")
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri()
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options()
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     db.init_app(app)
-    with app.app_context():
-        inspector=inspect(db.engine)
-        for table_name in db.metadata.tables.keys():
-            if not inspector.has_table(table_name):
-                print(f"Creating table: {table_name}")
-                db.create_all()
-        print("Database setup completed!")
+    # Deployments with several workers can set DB_MIGRATE_ON_STARTUP=false
+    # and run `python migrate.py` once per release instead
+    if os.getenv("DB_MIGRATE_ON_STARTUP", "true").lower() == "true":
+        from db.migrations import migrate
+        with app.app_context():
+            migrate(db.engine)
+    print("Database setup completed!")
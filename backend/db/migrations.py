@@ -0,0 +1,134 @@
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+
+from db.db import db
+
+# Versions applied to this database, one row per migration
+schema_version = Table(
+    "schema_version",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String(255), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+def create_missing_tables(connection):
+    """Create the tables of the models that don't exist yet, with their indexes."""
+    db.metadata.create_all(bind=connection)
+
+
+def create_tables(*names):
+    """Migration creating tables of models added after migration 1."""
+    def upgrade(connection):
+        for name in names:
+            db.metadata.tables[name].create(bind=connection, checkfirst=True)
+    return upgrade
+
+
+def model_index(name):
+    for table in db.metadata.tables.values():
+        for index in table.indexes:
+            if index.name == name:
+                return index
+    raise KeyError(f"No model declares the index {name}")
+
+
+def create_indexes(*names):
+    """Migration adding indexes declared on the models to tables that already exist."""
+    def upgrade(connection):
+        for name in names:
+            model_index(name).create(bind=connection, checkfirst=True)
+    return upgrade
+
+
+def add_columns(table_name, *names):
+    """Migration adding nullable columns declared on a model to its existing table."""
+    def upgrade(connection):
+        table = db.metadata.tables[table_name]
+        existing = {column["name"] for column in inspect(connection).get_columns(table_name)}
+        for name in names:
+            if name not in existing:
+                column_type = table.c[name].type.compile(dialect=connection.dialect)
+                connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {name} {column_type}"))
+    return upgrade
+
+
+def create_prompt_log_tables(connection):
+    create_tables("prompt_data", "meta_prompt_data")(connection)
+    # meta_prompt_data as db/process_model_data.py creates it only has the
+    # prompt and response columns
+    add_columns("meta_prompt_data", "prompt_vocabulary", "prompt_narratives",
+                "model_meta_vocabulary", "model_meta_narratives")(connection)
+
+
+# Access paths of the conversation listings, the story messages and the
+# child account and assignment lookups
+lookup_indexes = (
+    "ix_conversation_user_created",
+    "ix_message_conversation_created",
+    "ix_child_account_parent",
+    "ix_story_assignment_child",
+    "ix_story_assignment_conversation",
+)
+
+# (version, name, upgrade) in the order they are applied. Every upgrade must
+# be safe to run again: MySQL commits DDL at once, so a migration interrupted
+# before its schema_version row was written is run a second time.
+migrations = [
+    (1, "create missing tables", create_missing_tables),
+    (2, "conversation, message, child_account and story_assignment indexes", create_indexes(*lookup_indexes)),
+    (3, "message.handler_code", add_columns("message", "handler_code")),
+    (4, "story_pool_refill", create_tables("story_pool_refill")),
+    (5, "prompt_data and meta_prompt_data", create_prompt_log_tables),
+]
+
+
+@contextmanager
+def migration_lock(connection, timeout_seconds=60):
+    # Keeps workers starting at the same time from applying a migration twice
+    if connection.dialect.name != "mysql":
+        yield
+        return
+    acquired = connection.execute(text("SELECT GET_LOCK('schema_migrations', :timeout)"),
+                                  {"timeout": timeout_seconds}).scalar()
+    if not acquired:
+        raise RuntimeError("Timed out waiting for another process to finish migrating")
+    try:
+        yield
+    finally:
+        connection.execute(text("SELECT RELEASE_LOCK('schema_migrations')"))
+
+
+def applied_versions(connection):
+    schema_version.create(bind=connection, checkfirst=True)
+    return {row.version: row.applied_at for row in connection.execute(select(schema_version))}
+
+
+def migrate(engine, target=None):
+    """Apply the migrations this database is missing, up to target, and return the ones applied."""
+    applied = []
+    with engine.connect() as connection:
+        with migration_lock(connection):
+            with connection.begin():
+                done = applied_versions(connection)
+            for version, name, upgrade in migrations:
+                if version in done or (target is not None and version > target):
+                    continue
+                print(f"Applying migration {version}: {name}")
+                with connection.begin():
+                    upgrade(connection)
+                    connection.execute(schema_version.insert().values(
+                        version=version, name=name, applied_at=datetime.now()))
+                applied.append(version)
+    return applied
+
+
+def migration_status(engine):
+    """(version, name, applied_at or None) of every migration."""
+    with engine.connect() as connection:
+        with connection.begin():
+            done = applied_versions(connection)
+    return [(version, name, done.get(version)) for version, name, _ in migrations]
@@ -0,0 +1,74 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from db.db import database_uri, engine_options
+
+
+class PooledDatabase:
+    """
+    A bounded SQLAlchemy connection pool for work outside the Flask app
+    context, e.g. the analytics writer thread. Connections are pinged
+    before use and recycled after pool_recycle seconds, the same options
+    the Flask-SQLAlchemy engine gets from init_db. The time spent waiting
+    for a pooled connection is measured on every checkout.
+    """
+
+    def __init__(self, uri, pool_size, max_overflow, pool_timeout):
+        options = engine_options()
+        # In-memory SQLite keeps one connection per thread and takes no sizing
+        if uri not in ("sqlite://", "sqlite:///:memory:"):
+            options.update(pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout)
+        self.engine = create_engine(uri, **options)
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    @contextmanager
+    def begin(self):
+        """Check out a connection and run the enclosed statements in one transaction."""
+        start = time.perf_counter()
+        try:
+            connection = self.engine.connect()
+        except PoolTimeoutError:
+            with self.lock:
+                self.checkout_timeouts += 1
+            raise
+        wait_ms = (time.perf_counter() - start) * 1000
+        with self.lock:
+            self.checkouts += 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        with connection:
+            with connection.begin():
+                yield connection
+
+    def stats(self):
+        pool = self.engine.pool
+        with self.lock:
+            return {
+                "pool": type(pool).__name__,
+                "size": pool.size() if hasattr(pool, "size") else None,
+                "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+                "overflow": pool.overflow() if hasattr(pool, "overflow") else None,
+                "checkouts": self.checkouts,
+                "checkout_timeouts": self.checkout_timeouts,
+                "mean_checkout_wait_ms": self.total_wait_ms / self.checkouts if self.checkouts else None,
+                "max_checkout_wait_ms": self.max_wait_ms,
+            }
+
+
+def log_database_from_env():
+    """The pool of the prompt logging path, sized by the LOG_DB_POOL_* variables."""
+    return PooledDatabase(
+        database_uri(),
+        pool_size=int(os.getenv("LOG_DB_POOL_SIZE", "2")),
+        max_overflow=int(os.getenv("LOG_DB_POOL_MAX_OVERFLOW", "2")),
+        pool_timeout=float(os.getenv("LOG_DB_POOL_TIMEOUT_SECONDS", "5")),
+    )
@@ -0,0 +1,115 @@
+import re
+from sqlalchemy.exc import IntegrityError
+from db.db import db, Message, SenderType, Story, StoryPart, StorySummary
+
+default_title = "Continued Story"
+
+
+def parse_story_message(content):
+    """
+    Split a logged model message into its title and story part.
+    Handles both the "STORY, PART #n:" layout of the parent routes and the
+    "STORY:" layout of the child routes; the title is None when the message
+    has no TITLE line.
+    """
+    if "TITLE:" in content:
+        parts = re.split(r"STORY, PART #\d+:|STORY:", content, maxsplit=1)
+        if len(parts) > 1:
+            title = parts[0].replace("TITLE:", "").strip() or None
+            return title, parts[1].strip()
+    return None, content.strip()
+
+
+def append_story_part(conversation_id, content, retries=1, commit=True):
+    """
+    Record a model message as the next part of the conversation's story.
+    With commit=False the part is only added to the session, so the caller
+    commits it together with the message and retries on IntegrityError.
+    """
+    title, story = parse_story_message(content)
+    if not story:
+        return None
+    try:
+        # Lock the story row so concurrent continuations get distinct part numbers
+        story_state = Story.query.filter_by(
+            conversation_id=conversation_id).with_for_update().first()
+        if story_state is None:
+            story_state = Story(conversation_id=conversation_id,
+                                title=title or default_title, part_count=0)
+            db.session.add(story_state)
+        elif title:
+            story_state.title = title
+        story_state.part_count += 1
+        db.session.add(StoryPart(conversation_id=conversation_id,
+                                 part_number=story_state.part_count,
+                                 content=story))
+        if commit:
+            db.session.commit()
+        return story_state.part_count
+    except IntegrityError:
+        # Another request took the same part number first
+        db.session.rollback()
+        if retries > 0 and commit:
+            return append_story_part(conversation_id, content, retries - 1)
+        raise
+
+
+def load_story_state(conversation_id):
+    """
+    Load the title and the ordered story parts of a conversation with one
+    indexed query. Returns None when no story state exists yet.
+    """
+    rows = db.session.query(Story.title, Story.part_count, StoryPart.content) \
+        .join(StoryPart, StoryPart.conversation_id == Story.conversation_id) \
+        .filter(Story.conversation_id == conversation_id) \
+        .order_by(StoryPart.part_number).all()
+    if not rows:
+        return None
+    title, part_count = rows[0][0], rows[0][1]
+    return title, [row[2] for row in rows], part_count
+
+
+def story_part_count(conversation_id):
+    """
+    Number of parts in the story state of a conversation, 0 without one
+    """
+    return db.session.query(Story.part_count).filter(
+        Story.conversation_id == conversation_id).scalar() or 0
+
+
+def backfill_story_state(conversation_id):
+    """
+    Build the story state of a conversation from its logged messages,
+    replacing any existing state. Returns the number of parts found.
+    """
+    delete_story_state(conversation_id)
+    messages = Message.query.filter(
+        Message.conversation_id == conversation_id,
+        Message.sender_type == SenderType.MODEL,
+        Message.code.in_([2, 3])
+    ).order_by(Message.created_at, Message.id).all()
+
+    title = default_title
+    part_count = 0
+    for message in messages:
+        message_title, story = parse_story_message(message.content)
+        if not story:
+            continue
+        title = message_title or title
+        part_count += 1
+        db.session.add(StoryPart(conversation_id=conversation_id,
+                                 part_number=part_count, content=story))
+    if part_count:
+        db.session.add(Story(conversation_id=conversation_id,
+                             title=title, part_count=part_count))
+    db.session.commit()
+    return part_count
+
+
+def delete_story_state(conversation_id):
+    """
+    Remove the story state of a conversation, the caller commits
+    """
+    StorySummary.query.filter_by(conversation_id=conversation_id).delete()
+    StoryPart.query.filter_by(conversation_id=conversation_id).delete()
+    Story.query.filter_by(conversation_id=conversation_id).delete()
@@ -6,13 +6,23 @@ from flask import request, jsonify
 # Firebase project ID
 FIREBASE_PROJECT_ID = 'wonder-words-bac10'
 
+def identity_toolkit_url():
+    """
+    Base URL of the Firebase Auth REST API, or of the Auth emulator (or the
+    load test stand-in in mock_openai_server.py) when FIREBASE_AUTH_EMULATOR_HOST is set
+    """
+    emulator_host = os.environ.get("FIREBASE_AUTH_EMULATOR_HOST")
+    if emulator_host:
+        return f'http://{emulator_host}/identitytoolkit.googleapis.com/v1'
+    return 'https://identitytoolkit.googleapis.com/v1'
+
 def verify_firebase_token(id_token):
     """
     Verify the Firebase ID token using the Firebase Auth REST API
     """
     try:
         # Use Firebase Auth REST API to verify the token
-        url = f'https://identitytoolkit.googleapis.com/v1/accounts:lookup?key={os.environ.get("FIREBASE_API_KEY")}'
+        url = f'{identity_toolkit_url()}/accounts:lookup?key={os.environ.get("FIREBASE_API_KEY")}'
         payload = {'idToken': id_token}
         response = requests.post(url, json=payload)
         
@@ -0,0 +1,169 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def normalize_query(query):
+    """Fold case, punctuation and whitespace so trivially different inputs share a key."""
+    query = unicodedata.normalize("NFKC", query).casefold()
+    query = "".join(" " if unicodedata.category(ch).startswith("P") else ch for ch in query)
+    return re.sub(r"\s+", " ", query).strip()
+
+
+class MemoryCacheBackend:
+    """LRU store private to the current process."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at):
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def size(self):
+        with self.lock:
+            return len(self.entries)
+
+
+class SQLiteCacheBackend:
+    """LRU store in a SQLite file so every worker process on the host shares it."""
+
+    def __init__(self, path, max_entries, table="cache"):
+        self.path = path
+        self.max_entries = max_entries
+        self.table = table
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            connection.execute(
+                f"CREATE INDEX IF NOT EXISTS ix_{self.table}_accessed_at ON {self.table} (accessed_at)"
+            )
+
+    @contextmanager
+    def connect(self):
+        """Open a short-lived connection and commit the enclosed statements."""
+        connection = sqlite3.connect(self.path, timeout=5)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, key):
+        now = time.time()
+        with self.connect() as connection:
+            row = connection.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                return None
+            connection.execute(
+                f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            return row[0]
+
+    def set(self, key, value, expires_at):
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, expires_at, now),
+            )
+            # Evict expired entries first, then the least recently used ones
+            connection.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (now,))
+            connection.execute(
+                f"DELETE FROM {self.table} WHERE key IN ("
+                f"SELECT key FROM {self.table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def size(self):
+        with self.connect() as connection:
+            return connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+
+def cache_backend(name, max_entries, path=None, table="cache"):
+    """Build the cache backend configured by name ("memory" or "sqlite")."""
+    if name == "memory":
+        return MemoryCacheBackend(max_entries)
+    if name == "sqlite":
+        return SQLiteCacheBackend(path, max_entries, table=table)
+    raise ValueError(f"Unknown cache backend: {name}")
+
+
+class TTLCache:
+    """Bounded cache with a time-to-live and hit/miss counters on top of a backend.
+
+    Keys are normalized with normalize_query. Values must be strings so every
+    backend can store them. The counters are kept per process.
+    """
+
+    def __init__(self, backend, ttl_seconds):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, query):
+        value = self.backend.get(normalize_query(query))
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, query, value):
+        self.backend.set(normalize_query(query), value, time.time() + self.ttl_seconds)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": type(self.backend).__name__,
+                "entries": self.backend.size(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def cache_from_env(prefix, default_path, default_ttl_seconds, default_max_entries=1024):
+    """Build a TTLCache from the <prefix>_BACKEND/_MAX_ENTRIES/_TTL_SECONDS/_PATH variables."""
+    backend = cache_backend(
+        os.getenv(f"{prefix}_BACKEND", "memory").lower(),
+        int(os.getenv(f"{prefix}_MAX_ENTRIES", str(default_max_entries))),
+        path=os.getenv(f"{prefix}_PATH", default_path),
+        table=prefix.lower(),
+    )
+    return TTLCache(backend, float(os.getenv(f"{prefix}_TTL_SECONDS", str(default_ttl_seconds))))
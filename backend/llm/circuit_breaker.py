@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import deque
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling upstream while the circuit breaker is open."""
+
+    def __init__(self, message, retry_after=0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Tracks the outcome of upstream calls over a sliding window. Once at least
+    min_calls finished in the window and the share of failures reaches the
+    threshold, the breaker opens and calls fail fast for open_seconds. Then a
+    single probe call is let through: success closes the breaker again and
+    failure keeps it open for another open_seconds.
+    """
+
+    def __init__(self, error_threshold, min_calls, window_seconds, open_seconds):
+        self.error_threshold = error_threshold
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.lock = threading.Lock()
+        self.outcomes = deque()
+        self.state = "closed"
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+
+    def allow(self):
+        """
+        Raise CircuitOpenError unless a call may go upstream now. Returns True
+        when the call is the probe of a half open breaker.
+        """
+        with self.lock:
+            if self.state == "open" and time.time() - self.opened_at >= self.open_seconds:
+                self.state = "half_open"
+            if self.state == "closed":
+                return False
+            if self.state == "half_open" and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            self.rejected += 1
+            retry_in = max(0.0, self.opened_at + self.open_seconds - time.time())
+        raise CircuitOpenError(f"Upstream LLM circuit is open, retry in {retry_in:.1f} s", retry_in)
+
+    def record(self, ok, probe=False):
+        """Record the outcome of a call that allow() let through."""
+        with self.lock:
+            now = time.time()
+            if probe:
+                self.probe_in_flight = False
+                if ok:
+                    self.state = "closed"
+                    self.outcomes.clear()
+                else:
+                    self._open(now)
+                return
+            self.outcomes.append((now, ok))
+            self._trim(now)
+            if self.state != "closed" or len(self.outcomes) < self.min_calls:
+                return
+            failures = sum(1 for _, succeeded in self.outcomes if not succeeded)
+            if failures / len(self.outcomes) >= self.error_threshold:
+                self._open(now)
+
+    def _open(self, now):
+        # Called with the lock held
+        self.state = "open"
+        self.opened_at = now
+        self.times_opened += 1
+        print(f"LLM circuit breaker opened, failing fast for {self.open_seconds} s")
+
+    def _trim(self, now):
+        # Called with the lock held
+        while self.outcomes and self.outcomes[0][0] < now - self.window_seconds:
+            self.outcomes.popleft()
+
+    def stats(self):
+        with self.lock:
+            self._trim(time.time())
+            failures = sum(1 for _, ok in self.outcomes if not ok)
+            return {
+                "state": self.state,
+                "window_calls": len(self.outcomes),
+                "window_error_rate": failures / len(self.outcomes) if self.outcomes else 0.0,
+                "error_threshold": self.error_threshold,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+            }
@@ -0,0 +1,101 @@
+import math
+import os
+import re
+
+from db.db import db, StorySummary
+
+# Token budget for the story context embedded in continuation prompts. The
+# newest parts are kept verbatim, older ones are folded into a rolling summary
+# that is stored with the conversation and only extended when parts age out.
+context_token_budget = int(os.getenv("STORY_CONTEXT_TOKEN_BUDGET", "600"))
+verbatim_parts = int(os.getenv("STORY_CONTEXT_VERBATIM_PARTS", "3"))
+summary_token_budget = int(os.getenv("STORY_SUMMARY_TOKEN_BUDGET", "150"))
+# "heuristic" counts tokens with a local regex estimate. "tiktoken" uses the
+# tiktoken encoding, which must already be in the local tiktoken cache since
+# the context builder never goes to the network.
+tokenizer_name = os.getenv("STORY_CONTEXT_TOKENIZER", "heuristic").lower()
+
+_token_pattern = re.compile(r"\w+|[^\w\s]")
+_encoding = None
+
+
+def _heuristic_token_count(text):
+    # Roughly one token per short word or punctuation mark and one per ~5
+    # characters of longer words, which errs on the side of overcounting
+    return sum(
+        max(1, math.ceil(len(piece) / 5)) for piece in _token_pattern.findall(text)
+    )
+
+
+def count_tokens(text):
+    """Count the tokens of text without any network access."""
+    global _encoding, tokenizer_name
+    if tokenizer_name == "tiktoken":
+        try:
+            if _encoding is None:
+                import tiktoken
+                _encoding = tiktoken.get_encoding("o200k_base")
+            return len(_encoding.encode(text))
+        except Exception as e:
+            print(f"Error loading the tiktoken encoding, using the heuristic token count: {e}")
+            tokenizer_name = "heuristic"
+    return _heuristic_token_count(text)
+
+
+def truncate_to_tokens(text, max_tokens, keep_end=False):
+    """Cut text to at most max_tokens, keeping whole words from the start (or the end)."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    words = text.split()
+    while words and count_tokens(" ".join(words)) > max_tokens:
+        # Drop about the overshoot at once instead of one word at a time
+        drop = max(1, (count_tokens(" ".join(words)) - max_tokens) // 2)
+        words = words[drop:] if keep_end else words[:-drop]
+    return " ".join(words)
+
+
+def rolling_summary(conversation_id, title, parts, fold_count, summarize):
+    """
+    Return a summary covering the first fold_count parts, extending the
+    stored summary with the parts that aged out since it was last written.
+    """
+    stored = db.session.get(StorySummary, conversation_id)
+    if stored is not None and stored.summarized_parts >= fold_count:
+        return stored.summary, stored.summarized_parts
+
+    previous_summary = stored.summary if stored is not None else ""
+    already_summarized = stored.summarized_parts if stored is not None else 0
+    summary = summarize(previous_summary, title, parts[already_summarized:fold_count], summary_token_budget)
+    summary = truncate_to_tokens(summary, summary_token_budget)
+    if stored is None:
+        stored = StorySummary(conversation_id=conversation_id)
+        db.session.add(stored)
+    stored.summary = summary
+    stored.summarized_parts = fold_count
+    db.session.commit()
+    return summary, fold_count
+
+
+def build_story_context(conversation_id, title, parts, summarize):
+    """
+    Build the "Existing Story" text for a continuation within the token budget.
+
+    The last verbatim_parts parts are kept word for word (fewer if they alone
+    exceed the budget) and everything before them is replaced by the rolling
+    summary. summarize(previous_summary, title, new_parts, max_tokens) is the
+    LLM call that extends a summary.
+    """
+    fold_count = max(0, len(parts) - verbatim_parts)
+    verbatim = parts[fold_count:]
+    while len(verbatim) > 1 and count_tokens("\n".join(verbatim)) > context_token_budget - summary_token_budget:
+        fold_count += 1
+        verbatim = parts[fold_count:]
+    if fold_count == 0:
+        return truncate_to_tokens("\n".join(parts), context_token_budget, keep_end=True)
+
+    summary, summarized_parts = rolling_summary(conversation_id, title, parts, fold_count, summarize)
+    # A summary written under a smaller budget may already cover more parts
+    verbatim = parts[summarized_parts:]
+    # The end of the story matters most for what happens next
+    recent = truncate_to_tokens("\n".join(verbatim), context_token_budget - summary_token_budget, keep_end=True)
+    return f"Summary of the story so far: {summary}\n{recent}"
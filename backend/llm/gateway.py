@@ -0,0 +1,268 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import openai
+from dotenv import load_dotenv
+from openai import OpenAI
+
+from llm.circuit_breaker import CircuitBreaker, CircuitOpenError
+from llm.hedging import Hedger, LatencyTracker
+from llm.timing import timed, record_stage
+
+load_dotenv(dotenv_path=os.path.join(
+    os.path.dirname(__file__), '..', '..', '.env'))
+
+model = "gpt-4o-mini"
+
+# Keep-alive connection pool shared by every stage of this process
+http_client = httpx.Client(
+    limits=httpx.Limits(
+        max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "32")),
+        max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "16")),
+        keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY_SECONDS", "60")),
+    ),
+)
+
+# Retries are done here with jittered backoff, so the SDK's own are disabled.
+# OPENAI_BASE_URL points the backend at another server, e.g. the load test
+# stand-in mock_openai_server.py.
+client = OpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    base_url=os.getenv("OPENAI_BASE_URL") or None,
+    http_client=http_client,
+    max_retries=0,
+)
+
+# Per-stage request timeouts in seconds, overridable with LLM_TIMEOUT_<STAGE>
+stage_timeouts = {
+    "handler": 10.0,
+    "vocabulary": 10.0,
+    "features": 10.0,
+    "meta_prompt": 20.0,
+    "fused_enrichment": 20.0,
+    "story_summary": 20.0,
+    "story": 60.0,
+}
+default_timeout = float(os.getenv("LLM_TIMEOUT_DEFAULT", "30"))
+max_retries = int(os.getenv("LLM_MAX_RETRIES", "2"))
+backoff_base = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "0.5"))
+backoff_max = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "8"))
+# Cap on upstream calls in flight in this process, callers wait for a slot
+max_in_flight = int(os.getenv("LLM_MAX_IN_FLIGHT", "16"))
+slot_timeout = float(os.getenv("LLM_SLOT_TIMEOUT_SECONDS", "30"))
+in_flight_slots = threading.BoundedSemaphore(max_in_flight)
+
+# The circuit breaker fails calls fast while too many recent upstream calls
+# failed, so the short stages can take their degraded path instead of waiting
+circuit_breaker = CircuitBreaker(
+    error_threshold=float(os.getenv("LLM_BREAKER_ERROR_THRESHOLD", "0.5")),
+    min_calls=int(os.getenv("LLM_BREAKER_MIN_CALLS", "10")),
+    window_seconds=float(os.getenv("LLM_BREAKER_WINDOW_SECONDS", "30")),
+    open_seconds=float(os.getenv("LLM_BREAKER_OPEN_SECONDS", "15")),
+) if os.getenv("LLM_CIRCUIT_BREAKER_ENABLED", "true").lower() == "true" else None
+
+# LLM_HEDGING_ENABLED=true sends a duplicate of a short stage completion that
+# is slower than the stage's recent LLM_HEDGE_PERCENTILE latency and keeps the
+# first answer. Until LLM_HEDGE_MIN_SAMPLES calls were seen the default delay is used.
+latency_tracker = LatencyTracker(window=int(os.getenv("LLM_HEDGE_WINDOW", "200")))
+hedger = Hedger(
+    ThreadPoolExecutor(
+        max_workers=int(os.getenv("LLM_HEDGE_MAX_WORKERS", "16")),
+        thread_name_prefix="hedge",
+    ),
+    latency_tracker,
+    stages={stage.strip() for stage in os.getenv("LLM_HEDGE_STAGES", "handler,vocabulary,features").split(",")
+            if stage.strip()},
+    pct=float(os.getenv("LLM_HEDGE_PERCENTILE", "95")),
+    min_delay_ms=float(os.getenv("LLM_HEDGE_MIN_DELAY_MS", "50")),
+    default_delay_ms=float(os.getenv("LLM_HEDGE_DEFAULT_DELAY_MS", "1000")),
+    min_samples=int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20")),
+) if os.getenv("LLM_HEDGING_ENABLED", "false").lower() == "true" else None
+
+retryable_errors = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+class LLMGatewayBusyError(Exception):
+    """Raised when no upstream slot frees up within LLM_SLOT_TIMEOUT_SECONDS."""
+
+
+class GatewayStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.calls = {}
+        self.retries = {}
+        self.failures = {}
+        self.busy_rejections = 0
+
+    def count(self, counter, stage):
+        with self.lock:
+            counter[stage] = counter.get(stage, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "in_flight": self.in_flight,
+                "max_in_flight": max_in_flight,
+                "calls": dict(self.calls),
+                "retries": dict(self.retries),
+                "failures": dict(self.failures),
+                "busy_rejections": self.busy_rejections,
+            }
+
+
+stats = GatewayStats()
+
+
+def stage_timeout(stage):
+    override = os.getenv(f"LLM_TIMEOUT_{stage.upper()}")
+    if override:
+        return float(override)
+    return stage_timeouts.get(stage, default_timeout)
+
+
+def backoff_delay(attempt, error):
+    """Full-jitter exponential backoff, honouring Retry-After on rate limits."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(backoff_max, float(retry_after))
+        except ValueError:
+            pass
+    return random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+
+
+class upstream_slot:
+    """Hold one of the process-wide in-flight slots for the duration of a call."""
+
+    def __enter__(self):
+        if not in_flight_slots.acquire(timeout=slot_timeout):
+            with stats.lock:
+                stats.busy_rejections += 1
+            raise LLMGatewayBusyError(f"No upstream LLM slot free after {slot_timeout} s")
+        with stats.lock:
+            stats.in_flight += 1
+        return self
+
+    def __exit__(self, *exc):
+        with stats.lock:
+            stats.in_flight -= 1
+        in_flight_slots.release()
+
+
+def guarded_call(stage, call):
+    """Run call() through the circuit breaker, recording its latency when it succeeds."""
+    probe = circuit_breaker.allow() if circuit_breaker is not None else False
+    ok = True
+    start = time.perf_counter()
+    try:
+        result = call()
+        latency_tracker.add(stage, (time.perf_counter() - start) * 1000)
+        return result
+    except retryable_errors:
+        ok = False
+        raise
+    finally:
+        # Other errors, e.g. a rejected request, still mean upstream answered
+        if circuit_breaker is not None:
+            circuit_breaker.record(ok, probe)
+
+
+def call_with_retries(stage, call, hold_slot=True):
+    """Run call() with the stage's retry policy, sleeping between attempts.
+
+    With hold_slot the call runs inside an upstream slot; callers that
+    already hold one (streaming) pass hold_slot=False. An open circuit
+    breaker raises CircuitOpenError without retrying.
+    """
+    attempt = 0
+    while True:
+        stats.count(stats.calls, stage)
+        try:
+            if not hold_slot:
+                return guarded_call(stage, call)
+            with upstream_slot():
+                return guarded_call(stage, call)
+        except CircuitOpenError:
+            stats.count(stats.failures, stage)
+            raise
+        except retryable_errors as e:
+            if attempt >= max_retries:
+                stats.count(stats.failures, stage)
+                raise
+            delay = backoff_delay(attempt, e)
+            print(f"Retrying {stage} completion in {delay:.2f} s after {type(e).__name__}")
+            stats.count(stats.retries, stage)
+            attempt += 1
+            time.sleep(delay)
+        except Exception:
+            stats.count(stats.failures, stage)
+            raise
+
+
+def create_completion(stage, messages, **kwargs):
+    """Run a chat completion for a pipeline stage and record its latency and token usage."""
+    kwargs.setdefault("model", model)
+    kwargs.setdefault("timeout", stage_timeout(stage))
+    def attempt():
+        return call_with_retries(stage, lambda: client.chat.completions.create(messages=messages, **kwargs))
+
+    with timed(stage) as record:
+        if hedger is not None and stage in hedger.stages:
+            # A duplicate would only queue behind the others when every slot is taken
+            chat_completion = hedger.call(stage, attempt, may_hedge=lambda: stats.in_flight < max_in_flight)
+        else:
+            chat_completion = attempt()
+        record.record_usage(chat_completion)
+    return chat_completion
+
+
+def stream_completion(stage, messages, **kwargs):
+    """Stream a chat completion for a pipeline stage, yielding the text deltas as they arrive.
+
+    Retries only cover opening the stream; the upstream slot is held until
+    the stream is exhausted or closed.
+    """
+    kwargs.setdefault("model", model)
+    kwargs.setdefault("timeout", stage_timeout(stage))
+    with timed(stage) as record, upstream_slot():
+        start = time.perf_counter()
+        first_token = True
+        stream = call_with_retries(
+            stage,
+            lambda: client.chat.completions.create(
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+                **kwargs
+            ),
+            hold_slot=False,
+        )
+        for chunk in stream:
+            if chunk.usage is not None:
+                record.record_usage(chunk)
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if first_token:
+                record_stage(f"{stage}_first_token", (time.perf_counter() - start) * 1000)
+                first_token = False
+            yield chunk.choices[0].delta.content
+
+
+def gateway_stats():
+    return {
+        **stats.snapshot(),
+        "latency": latency_tracker.snapshot(),
+        "hedging": hedger.stats() if hedger is not None else {"enabled": False},
+        "circuit_breaker": circuit_breaker.stats() if circuit_breaker is not None else {"enabled": False},
+    }
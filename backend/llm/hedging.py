@@ -0,0 +1,116 @@
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from llm.timing import percentile
+
+
+class LatencyTracker:
+    """Latencies of the most recent successful upstream calls per stage."""
+
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, stage, elapsed_ms):
+        with self.lock:
+            self.samples.setdefault(stage, deque(maxlen=self.window)).append(elapsed_ms)
+
+    def percentile(self, stage, pct, min_samples=1):
+        """The pct percentile of the stage in ms, or None with fewer than min_samples samples."""
+        with self.lock:
+            samples = list(self.samples.get(stage, ()))
+        if len(samples) < min_samples:
+            return None
+        return percentile(samples, pct)
+
+    def snapshot(self):
+        with self.lock:
+            samples = {stage: list(values) for stage, values in self.samples.items()}
+        return {
+            stage: {
+                "samples": len(values),
+                "p50_ms": percentile(values, 50),
+                "p95_ms": percentile(values, 95),
+                "p99_ms": percentile(values, 99),
+            }
+            for stage, values in samples.items() if values
+        }
+
+
+class Hedger:
+    """
+    Sends a duplicate of a call that has not answered within the stage's
+    recent latency percentile and takes whichever answer comes first. The
+    other call cannot be cancelled once it is upstream, it finishes in the
+    background and its tokens are counted as wasted.
+    """
+
+    def __init__(self, executor, tracker, stages, pct, min_delay_ms, default_delay_ms, min_samples):
+        self.executor = executor
+        self.tracker = tracker
+        self.stages = stages
+        self.pct = pct
+        self.min_delay_ms = min_delay_ms
+        self.default_delay_ms = default_delay_ms
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.fired = {}
+        self.hedge_wins = {}
+        self.wasted_tokens = 0
+
+    def delay_ms(self, stage):
+        """How long to wait for the first call before sending the duplicate."""
+        recent = self.tracker.percentile(stage, self.pct, self.min_samples)
+        return max(self.min_delay_ms, self.default_delay_ms if recent is None else recent)
+
+    def _count(self, counter, stage):
+        with self.lock:
+            counter[stage] = counter.get(stage, 0) + 1
+
+    def _count_wasted(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        usage = getattr(future.result(), "usage", None)
+        if usage is not None:
+            with self.lock:
+                self.wasted_tokens += usage.total_tokens
+
+    def call(self, stage, attempt, may_hedge=lambda: True):
+        """Return attempt() for the stage, sending a second attempt() if the first is slow."""
+        self._count(self.calls, stage)
+        primary = self.executor.submit(attempt)
+        done, _ = wait([primary], timeout=self.delay_ms(stage) / 1000)
+        if done or not may_hedge():
+            return primary.result()
+
+        self._count(self.fired, stage)
+        hedge = self.executor.submit(attempt)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                if future is hedge:
+                    self._count(self.hedge_wins, stage)
+                for other in pending:
+                    other.add_done_callback(self._count_wasted)
+                return future.result()
+        raise error
+
+    def stats(self):
+        with self.lock:
+            return {
+                "stages": sorted(self.stages),
+                "percentile": self.pct,
+                "delay_ms": {stage: self.delay_ms(stage) for stage in sorted(self.stages)},
+                "calls": dict(self.calls),
+                "hedges_fired": dict(self.fired),
+                "hedge_wins": dict(self.hedge_wins),
+                "wasted_tokens": self.wasted_tokens,
+            }
@@ -0,0 +1,93 @@
+import random
+import zlib
+
+import numpy as np
+
+from llm.cache import normalize_query
+
+# Handler codes the classifier can predict, see llm.handler
+intent_codes = [0, 1, 2, 3]
+
+
+def hashed_features(query, dims):
+    """Map a query to sparse hashed word 1-2 gram and character 3-5 gram features.
+
+    Returns (indices, values) with the values L2 normalized. crc32 is used
+    instead of hash() so features are stable across processes.
+    """
+    text = normalize_query(query)
+    words = text.split()
+    grams = [f"w:{w}" for w in words]
+    grams += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+    padded = f" {text} "
+    for n in (3, 4, 5):
+        grams += [f"c:{padded[i:i + n]}" for i in range(len(padded) - n + 1)]
+
+    features = {}
+    for gram in grams:
+        h = zlib.crc32(gram.encode("utf-8"))
+        index = h % dims
+        # Signed hashing keeps collisions from always adding up
+        sign = 1.0 if (h >> 31) & 1 else -1.0
+        features[index] = features.get(index, 0.0) + sign
+    if not features:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    indices = np.fromiter(features.keys(), dtype=np.int64)
+    values = np.fromiter(features.values(), dtype=np.float64)
+    norm = np.linalg.norm(values)
+    if norm:
+        values /= norm
+    return indices, values
+
+
+def softmax(logits):
+    exp = np.exp(logits - logits.max())
+    return exp / exp.sum()
+
+
+class IntentClassifier:
+    """Multinomial logistic regression over hashed n-grams, small enough to run on CPU in well under a millisecond."""
+
+    def __init__(self, weights, bias, dims):
+        self.weights = weights
+        self.bias = bias
+        self.dims = dims
+
+    def predict_proba(self, query):
+        indices, values = hashed_features(query, self.dims)
+        return softmax(self.weights[:, indices] @ values + self.bias)
+
+    def predict(self, query):
+        """Return the most likely handler code and its probability."""
+        probabilities = self.predict_proba(query)
+        best = int(np.argmax(probabilities))
+        return intent_codes[best], float(probabilities[best])
+
+    @classmethod
+    def train(cls, queries, labels, dims=2 ** 18, epochs=8, learning_rate=0.5, l2=1e-6, seed=0):
+        """Fit the model with plain SGD on the sparse features."""
+        weights = np.zeros((len(intent_codes), dims))
+        bias = np.zeros(len(intent_codes))
+        samples = [
+            (hashed_features(query, dims), intent_codes.index(label))
+            for query, label in zip(queries, labels)
+        ]
+        rng = random.Random(seed)
+        for epoch in range(epochs):
+            rng.shuffle(samples)
+            rate = learning_rate / (1 + epoch)
+            for (indices, values), target in samples:
+                probabilities = softmax(weights[:, indices] @ values + bias)
+                gradient = probabilities
+                gradient[target] -= 1.0
+                weights[:, indices] -= rate * (np.outer(gradient, values) + l2 * weights[:, indices])
+                bias -= rate * gradient
+        return cls(weights, bias, dims)
+
+    def save(self, path):
+        np.savez_compressed(path, weights=self.weights, bias=self.bias, dims=self.dims)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["weights"], data["bias"], int(data["dims"]))
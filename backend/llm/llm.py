@@ -1,92 +1,309 @@
 import os
 from dotenv import load_dotenv
 from flask import jsonify
-from openai import OpenAI
 from db.db import db, Conversation, Message, SenderType
-import mysql
-from mysql.connector import Error
+from db.story_state import load_story_state, backfill_story_state, story_part_count
+from llm.context import build_story_context
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from db.pool import log_database_from_env
 import pandas as pd
 import re
-
-model = "gpt-4o-mini"
+import json
+from concurrent.futures import ThreadPoolExecutor
+from llm.timing import timed, run_in_context
+from llm.gateway import create_completion
+from llm.circuit_breaker import CircuitOpenError
+from llm.cache import cache_from_env
+from llm.intent_classifier import IntentClassifier
+from llm.singleflight import SingleFlight
+from llm.story_backends import story_backend_from_env
+from llm.speculation import Speculator
+from llm.story_cache import story_cache_from_env
+from llm.suggestions import suggestion_index_from_env
+from llm.log_queue import WriteBehindQueue
+import threading
 
 load_dotenv(dotenv_path=os.path.join(
     os.path.dirname(__file__), '..', '..', '.env'))
 
-client = OpenAI(
-    api_key=os.getenv("OPENAI_API_KEY"),
+# When enabled, the vocabulary and narrative-feature completions are sent at
+# the same time instead of one after the other.
+concurrent_enrichment = os.getenv("CONCURRENT_ENRICHMENT", "true").lower() == "true"
+# Prompt enrichment mode: "legacy" runs the vocabulary -> features -> meta
+# prompt chain, "fused" asks for all three in a single structured completion.
+prompt_enrichment_mode = os.getenv("PROMPT_ENRICHMENT_MODE", "legacy").lower()
+# Intent classifications are cached on the normalized query so repeated inputs
+# such as the valid_additions buttons skip the handler round-trip. Set
+# HANDLER_CACHE_BACKEND=sqlite to share the cache between worker processes.
+handler_cache_enabled = os.getenv("HANDLER_CACHE_ENABLED", "true").lower() == "true"
+handler_cache = cache_from_env(
+    "HANDLER_CACHE",
+    default_path=os.path.join(os.path.dirname(__file__), '..', 'handler_cache.sqlite3'),
+    default_ttl_seconds=3600,
+) if handler_cache_enabled else None
+# INTENT_CLASSIFIER=local answers the handler with the classifier trained by
+# train_intent_classifier.py whenever its confidence reaches the threshold and
+# falls back to the LLM handler otherwise.
+intent_classifier_mode = os.getenv("INTENT_CLASSIFIER", "llm").lower()
+intent_classifier_path = os.getenv(
+    "INTENT_CLASSIFIER_PATH",
+    os.path.join(os.path.dirname(__file__), '..', 'intent_classifier.npz'))
+intent_classifier_threshold = float(os.getenv("INTENT_CLASSIFIER_THRESHOLD", "0.9"))
+# Confidence the classifier still needs while the LLM circuit breaker is
+# open. Below it the request fails with a try again later reply instead of
+# letting a guess decide whether a prompt is safe.
+intent_classifier_degraded_threshold = float(os.getenv("INTENT_CLASSIFIER_DEGRADED_THRESHOLD", "0.6"))
+# Concurrent requests with an identical prompt share one run of the enrichment
+# stages instead of each sending the same completions upstream.
+single_flight_enabled = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+features_flight = SingleFlight("features_and_vocabulary")
+enrichment_flight = SingleFlight("prompt_enrichment")
+# What writes the story itself: the OpenAI API or a local CPU model (STORY_BACKEND)
+story_backend = story_backend_from_env()
+# Bounded pool shared by all requests of this process for the concurrent stages
+enrichment_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("ENRICHMENT_MAX_WORKERS", "8")),
+    thread_name_prefix="enrichment",
 )
-# Database connection details
-host = os.getenv("DB_HOST")
-user = os.getenv("DB_USER")
-password = os.getenv("DB_PASSWORD")
-database = os.getenv("DB_NAME")
-
-def connect_to_database():
-    """Create a connection to the MySQL database."""
+# VOCABULARY_SOURCE=local and FEATURES_SOURCE=local answer that enrichment
+# stage from the TinyStories occurrence tables instead of a completion. The
+# fused enrichment mode asks for both in its one completion and ignores them.
+vocabulary_source = os.getenv("VOCABULARY_SOURCE", "llm").lower()
+features_source = os.getenv("FEATURES_SOURCE", "llm").lower()
+suggestion_index = (
+    suggestion_index_from_env() if "local" in (vocabulary_source, features_source) else None)
+# STORY_CACHE_ENABLED=true hands out a stored story for prompts that are near
+# duplicates of an earlier one instead of running the whole pipeline again
+story_cache = story_cache_from_env()
+# SPECULATIVE_ENRICHMENT=true starts the prompt enrichment of a query while the
+# handler is still classifying it. The result is dropped for codes 0 and 1 and
+# otherwise adopted by the story stage, also by /confirm_new_story within the TTL.
+speculative_enrichment = os.getenv("SPECULATIVE_ENRICHMENT", "false").lower() == "true"
+speculator = Speculator(
+    ThreadPoolExecutor(
+        max_workers=int(os.getenv("SPECULATION_MAX_WORKERS", "4")),
+        thread_name_prefix="speculation",
+    ),
+    ttl_seconds=float(os.getenv("SPECULATION_TTL_SECONDS", "300")),
+) if speculative_enrichment else None
+
+# The prompt_data/meta_prompt_data inserts share one bounded connection
+# pool (LOG_DB_POOL_*) instead of opening a connection per insert
+log_database = log_database_from_env()
+
+prompt_insert_query = text("""
+    INSERT INTO prompt_data (features, vocabulary, user_prompt, model_response)
+    VALUES (:features, :vocabulary, :user_prompt, :model_response)
+""")
+meta_prompt_insert_query = text("""
+    INSERT INTO meta_prompt_data (user_meta_prompt, prompt_vocabulary, prompt_narratives, model_meta_response, model_meta_vocabulary, model_meta_narratives)
+    VALUES (:user_meta_prompt, :prompt_vocabulary, :prompt_narratives, :model_meta_response, :model_meta_vocabulary, :model_meta_narratives)
+""")
+
+
+def write_log_rows(statements):
+    """Insert the rows of each statement with executemany, all in one transaction."""
+    with log_database.begin() as connection:
+        for statement, rows in statements.items():
+            connection.execute(statement, rows)
+
+
+# The prompt_data/meta_prompt_data analytics rows are written behind the
+# request in batches (LOG_WRITE_BEHIND=true), see WriteBehindQueue
+log_queue = WriteBehindQueue(
+    "prompt_log",
+    write_log_rows,
+    max_rows=int(os.getenv("LOG_QUEUE_MAX_ROWS", "10000")),
+    batch_rows=int(os.getenv("LOG_QUEUE_BATCH_ROWS", "100")),
+    flush_seconds=float(os.getenv("LOG_QUEUE_FLUSH_SECONDS", "2")),
+    policy=os.getenv("LOG_QUEUE_POLICY", "drop").lower(),
+    block_seconds=float(os.getenv("LOG_QUEUE_BLOCK_SECONDS", "0.1")),
+) if os.getenv("LOG_WRITE_BEHIND", "true").lower() == "true" else None
+
+
+def log_row(statement, row):
+    if log_queue is not None:
+        log_queue.put(statement, row)
+        return
     try:
-        connection = mysql.connector.connect(
-            host=host,
-            user=user,
-            password=password,
-            database=database
-        )
-        if connection.is_connected():
-            print("Connected to the database")
-            return connection
-    except Error as e:
-        print(f"Error while connecting to MySQL: {e}")
-        return None
+        write_log_rows({statement: [row]})
+    except SQLAlchemyError as e:
+        print(f"Error while inserting data: {e}")
+
+
+def log_queue_stats():
+    stats = log_queue.stats() if log_queue is not None else {"enabled": False}
+    stats["pool"] = log_database.stats()
+    return stats
+
 
 def add_to_prompt_table(features, vocabulary, user_prompt, model_response):
     """Add a new prompt and its features to the MySQL database."""
-    connection = connect_to_database()
-    if connection:
-        print("Adding new prompt to the database...")
-        try:
-            cursor = connection.cursor()
-            # Insert the new prompt into the prompts table
-            insert_query = """
-                INSERT INTO prompt_data (features, vocabulary, user_prompt, model_response)
-                VALUES (%s, %s, %s, %s)
-            """
-            cursor.execute(insert_query, (features, vocabulary, user_prompt, model_response))
-            connection.commit()
-            print("New prompt added successfully")
-        except Error as e:
-            print(f"Error while inserting data: {e}")
-        finally:
-            cursor.close()
-            connection.close()
-    else:
-        print("Failed to connect to the database. Prompt not added.")
+    log_row(prompt_insert_query, {
+        "features": features,
+        "vocabulary": vocabulary,
+        "user_prompt": user_prompt,
+        "model_response": model_response,
+    })
 
 def add_to_meta_prompt_table(user_meta_prompt, prompt_vocabulary, prompt_narratives, model_meta_response, model_meta_vocabulary, model_meta_narratives):
     """Add a new meta prompt and its response to the MySQL database."""
-    connection = connect_to_database()
-    if connection:
-        try:
-            cursor = connection.cursor()
-            # Insert the new meta prompt into the meta_prompts table
-            insert_query = """
-                INSERT INTO meta_prompt_data (user_meta_prompt, prompt_vocabulary, prompt_narratives, model_meta_response, model_meta_vocabulary, model_meta_narratives)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """
-            cursor.execute(insert_query, (user_meta_prompt, prompt_vocabulary, prompt_narratives, model_meta_response, model_meta_vocabulary, model_meta_narratives))
-            connection.commit()
-            print("New meta prompt added successfully")
-        except Error as e:
-            print(f"Error while inserting data: {e}")
-        finally:
-            cursor.close()
-            connection.close()
+    log_row(meta_prompt_insert_query, {
+        "user_meta_prompt": user_meta_prompt,
+        "prompt_vocabulary": prompt_vocabulary,
+        "prompt_narratives": prompt_narratives,
+        "model_meta_response": model_meta_response,
+        "model_meta_vocabulary": model_meta_vocabulary,
+        "model_meta_narratives": model_meta_narratives,
+    })
 
 # This subprompt is used to handle the language of the user's input.
 language_handling_subprompt = "Important: Respond to the user's input in the language they are using. Interpret their request in their language to make decisions to your instructions."
 valid_additions = ['What happens next?','Different Ending', 'Make it funny', 'Add a twist']
+class LocalIntentRouter:
+    """Answers the handler locally when the distilled classifier is confident enough."""
+
+    def __init__(self, path, threshold):
+        self.path = path
+        self.threshold = threshold
+        self.classifier = None
+        self.load_failed = False
+        self.local_answers = 0
+        self.fallbacks = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.classifier is None and not self.load_failed:
+                try:
+                    self.classifier = IntentClassifier.load(self.path)
+                    print(f"Loaded local intent classifier from {self.path}")
+                except (OSError, KeyError, ValueError) as e:
+                    # Keep serving through the LLM handler instead
+                    print(f"Error loading local intent classifier: {e}")
+                    self.load_failed = True
+            return self.classifier
+
+    def classify(self, query):
+        """Return the handler code as a string, or None when the LLM should decide."""
+        classifier = self.load()
+        if classifier is None:
+            return None
+        with timed("local_classifier"):
+            code, confidence = classifier.predict(query)
+        with self.lock:
+            if confidence >= self.threshold:
+                self.local_answers += 1
+                return str(code)
+            self.fallbacks += 1
+        return None
+
+    def stats(self):
+        with self.lock:
+            answered = self.local_answers + self.fallbacks
+            return {
+                "loaded": self.classifier is not None,
+                "threshold": self.threshold,
+                "local_answers": self.local_answers,
+                "fallbacks": self.fallbacks,
+                "local_rate": self.local_answers / answered if answered else 0.0,
+            }
+
+local_intent_router = LocalIntentRouter(
+    intent_classifier_path, intent_classifier_threshold
+) if intent_classifier_mode == "local" else None
+
+# Answers the handler while the LLM circuit breaker is open
+degraded_intent_router = LocalIntentRouter(intent_classifier_path, intent_classifier_degraded_threshold)
+
+# Answers given by a local fallback because the LLM circuit breaker was open
+degraded_answers = {}
+degraded_lock = threading.Lock()
+
+def count_degraded(stage):
+    print(f"LLM circuit open, answering {stage} locally")
+    with degraded_lock:
+        degraded_answers[stage] = degraded_answers.get(stage, 0) + 1
+
+def degraded_stats():
+    with degraded_lock:
+        return dict(degraded_answers)
+
+def intent_classifier_stats():
+    stats = local_intent_router.stats() if local_intent_router is not None else {"enabled": False}
+    return {**stats, "degraded": degraded_intent_router.stats()}
+
 def handler(query):
-    chat_completion = client.chat.completions.create(
-        messages=[
+    """Classify the query into a handler code."""
+    return classify(query)[0]
+
+def classify(query):
+    """Classify the query into (handler code, source of the code).
+
+    Cached classifications are reused first ("cache"), then the local
+    classifier is tried when enabled ("local") before falling back to the LLM
+    handler ("llm"). While the LLM circuit breaker is open the local
+    classifier answers when it reaches the degraded threshold ("degraded"),
+    otherwise CircuitOpenError is raised.
+    """
+    if handler_cache is not None:
+        code = handler_cache.get(query)
+        if code is not None:
+            return code, "cache"
+    if local_intent_router is not None:
+        code = local_intent_router.classify(query)
+        if code is not None:
+            return code, "local"
+    try:
+        code = llm_handler(query)
+    except CircuitOpenError:
+        code = degraded_intent_router.classify(query)
+        if code is None:
+            raise
+        count_degraded("handler")
+        return code, "degraded"
+    # Only cache answers the routes can use, anything else is retried next time
+    if handler_cache is not None and code.strip() in ("0", "1", "2", "3"):
+        handler_cache.set(query, code.strip())
+    return code, "llm"
+
+def handler_cache_stats():
+    return handler_cache.stats() if handler_cache is not None else {"enabled": False}
+
+def classify_with_speculation(query, conversation_id=None):
+    """Run classify(query) while speculatively enriching the query for the story stage.
+
+    With a conversation the speculation prepares a continuation, otherwise a
+    new story. Codes that lead to no story work discard it. Returns the code
+    and its source, like classify.
+    """
+    if speculator is None:
+        return classify(query)
+    if conversation_id:
+        key = continuation_key(conversation_id, query)
+        speculator.start(key, speculate_continuation, conversation_id, query,
+                         attribution={"conversation_id": conversation_id})
+    else:
+        key = ("prompt_enrichment", query)
+        speculator.start(key, coalesced_prompt_enrichment, query)
+    code, source = classify(query)
+    try:
+        parsed_code = int(code)
+    except ValueError:
+        parsed_code = None
+    # Code 3 without a conversation has no story to continue
+    if parsed_code not in (2, 3) or (parsed_code == 3 and not conversation_id):
+        speculator.discard(key)
+    return code, source
+
+def speculation_stats():
+    return speculator.stats() if speculator is not None else {"enabled": False}
+
+def llm_handler(query):
+    chat_completion = create_completion(
+        "handler",
+        [
             {
                 "role": "system",
                 "content": (
@@ -105,7 +322,6 @@ def handler(query):
                 "content": query,
             }
         ],
-        model=model,
     )
     return chat_completion.choices[0].message.content
 feature_vocabulary_subprompt = (
@@ -113,54 +329,119 @@ feature_vocabulary_subprompt = (
     "The narrative features provide guidance on the plot and structure of the story, "
     "while the vocabulary words are specific terms that should ALWAYS be included in the story. "
 )
+def vocabulary_generator(query):
+    """Extract interesting vocabulary words that pair well with the query.
+
+    The local suggestions answer instead with VOCABULARY_SOURCE=local and
+    while the LLM circuit breaker is open.
+    """
+    if vocabulary_source == "local":
+        return local_vocabulary(query)
+    try:
+        vocabulary_completion = create_completion(
+            "vocabulary",
+            [
+                {
+                    "role": "system",
+                    "content": (
+                        f"{language_handling_subprompt}"
+                        "You are a vocabulary expert for a storytelling AI."
+                        "You should create a list of some existing or novel (around 3-5) vocabulary words that pair well with the story query."
+                        "Return the vocabulary as a comma-separated list of words."
+                        "Aim to include words that are unique, descriptive, and engaging for children."
+                        "Do not include common words or phrases, and only return the vocabulary words without any additional text."
+                    ),
+                },
+                {
+                    "role": "user",
+                    "content": query,
+                }
+            ],
+        )
+    except CircuitOpenError:
+        count_degraded("vocabulary")
+        return local_vocabulary(query)
+    return vocabulary_completion.choices[0].message.content
+
+
+def local_suggestions():
+    """The suggestion index, loaded on first use when it only backs the degraded path."""
+    global suggestion_index
+    if suggestion_index is None:
+        suggestion_index = suggestion_index_from_env()
+    return suggestion_index
+
+
+def local_vocabulary(query):
+    with timed("vocabulary"):
+        return ", ".join(local_suggestions().vocabulary(query))
+
+
+def local_features(query):
+    with timed("features"):
+        return ", ".join(local_suggestions().narrative_features(query))
+
+
+example_narrative_features = ['dialogue', 'twist', 'moralvalue', 'foreshadowing', 'goodending', 'badending', 'characterdevelopment']
+def features_generator(query):
+    """Generate narrative features that pair well with the query.
+
+    The local suggestions answer instead with FEATURES_SOURCE=local and
+    while the LLM circuit breaker is open.
+    """
+    if features_source == "local":
+        return local_features(query)
+    try:
+        features_completion = create_completion(
+            "features",
+            [
+                {
+                    "role": "system",
+                    "content": (
+                        f"{language_handling_subprompt}"
+                        "You are a narrative features expert for a storytelling AI."
+                        "You should create a list of some existing or novel (around 3-5) narrative features that pair well with the story query."
+                        f"Example narrative features include: {', '.join(example_narrative_features)}."
+                        "Return the features as a comma-separated list of words."
+                        "Aim to include storytelling or literature narratives that are unique, descriptive, and engaging for children."
+                        "Do not include common words or phrases, and only return the narrative features without any additional text."
+                    ),
+                },
+                {
+                    "role": "user",
+                    "content": query,
+                }
+            ],
+        )
+    except CircuitOpenError:
+        count_degraded("features")
+        return local_features(query)
+    return features_completion.choices[0].message.content
+
+
 def features_and_vocabulary(query):
-    # chat completion to extract interesting vocabulary from the query
-    vocabulary_completion = client.chat.completions.create(
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    f"{language_handling_subprompt}"
-                    "You are a vocabulary expert for a storytelling AI."
-                    "You should create a list of some existing or novel (around 3-5) vocabulary words that pair well with the story query."
-                    "Return the vocabulary as a comma-separated list of words."
-                    "Aim to include words that are unique, descriptive, and engaging for children."
-                    "Do not include common words or phrases, and only return the vocabulary words without any additional text."
-                ),
-            },
-            {
-                "role": "user",
-                "content": query,
-            }
-        ],
-        model=model,
-    )
-    # chat completion to generate narrative features from the query
-    example_narrative_features = ['dialogue', 'twist', 'moralvalue', 'foreshadowing', 'goodending', 'badending', 'characterdevelopment']
-    features_completion = client.chat.completions.create(
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    f"{language_handling_subprompt}"
-                    "You are a narrative features expert for a storytelling AI."
-                    "You should create a list of some existing or novel (around 3-5) narrative features that pair well with the story query."
-                    f"Example narrative features include: {', '.join(example_narrative_features)}."
-                    "Return the features as a comma-separated list of words."
-                    "Aim to include storytelling or literature narratives that are unique, descriptive, and engaging for children."
-                    "Do not include common words or phrases, and only return the narrative features without any additional text."
-                ),
-            },
-            {
-                "role": "user",
-                "content": query,
-            }
-        ],
-        model=model,
-    )
+    """Fetch vocabulary and narrative features for the query, coalescing identical in-flight queries."""
+    if single_flight_enabled:
+        return features_flight.do(query, fetch_features_and_vocabulary, query)
+    return fetch_features_and_vocabulary(query)
 
-    vocabulary_response = vocabulary_completion.choices[0].message.content
-    features_response = features_completion.choices[0].message.content
+
+def fetch_features_and_vocabulary(query):
+    """Fetch vocabulary and narrative features for the query.
+
+    The two completions are independent, so in concurrent mode both are sent
+    at once and the slower of the two sets the latency of this stage. A local
+    source answers in microseconds and is not worth a thread.
+    """
+    with timed("features_and_vocabulary"):
+        if concurrent_enrichment and vocabulary_source != "local" and features_source != "local":
+            vocabulary_future = run_in_context(enrichment_executor, vocabulary_generator, query)
+            features_future = run_in_context(enrichment_executor, features_generator, query)
+            vocabulary_response = vocabulary_future.result()
+            features_response = features_future.result()
+        else:
+            vocabulary_response = vocabulary_generator(query)
+            features_response = features_generator(query)
     return vocabulary_response, features_response
 
 
@@ -204,13 +485,14 @@ meta_prompt_gen_user_prompt = '''<|im_start|>user
                     <|im_start|>assistant
                     Prompt:'''
 
-def meta_prompt_generator(user_prompt):
-    """Generate a meta prompt based on the user's input."""
+def legacy_prompt_enrichment(user_prompt):
+    """Enrich the user's prompt with separate vocabulary, features and meta prompt completions."""
     # Fetch vocabulary and narrative and formatted prompt from the query
     vocabulary, features, formatted_prompt = story_prompt_generator(user_prompt)
     # chat completion to generate a meta prompt
-    chat_completion = client.chat.completions.create(
-        messages=[
+    chat_completion = create_completion(
+        "meta_prompt",
+        [
             {
                 "role": "system",
                 "content": meta_prompt_system_prompt,
@@ -223,7 +505,6 @@ def meta_prompt_generator(user_prompt):
                 ),
             }
         ],
-        model=model,
     )
 
     response = chat_completion.choices[0].message.content
@@ -264,18 +545,133 @@ def meta_prompt_generator(user_prompt):
             updated_vocabulary = ""
         if not features:
             updated_features = ""
-    print('updated story request:', updated_prompt)
-    # logging the words, features, query, and response to the db's meta_prompt_data table
 
-    add_to_meta_prompt_table(
-        user_meta_prompt=formatted_prompt,
-        prompt_vocabulary=vocabulary,
-        prompt_narratives=features,
-        model_meta_response=updated_prompt,
-        model_meta_vocabulary=updated_vocabulary,
-        model_meta_narratives=updated_features
+    return {
+        "user_meta_prompt": formatted_prompt,
+        "prompt_vocabulary": vocabulary,
+        "prompt_narratives": features,
+        "model_meta_response": updated_prompt,
+        "model_meta_vocabulary": updated_vocabulary,
+        "model_meta_narratives": updated_features,
+    }
+
+fused_enrichment_system_prompt = (
+                    f"{language_handling_subprompt}"
+                    "You are a vocabulary, narrative features and prompt evaluation expert for a storytelling AI."
+                    "For the user's story query you should:\n"
+                    "1. Create a list of some existing or novel (around 3-5) vocabulary words that pair well with the story query. "
+                    "Aim to include words that are unique, descriptive, and engaging for children, and do not include common words or phrases.\n"
+                    f"2. Create a list of some existing or novel (around 3-5) narrative features that pair well with the story query, for example: {', '.join(example_narrative_features)}.\n"
+                    "3. Edit the user's query into an improved story request that is clear, concise, and engaging and that uses the vocabulary and narrative features. "
+                    "The goal is to improve the prompt, not to provide a story."
+                    f"{feature_vocabulary_subprompt}"
+)
+
+# JSON schema for the single structured completion of the fused enrichment mode
+fused_enrichment_schema = {
+    "name": "prompt_enrichment",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "vocabulary": {"type": "array", "items": {"type": "string"}},
+            "narrative_features": {"type": "array", "items": {"type": "string"}},
+            "story_request": {"type": "string"},
+        },
+        "required": ["vocabulary", "narrative_features", "story_request"],
+        "additionalProperties": False,
+    },
+}
+
+def fused_prompt_enrichment(user_prompt):
+    """Enrich the user's prompt with vocabulary, features and a story request in one completion.
+
+    The result has the same shape as legacy_prompt_enrichment so the meta
+    prompt logging and the story stage do not need to know which mode ran.
+    Falls back to the legacy chain when the structured response can't be used.
+    """
+    chat_completion = create_completion(
+        "fused_enrichment",
+        [
+            {
+                "role": "system",
+                "content": fused_enrichment_system_prompt,
+            },
+            {
+                "role": "user",
+                "content": user_prompt,
+            }
+        ],
+        response_format={"type": "json_schema", "json_schema": fused_enrichment_schema},
+    )
+    try:
+        enrichment = json.loads(chat_completion.choices[0].message.content)
+        vocabulary = ", ".join(word.strip() for word in enrichment["vocabulary"] if word.strip())
+        features = ", ".join(feature.strip() for feature in enrichment["narrative_features"] if feature.strip())
+        story_request = enrichment["story_request"].strip()
+    except (TypeError, KeyError, AttributeError, json.JSONDecodeError) as e:
+        print(f"Invalid fused enrichment response, falling back to the legacy chain: {e}")
+        return legacy_prompt_enrichment(user_prompt)
+    if not story_request:
+        return legacy_prompt_enrichment(user_prompt)
+
+    formatted_prompt = (
+        f"{feature_vocabulary_subprompt}"
+        f"Relevant vocabulary: {vocabulary}\n"
+        f"Relevant narrative features: {features}\n"
+        f"User prompt: {user_prompt}\n"
+    )
+    # Same layout the meta prompt completion returns in the legacy chain
+    updated_prompt = (
+        f"\nStory Request: {story_request}\n\n"
+        f"Vocabulary: {vocabulary}\n\n"
+        f"Narratives: {features}"
     )
-    return updated_prompt, updated_features, updated_vocabulary
+    return {
+        "user_meta_prompt": formatted_prompt,
+        "prompt_vocabulary": vocabulary,
+        "prompt_narratives": features,
+        "model_meta_response": updated_prompt,
+        "model_meta_vocabulary": vocabulary,
+        "model_meta_narratives": features,
+    }
+
+def prompt_enrichment(user_prompt):
+    """Enrich the user's prompt, reusing a speculative run or an identical in-flight one."""
+    if speculator is not None:
+        enrichment = speculator.adopt(("prompt_enrichment", user_prompt))
+        if enrichment is not None:
+            return enrichment
+    return coalesced_prompt_enrichment(user_prompt)
+
+
+def coalesced_prompt_enrichment(user_prompt):
+    """Enrich the user's prompt, coalescing identical in-flight prompts."""
+    if single_flight_enabled:
+        return enrichment_flight.do((prompt_enrichment_mode, user_prompt), run_prompt_enrichment, user_prompt)
+    return run_prompt_enrichment(user_prompt)
+
+
+def run_prompt_enrichment(user_prompt):
+    """Enrich the user's prompt using the mode configured for this deployment."""
+    if prompt_enrichment_mode == "fused":
+        return fused_prompt_enrichment(user_prompt)
+    return legacy_prompt_enrichment(user_prompt)
+
+def single_flight_stats():
+    return {
+        "enabled": single_flight_enabled,
+        "features_and_vocabulary": features_flight.stats(),
+        "prompt_enrichment": enrichment_flight.stats(),
+    }
+
+def meta_prompt_generator(user_prompt):
+    """Generate a meta prompt based on the user's input."""
+    enrichment = prompt_enrichment(user_prompt)
+    print('updated story request:', enrichment["model_meta_response"])
+    # logging the words, features, query, and response to the db's meta_prompt_data table
+    add_to_meta_prompt_table(**enrichment)
+    return enrichment["model_meta_response"], enrichment["model_meta_narratives"], enrichment["model_meta_vocabulary"]
 
 story_gen_system_prompt = (
                     f"{language_handling_subprompt}"
@@ -291,25 +687,62 @@ story_gen_system_prompt = (
                     "Limit the story to 100 words."
                 )
 
-def new_story_generator(query):
-    """Generate a new story based on the user's query."""
+def parse_story_response(response):
+    """Split a "TITLE: ... STORY: ..." completion into its title and story.
+
+    Returns None when either part is missing so callers can fall back to the
+    raw response.
+    """
+    # Split by the STORY: marker
+    parts = response.split(f"STORY:", 1)
+
+    # Extract title from the first part
+    title_part = parts[0].strip()
+    title = title_part.replace("TITLE:", "").strip()
+
+    # Extract story from the second part (if it exists)
+    story = parts[1].strip() if len(parts) > 1 else response
+    if not title or not story:
+        return None
+    return title, story
+
+
+def new_story_messages(query):
+    """Build the story completion messages for a new story, running the prompt enrichment stages."""
     # Fetch vocabulary and narrative features from the query
     formatted_prompt, features, vocabulary = meta_prompt_generator(query)
-    chat_completion = client.chat.completions.create(
-        messages=[
-            {
-                "role": "system",
-                "content": story_gen_system_prompt,
-            },
-            {
-                "role": "user",
-                "content": formatted_prompt,
-            }
-        ],
-        model=model,
-    )
+    messages = [
+        {
+            "role": "system",
+            "content": story_gen_system_prompt,
+        },
+        {
+            "role": "user",
+            "content": formatted_prompt,
+        }
+    ]
+    return messages, features, vocabulary
 
-    response = chat_completion.choices[0].message.content
+
+def cached_story(query):
+    """A story written for a near-duplicate of the query, or None."""
+    if story_cache is None:
+        return None
+    with timed("story_cache"):
+        return story_cache.get(query)
+
+
+def new_story_generator(query, use_cache=True):
+    """Generate a new story based on the user's query.
+
+    use_cache=False skips the near-duplicate story cache, e.g. for the story
+    pool which wants fresh stories.
+    """
+    cached = cached_story(query) if use_cache else None
+    if cached is not None:
+        return cached
+    messages, features, vocabulary = new_story_messages(query)
+    response = story_backend.generate("story", messages)
     # logging the words, features, query, and response to the db's prompt_data table
     add_to_prompt_table(
         features=features,
@@ -320,24 +753,15 @@ def new_story_generator(query):
 
     # Parse the response to extract title and story
     try:
-        # Split by the STORY: marker
-        parts = response.split(f"STORY:", 1)
-
-
-        # Extract title from the first part
-        title_part = parts[0].strip()
-        title = title_part.replace("TITLE:", "").strip()
-        
-        # Extract story from the second part (if it exists)
-        story = parts[1].strip() if len(parts) > 1 else response
+        parsed = parse_story_response(response)
         # If we couldn't parse properly, just return the original response
-        if not title or not story:
+        if parsed is None:
             return response
-
-        # Store the title in a global variable or database for later use
-        # For now, we'll just return the story, but we'll modify app.py to handle the title
-
-        return {"title": title, "story": story}
+        title, story = parsed
+        story_data = {"title": title, "story": story}
+        if use_cache and story_cache is not None:
+            story_cache.set(query, story_data)
+        return story_data
     except:
         # If parsing fails, return the original response
         return {"title": "New Story", "story": response}
@@ -360,49 +784,78 @@ def update_conversation_history(conversation_id, extended_story):
     db.session.commit()
 
 
-def add_to_story(conversation_id, query):
-    # Fetch the existing conversation history from the database using conversation_id
-    conversation_history = fetch_conversation_history(conversation_id)
-    ### print the conversation history and length
-    # Extract the story and combine all messages into a single story string
-    existing_story = ""
-    existing_title = "Continued Story"
-    story_chunks = []
-    part_number = 0
-    for message in reversed(conversation_history):
-        if message.sender_type == SenderType.MODEL and message.code in [2, 3]:
-            # Check if the content has a title format
-            if "TITLE:" in message.content and "STORY," in message.content:
-                
-                parts = re.split(r"STORY, PART #\d+:", message.content, maxsplit=1)
-                title_part = parts[0].strip()
-                existing_title = title_part.replace("TITLE:", "").strip()
-                story_part = parts[1].strip()
-                # Append the story part to the list
-                story_chunks.append(story_part)
-                # Increment the part number
-                part_number += 1
-            else:
-                existing_story = message.content
-                part_number += 1
-
-    # Combine the story chunks into a single string
-    if story_chunks:
-        existing_story = "\n".join(reversed(story_chunks))
+def load_existing_story(conversation_id):
+    """Load the title, the story context for the next part and the number of parts of a conversation."""
+    story_state = load_story_state(conversation_id)
+    if story_state is None:
+        # Conversations logged before the story state existed are migrated on first use
+        if backfill_story_state(conversation_id):
+            story_state = load_story_state(conversation_id)
+    if story_state is None:
+        return "Continued Story", "", 0
+    existing_title, story_parts, part_number = story_state
+    # Older parts are folded into a rolling summary so the prompts stay bounded
+    existing_story = build_story_context(conversation_id, existing_title, story_parts, summarize_story_parts)
+    return existing_title, existing_story, part_number
 
-    if not existing_story:
-        return jsonify({"message": "No existing story found in the conversation history."})
-    # format the existing story and the current query for extendiing with new vocabulary and features
-    contextual_query = f"Existing Title: {existing_title}\nExisting Story: {existing_story}\nStory Request: {query}"
-    # Fetch vocabulary and narrative features from the query
-    feature_vocabulary_prompt, features, vocabulary = meta_prompt_generator(contextual_query)
-    print('### Continued Story Contextual Query:', contextual_query)
-    # Generate the extended story by appending the new query
-    chat_completion = client.chat.completions.create(
-        messages=[
+
+def load_story_for_continuation(conversation_id, query):
+    """load_existing_story, reusing the story loaded by a speculative continuation."""
+    if speculator is not None:
+        existing = speculator.adopt(continuation_key(conversation_id, query))
+        if existing is not None:
+            return existing
+    return load_existing_story(conversation_id)
+
+
+def continuation_key(conversation_id, query):
+    """
+    Speculation key of a continuation. It includes the number of story parts,
+    so once another part is logged, e.g. by a story job, a speculation that
+    was started earlier and never used is not adopted.
+    """
+    return ("continuation", conversation_id, story_part_count(conversation_id), query)
+
+
+def speculate_continuation(conversation_id, query):
+    """Load the story and enrich the continuation request ahead of the handler's answer."""
+    existing = load_existing_story(conversation_id)
+    existing_title, existing_story, _ = existing
+    if existing_story:
+        contextual_query = continuation_query(existing_title, existing_story, query)
+        speculator.stash(("prompt_enrichment", contextual_query), coalesced_prompt_enrichment(contextual_query))
+    return existing
+
+
+def summarize_story_parts(previous_summary, title, new_parts, max_tokens):
+    """Fold story parts that no longer fit the context into the rolling summary."""
+    chat_completion = create_completion(
+        "story_summary",
+        [
             {
                 "role": "system",
                 "content": (
+                    f"{language_handling_subprompt}"
+                    "You summarize children's stories for a storytelling AI."
+                    "Combine the existing summary and the new story parts into a single summary of the story so far."
+                    "Keep the characters, places, and open plot threads that are needed to continue the story."
+                    f"Use at most {int(max_tokens * 0.75)} words and only return the summary."
+                ),
+            },
+            {
+                "role": "user",
+                "content": (
+                    f"Title: {title}\n"
+                    f"Existing summary: {previous_summary or 'None'}\n"
+                    "New story parts:\n" + "\n".join(new_parts)
+                ),
+            }
+        ],
+    )
+    return chat_completion.choices[0].message.content.strip()
+
+
+continuation_system_prompt = (
                     f"{language_handling_subprompt}"
                     "You are the writer for a storytelling AI that can generate children's stories based on a given prompt."
                     "You should take the existing story and the new user input to generate an extended story."
@@ -412,18 +865,39 @@ def add_to_story(conversation_id, query):
                     "STORY: [The extended story content]\n\n"
                     "Limit the extended part of the story to 100 words."
                     "This should be a NEW addition to the story, and it should be consistent with the existing story. Avoid reiterating previously mentioned details."
-                    
-                ),
-            },
-            {
-                "role": "user",
-                "content": f"Existing Title: {existing_title}\nExisting Story: {existing_story}\nStory Request: {feature_vocabulary_prompt}",
-            }
-        ],
-        model=model,
-    )
+)
 
-    response = chat_completion.choices[0].message.content
+
+def continuation_query(existing_title, existing_story, query):
+    # format the existing story and the current query for extendiing with new vocabulary and features
+    return f"Existing Title: {existing_title}\nExisting Story: {existing_story}\nStory Request: {query}"
+
+def continuation_messages(existing_title, existing_story, query):
+    """Build the story completion messages for a continuation, running the prompt enrichment stages."""
+    contextual_query = continuation_query(existing_title, existing_story, query)
+    # Fetch vocabulary and narrative features from the query
+    feature_vocabulary_prompt, features, vocabulary = meta_prompt_generator(contextual_query)
+    print('### Continued Story Contextual Query:', contextual_query)
+    messages = [
+        {
+            "role": "system",
+            "content": continuation_system_prompt,
+        },
+        {
+            "role": "user",
+            "content": f"Existing Title: {existing_title}\nExisting Story: {existing_story}\nStory Request: {feature_vocabulary_prompt}",
+        }
+    ]
+    return messages, features, vocabulary
+
+
+def add_to_story(conversation_id, query):
+    existing_title, existing_story, part_number = load_story_for_continuation(conversation_id, query)
+    if not existing_story:
+        return jsonify({"message": "No existing story found in the conversation history."})
+    # Generate the extended story by appending the new query
+    messages, features, vocabulary = continuation_messages(existing_title, existing_story, query)
+    response = story_backend.generate("story", messages)
 
     # logging the words, features, query, and response to the db's prompt_data table
     add_to_prompt_table(
@@ -435,22 +909,162 @@ def add_to_story(conversation_id, query):
 
     # Parse the response to extract title and story
     try:
-        # Split by the STORY: marker
-        parts = response.split(f"STORY:", 1)
-
-        # Extract title from the first part
-        title_part = parts[0].strip()
-        title = title_part.replace("TITLE:", "").strip()
-
-        # Extract story from the second part (if it exists)
-        story = parts[1].strip() if len(parts) > 1 else response
-
+        parsed = parse_story_response(response)
         # If we couldn't parse properly, just return the original response
-        if not title or not story:
+        if parsed is None:
             return response
-
+        title, story = parsed
         # Return both title and story
         return {"title": title, "story": story, "part": part_number+1}
     except:
         # If parsing fails, return the original response
         return {"title": existing_title, "story": response}
+
+
+def suggestion_stats():
+    return {
+        "vocabulary_source": vocabulary_source,
+        "features_source": features_source,
+        **(suggestion_index.stats() if suggestion_index is not None else {}),
+    }
+
+
+def story_backend_stats():
+    return story_backend.stats()
+
+
+def story_cache_stats():
+    return story_cache.stats() if story_cache is not None else {"enabled": False}
+
+
+class StoryStreamParser:
+    """Incrementally split a streamed "TITLE: ... STORY: ..." completion into events.
+
+    feed() takes the text deltas as they arrive and returns ("title", text)
+    once the TITLE line is complete, then ("story", text) chunks for the
+    story content. finish() flushes whatever is still buffered.
+    """
+
+    def __init__(self, default_title):
+        self.default_title = default_title
+        self.state = "title"
+        self.buffer = ""
+        self.response = ""
+        self.title = None
+
+    def feed(self, delta):
+        self.response += delta
+        self.buffer += delta
+        events = []
+        if self.state == "title":
+            stripped = self.buffer.lstrip()
+            if len(stripped) >= len("TITLE:") and not stripped.startswith("TITLE:"):
+                # The model skipped the title, everything is story
+                self.title = self.default_title
+                events.append(("title", self.title))
+                self.buffer = stripped
+                self.state = "story"
+            elif stripped.startswith("TITLE:"):
+                title = stripped[len("TITLE:"):].lstrip()
+                line_ends = [i for i in (title.find("\n"), title.find("STORY:")) if i >= 0]
+                if line_ends and title[:min(line_ends)].strip():
+                    self.title = title[:min(line_ends)].strip()
+                    events.append(("title", self.title))
+                    self.buffer = title[min(line_ends):]
+                    self.state = "marker"
+        if self.state == "marker":
+            stripped = self.buffer.lstrip()
+            if stripped.startswith("STORY:"):
+                self.buffer = stripped[len("STORY:"):].lstrip()
+                self.state = "story" if self.buffer else "marker_done"
+            elif stripped and not "STORY:".startswith(stripped[:len("STORY:")]):
+                # Story text without the STORY: marker
+                self.buffer = stripped
+                self.state = "story"
+        if self.state == "marker_done":
+            # Drop the whitespace between the marker and the first word
+            self.buffer = self.buffer.lstrip()
+            if self.buffer:
+                self.state = "story"
+        if self.state == "story" and self.buffer:
+            events.append(("story", self.buffer))
+            self.buffer = ""
+        return events
+
+    def finish(self):
+        events = []
+        if self.title is None:
+            parsed = parse_story_response(self.response)
+            self.title = parsed[0] if parsed else self.default_title
+            events.append(("title", self.title))
+            story = parsed[1] if parsed else self.response.strip()
+            if story:
+                events.append(("story", story))
+        elif self.buffer.strip():
+            events.append(("story", self.buffer.strip()))
+        self.buffer = ""
+        return events
+
+
+def stream_story(messages, default_title):
+    """Stream the story completion as ("title", ...) and ("story", ...) events.
+
+    Ends with a ("complete", {...}) event carrying the title, the full story
+    and the raw response once the completion is finished.
+    """
+    parser = StoryStreamParser(default_title)
+    story_chunks = []
+    for delta in story_backend.stream("story", messages):
+        for event in parser.feed(delta):
+            if event[0] == "story":
+                story_chunks.append(event[1])
+            yield event
+    for event in parser.finish():
+        if event[0] == "story":
+            story_chunks.append(event[1])
+        yield event
+    yield ("complete", {"title": parser.title, "story": "".join(story_chunks).strip(), "response": parser.response})
+
+
+def stream_new_story(query):
+    """Streaming variant of new_story_generator."""
+    cached = cached_story(query)
+    if cached is not None:
+        yield ("title", cached["title"])
+        yield ("story", cached["story"])
+        yield ("complete", {"title": cached["title"], "story": cached["story"],
+                            "response": f"TITLE: {cached['title']}\n\nSTORY: {cached['story']}", "part": 1})
+        return
+    messages, features, vocabulary = new_story_messages(query)
+    for event in stream_story(messages, "New Story"):
+        if event[0] == "complete":
+            # logging the words, features, query, and response to the db's prompt_data table
+            add_to_prompt_table(
+                features=features,
+                vocabulary=vocabulary,
+                user_prompt=query,
+                model_response=event[1]["response"]
+            )
+            event[1]["part"] = 1
+            if story_cache is not None and event[1]["story"]:
+                story_cache.set(query, {"title": event[1]["title"], "story": event[1]["story"]})
+        yield event
+
+
+def stream_add_to_story(conversation_id, query):
+    """Streaming variant of add_to_story."""
+    existing_title, existing_story, part_number = load_story_for_continuation(conversation_id, query)
+    if not existing_story:
+        yield ("error", "No existing story found in the conversation history.")
+        return
+    messages, features, vocabulary = continuation_messages(existing_title, existing_story, query)
+    for event in stream_story(messages, existing_title):
+        if event[0] == "complete":
+            add_to_prompt_table(
+                features=features,
+                vocabulary=vocabulary,
+                user_prompt=query,
+                model_response=event[1]["response"]
+            )
+            event[1]["part"] = part_number + 1
+        yield event
@@ -0,0 +1,131 @@
+import atexit
+import queue
+import threading
+import time
+
+_stop = object()
+
+
+class WriteBehindQueue:
+    """
+    Rows for INSERT statements, buffered in memory and written by a
+    background thread. A batch is written once batch_rows rows are waiting
+    or flush_seconds after its first row, with one executemany per statement
+    in a single transaction. At most max_rows rows are buffered; when the
+    buffer is full, the "drop" policy discards the new row and the "block"
+    policy makes the caller wait up to block_seconds for room before
+    discarding it. Whatever is buffered is written when the process exits.
+
+    The rows are analytics, so a batch that fails to write is counted and
+    discarded rather than retried.
+    """
+
+    def __init__(self, name, write_batch, max_rows, batch_rows, flush_seconds, policy="drop", block_seconds=0.1):
+        if policy not in ("drop", "block"):
+            raise ValueError(f"Unknown write-behind policy: {policy}")
+        self.name = name
+        self.write_batch = write_batch
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+        self.policy = policy
+        self.block_seconds = block_seconds
+        self.rows = queue.Queue(maxsize=max_rows)
+        self.lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.total_write_ms = 0.0
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name=f"{name}-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, statement, row):
+        """Buffer a row for the statement, returning False when it was dropped."""
+        try:
+            if self.policy == "block":
+                self.rows.put((statement, row), timeout=self.block_seconds)
+            else:
+                self.rows.put_nowait((statement, row))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+        with self.lock:
+            self.enqueued += 1
+        return True
+
+    def _run(self):
+        stopping = False
+        while True:
+            try:
+                item = self.rows.get_nowait() if stopping else self.rows.get(timeout=self.flush_seconds)
+            except queue.Empty:
+                if stopping:
+                    return
+                continue
+            # Fill the batch until it is full or its first row waited long
+            # enough, without waiting once shutting down
+            batch = []
+            deadline = time.monotonic() + self.flush_seconds
+            while True:
+                if item is _stop:
+                    stopping = True
+                else:
+                    batch.append(item)
+                if len(batch) >= self.batch_rows:
+                    break
+                try:
+                    if stopping:
+                        item = self.rows.get_nowait()
+                    else:
+                        item = self.rows.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        statements = {}
+        for statement, row in batch:
+            statements.setdefault(statement, []).append(row)
+        start = time.perf_counter()
+        try:
+            self.write_batch(statements)
+        except Exception as e:
+            print(f"Error writing {len(batch)} {self.name} rows: {e}")
+            with self.lock:
+                self.failed += len(batch)
+            return
+        with self.lock:
+            self.written += len(batch)
+            self.batches += 1
+            self.total_write_ms += (time.perf_counter() - start) * 1000
+
+    def close(self, timeout=5.0):
+        """Write the buffered rows and stop the writer thread."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.rows.put(_stop, timeout=timeout)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "policy": self.policy,
+                "buffered": self.rows.qsize(),
+                "max_rows": self.rows.maxsize,
+                "enqueued": self.enqueued,
+                "dropped": self.dropped,
+                "written": self.written,
+                "failed": self.failed,
+                "batches": self.batches,
+                "mean_batch_rows": self.written / self.batches if self.batches else None,
+                "mean_write_ms": self.total_write_ms / self.batches if self.batches else None,
+            }
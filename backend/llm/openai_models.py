@@ -1,19 +1,10 @@
-import os
-from dotenv import load_dotenv
-from openai import OpenAI
-
-model = "gpt-4o-mini"
-
-
-load_dotenv()
-client = OpenAI(
-    api_key=os.getenv("OPENAI_API_KEY"),
-)
+from llm.gateway import create_completion
 
 
 def handler(query):
-    chat_completion = client.chat.completions.create(
-        messages=[
+    chat_completion = create_completion(
+        "handler",
+        [
             {
                 "role": "system",
                 "content": (
@@ -30,7 +21,6 @@ def handler(query):
                 "content": query,
             }
         ],
-        model=model,
     )
 
     return chat_completion.choices[0].message.content
@@ -0,0 +1,78 @@
+import threading
+
+from llm.timing import timed, captured_stages
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key: the first caller (the
+    leader) runs the function and every caller that arrives while it is in
+    flight waits for and shares its result or exception. Nothing is kept
+    once the call finishes, so this is not a cache.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.leaders = 0
+        self.waiters = 0
+        self.upstream_calls = 0
+        self.upstream_calls_saved = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+                self.leaders += 1
+            else:
+                call.waiters += 1
+                self.waiters += 1
+        if leader:
+            return self._lead(key, call, fn, *args, **kwargs)
+        return self._wait(call)
+
+    def _wait(self, call):
+        with timed(f"{self.name}_coalesced"):
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _lead(self, key, call, fn, *args, **kwargs):
+        stages = []
+        try:
+            with captured_stages() as stages:
+                call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            # Stages with a model are the completions that went upstream
+            upstream_calls = sum(1 for stage in stages if stage.model is not None)
+            with self.lock:
+                del self.calls[key]
+                self.upstream_calls += upstream_calls
+                self.upstream_calls_saved += upstream_calls * call.waiters
+            call.done.set()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "in_flight": len(self.calls),
+                "leaders": self.leaders,
+                "waiters": self.waiters,
+                "upstream_calls": self.upstream_calls,
+                "upstream_calls_saved": self.upstream_calls_saved,
+            }
@@ -0,0 +1,146 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from flask import current_app, has_app_context
+
+from llm.timing import run_in_context, start_request_timings, request_timings
+
+
+class _Entry:
+    def __init__(self, future, expires_at, speculative):
+        self.future = future
+        self.expires_at = expires_at
+        # Stashed by-products of a speculation are not counted on their own
+        self.speculative = speculative
+
+
+class Speculator:
+    """
+    Run work before it is known to be needed and hand the result to whoever
+    asks for the same key later. Entries that are discarded, evicted or not
+    adopted within the TTL count as wasted speculation.
+
+    The stages of a speculation are not added to the request that started
+    it, which may have been answered before they finish. When the work is
+    done, record_usage(records, route, **attribution) receives them under
+    the route "speculation:<kind of key>", adopted or not; attribution() is
+    called when the work starts, in the request, to say who it is billed to.
+    """
+
+    def __init__(self, executor, ttl_seconds, max_entries=256):
+        self.executor = executor
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.record_usage = None
+        self.attribution = None
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.started = 0
+        self.adopted = 0
+        self.discarded = 0
+        self.cancelled = 0
+        self.expired = 0
+
+    def start(self, key, fn, *args, attribution=None):
+        """Run fn(*args) in the background, inside the app context if there is one."""
+        with self.lock:
+            if key in self.entries:
+                return
+            self._make_room()
+        app = current_app._get_current_object() if has_app_context() else None
+        attribution = {**(self.attribution() if self.attribution else {}), **(attribution or {})}
+
+        def run():
+            # Its own stage records, reported when the work is done
+            start_request_timings()
+            try:
+                if app is None:
+                    return fn(*args)
+                with app.app_context():
+                    return fn(*args)
+            finally:
+                self._record(key, request_timings(), attribution)
+
+        future = run_in_context(self.executor, run)
+        with self.lock:
+            self.entries[key] = _Entry(future, time.time() + self.ttl_seconds, speculative=True)
+            self.started += 1
+
+    def _record(self, key, records, attribution):
+        if not records or self.record_usage is None:
+            return
+        try:
+            self.record_usage(records, route=f"speculation:{key[0]}", **attribution)
+        except Exception as e:
+            print(f"Error recording speculative LLM usage: {e}")
+
+    def stash(self, key, value):
+        """Keep an already computed value for adoption, e.g. a by-product of a speculation."""
+        future = Future()
+        future.set_result(value)
+        with self.lock:
+            self._make_room()
+            self.entries[key] = _Entry(future, time.time() + self.ttl_seconds, speculative=False)
+
+    def adopt(self, key):
+        """
+        Take the result for key, waiting for it if the work is still running.
+        Returns None when there is nothing to adopt or the work failed.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.time():
+                if entry.speculative:
+                    self.expired += 1
+                return None
+            if entry.speculative:
+                self.adopted += 1
+        try:
+            return entry.future.result()
+        except Exception as e:
+            print(f"Speculative work for {key[0]} failed, running it again: {e}")
+            return None
+
+    def discard(self, key):
+        """Drop the work for key, cancelling it if it has not started yet."""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or not entry.speculative:
+                return
+            self.discarded += 1
+            if entry.future.cancel():
+                self.cancelled += 1
+
+    def _expire(self):
+        # Called with the lock held
+        now = time.time()
+        for key in [key for key, entry in self.entries.items() if entry.expires_at <= now]:
+            if self.entries.pop(key).speculative:
+                self.expired += 1
+
+    def _make_room(self):
+        # Called with the lock held, evicts the oldest entries beyond the bound
+        self._expire()
+        while len(self.entries) >= self.max_entries:
+            _, entry = self.entries.popitem(last=False)
+            if entry.speculative:
+                self.expired += 1
+
+    def stats(self):
+        with self.lock:
+            self._expire()
+            wasted = self.discarded + self.expired
+            settled = self.adopted + wasted
+            return {
+                "started": self.started,
+                "pending": sum(1 for entry in self.entries.values() if entry.speculative),
+                "adopted": self.adopted,
+                "discarded": self.discarded,
+                "cancelled_before_start": self.cancelled,
+                "expired": self.expired,
+                "wasted_rate": wasted / settled if settled else 0.0,
+            }
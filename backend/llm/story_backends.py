@@ -0,0 +1,258 @@
+import os
+import queue
+import threading
+import time
+
+from llm.gateway import create_completion, stream_completion
+from llm.timing import timed
+
+# STORY_BACKEND picks what writes the stories:
+#   "openai"      - the chat completion API through the LLM gateway (default)
+#   "llama_cpp"   - a GGUF file, e.g. the q4_k_m export of the fine-tuned
+#                   story model, run on the CPU with llama-cpp-python
+#   "torchscript" - a TorchScript causal LM that returns next-token logits,
+#                   with a Hugging Face tokenizer (torch and transformers)
+# The local runtimes are optional dependencies and are only imported when
+# selected. Their model is loaded on first use and kept resident.
+
+# Put on the queue of a streamed local generation after its last piece
+_finished = object()
+
+
+class OpenAIStoryBackend:
+    """Story completions from the OpenAI API."""
+
+    name = "openai"
+
+    def generate(self, stage, messages):
+        chat_completion = create_completion(stage, messages)
+        return chat_completion.choices[0].message.content
+
+    def stream(self, stage, messages):
+        yield from stream_completion(stage, messages)
+
+    def stats(self):
+        return {"backend": self.name}
+
+
+class LocalStoryBackend:
+    """
+    Base for the on-host runtimes. One model instance is shared by every
+    request of the process and generations run one at a time under a lock,
+    since neither runtime supports concurrent decoding on the same model.
+    """
+
+    name = "local"
+
+    def __init__(self, model_path, max_tokens, temperature, threads):
+        self.model_path = model_path
+        self.model_name = f"local/{os.path.basename(model_path)}"
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.model = None
+        self.load_seconds = None
+        self.generations = 0
+        self.tokens_generated = 0
+        self.generation_seconds = 0.0
+        self.last_tokens_per_second = None
+
+    def load(self):
+        """Load the model if it is not resident yet, the caller holds the lock."""
+        if self.model is None:
+            start = time.perf_counter()
+            self.model = self._load()
+            self.load_seconds = time.perf_counter() - start
+            print(f"Loaded story model {self.model_path} in {self.load_seconds:.1f} s")
+        return self.model
+
+    def generate(self, stage, messages):
+        return "".join(self.stream(stage, messages))
+
+    def stream(self, stage, messages):
+        # The model decodes under the lock in a thread of its own and the
+        # pieces are yielded outside it, so a slow client of a streamed story
+        # doesn't hold up the generations of every other request
+        pieces = queue.Queue()
+        cancelled = threading.Event()
+        with timed(stage) as record:
+            threading.Thread(target=self._decode, args=(messages, record, pieces, cancelled),
+                             name="story-decode", daemon=True).start()
+            try:
+                while True:
+                    piece = pieces.get()
+                    if piece is _finished:
+                        return
+                    if isinstance(piece, Exception):
+                        raise piece
+                    yield piece
+            finally:
+                # Stops the decoding when the client went away
+                cancelled.set()
+
+    def _decode(self, messages, record, pieces, cancelled):
+        try:
+            with self.lock:
+                model = self.load()
+                start = time.perf_counter()
+                usage = {"prompt_tokens": 0, "completion_tokens": 0}
+                for piece in self._generate(model, messages, usage):
+                    if cancelled.is_set():
+                        break
+                    pieces.put(piece)
+                elapsed = time.perf_counter() - start
+                record.model = self.model_name
+                record.prompt_tokens = usage["prompt_tokens"]
+                record.completion_tokens = usage["completion_tokens"]
+                tokens_per_second = usage["completion_tokens"] / elapsed if elapsed else 0.0
+                self.generations += 1
+                self.tokens_generated += usage["completion_tokens"]
+                self.generation_seconds += elapsed
+                self.last_tokens_per_second = tokens_per_second
+            print(f"Story model generated {usage['completion_tokens']} tokens at {tokens_per_second:.1f} tokens/s")
+        except Exception as e:
+            pieces.put(e)
+            return
+        pieces.put(_finished)
+
+    def _load(self):
+        raise NotImplementedError
+
+    def _generate(self, model, messages, usage):
+        """Yield the text of the completion piece by piece and fill in usage."""
+        raise NotImplementedError
+
+    def stats(self):
+        return {
+            "backend": self.name,
+            "model_path": self.model_path,
+            "loaded": self.model is not None,
+            "load_seconds": self.load_seconds,
+            "generations": self.generations,
+            "tokens_generated": self.tokens_generated,
+            "last_tokens_per_second": self.last_tokens_per_second,
+            "mean_tokens_per_second": (
+                self.tokens_generated / self.generation_seconds if self.generation_seconds else None),
+        }
+
+
+class LlamaCppStoryBackend(LocalStoryBackend):
+    """GGUF model run with llama-cpp-python, using the chat template stored in the file."""
+
+    name = "llama_cpp"
+
+    def __init__(self, model_path, max_tokens, temperature, threads, context_tokens):
+        super().__init__(model_path, max_tokens, temperature, threads)
+        self.context_tokens = context_tokens
+
+    def _load(self):
+        from llama_cpp import Llama
+        return Llama(
+            model_path=self.model_path,
+            n_ctx=self.context_tokens,
+            n_threads=self.threads,
+            verbose=False,
+        )
+
+    def _generate(self, model, messages, usage):
+        stream = model.create_chat_completion(
+            messages=messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            stream=True,
+        )
+        for chunk in stream:
+            content = chunk["choices"][0]["delta"].get("content")
+            if content:
+                # llama.cpp streams one token per chunk
+                usage["completion_tokens"] += 1
+                yield content
+        # Tokens evaluated in the context are the prompt plus the completion
+        usage["prompt_tokens"] = max(0, getattr(model, "n_tokens", 0) - usage["completion_tokens"])
+
+
+class TorchScriptStoryBackend(LocalStoryBackend):
+    """
+    TorchScript causal LM, called as model(input_ids) and returning logits of
+    shape (1, sequence, vocabulary), decoded token by token without a KV cache.
+    """
+
+    name = "torchscript"
+
+    def __init__(self, model_path, max_tokens, temperature, threads, context_tokens, tokenizer_path):
+        super().__init__(model_path, max_tokens, temperature, threads)
+        self.context_tokens = context_tokens
+        self.tokenizer_path = tokenizer_path
+        self.tokenizer = None
+
+    def _load(self):
+        import torch
+        from transformers import AutoTokenizer
+        torch.set_num_threads(self.threads)
+        self.tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_path)
+        model = torch.jit.load(self.model_path, map_location="cpu")
+        model.eval()
+        return model
+
+    def _generate(self, model, messages, usage):
+        import torch
+        if self.tokenizer.chat_template:
+            input_ids = self.tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+        else:
+            prompt = "\n".join(f"{m['role']}: {m['content']}" for m in messages) + "\nassistant:"
+            input_ids = self.tokenizer(prompt)["input_ids"]
+        # Keep the end of the prompt and room for the completion in the context
+        input_ids = input_ids[-max(1, self.context_tokens - self.max_tokens):]
+        usage["prompt_tokens"] = len(input_ids)
+
+        tokens = torch.tensor([input_ids], dtype=torch.long)
+        generated = []
+        text = ""
+        with torch.inference_mode():
+            for _ in range(self.max_tokens):
+                logits = model(tokens)
+                if isinstance(logits, (tuple, list)):
+                    logits = logits[0]
+                logits = logits[0, -1]
+                if self.temperature > 0:
+                    probabilities = torch.softmax(logits / self.temperature, dim=-1)
+                    next_token = int(torch.multinomial(probabilities, 1))
+                else:
+                    next_token = int(torch.argmax(logits))
+                if next_token == self.tokenizer.eos_token_id:
+                    break
+                generated.append(next_token)
+                usage["completion_tokens"] += 1
+                tokens = torch.cat([tokens, torch.tensor([[next_token]])], dim=1)[:, -self.context_tokens:]
+                # Decode the whole completion so multi-token characters come out whole
+                decoded = self.tokenizer.decode(generated, skip_special_tokens=True)
+                if len(decoded) > len(text) and not decoded.endswith("�"):
+                    yield decoded[len(text):]
+                    text = decoded
+
+
+def story_backend_from_env():
+    """Build the story backend configured by STORY_BACKEND and the STORY_MODEL_* variables."""
+    name = os.getenv("STORY_BACKEND", "openai").lower()
+    if name == "openai":
+        return OpenAIStoryBackend()
+
+    model_path = os.getenv("STORY_MODEL_PATH")
+    if not model_path:
+        raise ValueError(f"STORY_MODEL_PATH is required for STORY_BACKEND={name}")
+    options = {
+        "max_tokens": int(os.getenv("STORY_MODEL_MAX_TOKENS", "1024")),
+        "temperature": float(os.getenv("STORY_MODEL_TEMPERATURE", "0.8")),
+        "threads": int(os.getenv("STORY_MODEL_THREADS", str(os.cpu_count() or 4))),
+        "context_tokens": int(os.getenv("STORY_MODEL_CONTEXT_TOKENS", "4096")),
+    }
+    if name == "llama_cpp":
+        return LlamaCppStoryBackend(model_path, **options)
+    if name == "torchscript":
+        return TorchScriptStoryBackend(
+            model_path,
+            tokenizer_path=os.getenv("STORY_TOKENIZER_PATH", os.path.dirname(model_path)),
+            **options,
+        )
+    raise ValueError(f"Unknown story backend: {name}")
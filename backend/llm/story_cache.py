@@ -0,0 +1,198 @@
+import os
+import random
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from llm.cache import normalize_query
+
+# Words that say nothing about which story is wanted
+stopwords = {
+    "a", "an", "the", "me", "my", "us", "i", "you", "please", "tell", "write", "make", "give",
+    "story", "stories", "tale", "about", "of", "with", "and", "to", "for", "can", "could",
+    "would", "some", "new", "one", "that", "who", "is", "are", "in", "on",
+}
+
+# Smallest prime above 2^32, with a, b and the crc32 hashes below 2^32
+# a * x + b stays within uint64
+_prime = 4294967311
+
+
+def shingles(prompt):
+    """Content words and their character 4-grams, so "dragons" still overlaps "dragon"."""
+    words = [word for word in normalize_query(prompt).split() if word not in stopwords]
+    grams = set(words)
+    for word in words:
+        padded = f"_{word}_"
+        grams.update(padded[i:i + 4] for i in range(len(padded) - 3))
+    return grams
+
+
+class MinHasher:
+    """MinHash signatures whose matching slots estimate the Jaccard similarity of shingle sets."""
+
+    def __init__(self, permutations, seed=1):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 1 << 32, size=permutations, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 32, size=permutations, dtype=np.uint64)
+
+    def signature(self, grams):
+        if not grams:
+            return None
+        hashes = np.array([zlib.crc32(gram.encode("utf-8")) for gram in grams], dtype=np.uint64)
+        # (a * x + b) mod p for every permutation at once
+        values = (np.outer(hashes, self.a) + self.b) % _prime
+        return values.min(axis=0)
+
+
+class _Entry:
+    def __init__(self, prompt, signature, story, expires_at):
+        self.prompt = prompt
+        self.signature = signature
+        self.variants = [story]
+        self.next_variant = 0
+        self.expires_at = expires_at
+
+
+class StoryCache:
+    """
+    Near-duplicate cache of complete new stories. Prompts are compared by
+    the MinHash estimate of the Jaccard similarity of their shingles, with
+    LSH bands to find candidates without scanning every entry. A prompt at or
+    above the threshold gets a stored story; up to max_variants stories are
+    kept per entry and handed out in turn, and variant_rate of the hits are
+    sent to the pipeline to add a new variant.
+    """
+
+    def __init__(self, threshold, max_entries, ttl_seconds, max_variants=3, variant_rate=0.0,
+                 permutations=128, bands=32):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_variants = max_variants
+        self.variant_rate = variant_rate
+        self.rows = permutations // bands
+        self.bands = bands
+        self.hasher = MinHasher(self.rows * bands)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.buckets = {}
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.variant_refreshes = 0
+        self.evictions = 0
+        self.hit_similarity_total = 0.0
+
+    def _band_keys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+                for band in range(self.bands)]
+
+    def _find(self, signature):
+        # Called with the lock held, returns (entry id, similarity) of the best match
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates.update(self.buckets.get(key, ()))
+        best_id, best_similarity = None, 0.0
+        now = time.time()
+        for entry_id in candidates:
+            entry = self.entries[entry_id]
+            if entry.expires_at <= now:
+                continue
+            similarity = float(np.mean(entry.signature == signature))
+            if similarity > best_similarity:
+                best_id, best_similarity = entry_id, similarity
+        if best_similarity >= self.threshold:
+            return best_id, best_similarity
+        return None, best_similarity
+
+    def get(self, prompt):
+        """Return a cached story dict for a near-duplicate prompt, or None."""
+        signature = self.hasher.signature(shingles(prompt))
+        with self.lock:
+            entry_id, similarity = self._find(signature) if signature is not None else (None, 0.0)
+            if entry_id is None:
+                self.misses += 1
+                return None
+            entry = self.entries[entry_id]
+            if len(entry.variants) < self.max_variants and random.random() < self.variant_rate:
+                # Let the pipeline write another version of this story
+                self.variant_refreshes += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(entry_id)
+            self.hits += 1
+            self.hit_similarity_total += similarity
+            story = entry.variants[entry.next_variant % len(entry.variants)]
+            entry.next_variant += 1
+        print(f"Story cache hit ({similarity:.2f}) for '{prompt}' from '{entry.prompt}'")
+        return dict(story)
+
+    def set(self, prompt, story):
+        """Store a generated story, as another variant when a near-duplicate entry exists."""
+        signature = self.hasher.signature(shingles(prompt))
+        if signature is None:
+            return
+        with self.lock:
+            entry_id, _ = self._find(signature)
+            if entry_id is not None:
+                entry = self.entries[entry_id]
+                if len(entry.variants) < self.max_variants:
+                    entry.variants.append(dict(story))
+                self.entries.move_to_end(entry_id)
+                return
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = _Entry(prompt, signature, dict(story), time.time() + self.ttl_seconds)
+            for key in self._band_keys(signature):
+                self.buckets.setdefault(key, set()).add(entry_id)
+            self._evict()
+
+    def _evict(self):
+        # Called with the lock held, drops expired entries then the least recently used
+        now = time.time()
+        expired = [entry_id for entry_id, entry in self.entries.items() if entry.expires_at <= now]
+        while len(self.entries) - len(expired) > self.max_entries:
+            entry_id = next(entry_id for entry_id in self.entries if entry_id not in expired)
+            expired.append(entry_id)
+        for entry_id in expired:
+            entry = self.entries.pop(entry_id)
+            self.evictions += 1
+            for key in self._band_keys(entry.signature):
+                bucket = self.buckets.get(key)
+                if bucket is not None:
+                    bucket.discard(entry_id)
+                    if not bucket:
+                        del self.buckets[key]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "threshold": self.threshold,
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "stories": sum(len(entry.variants) for entry in self.entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "mean_hit_similarity": self.hit_similarity_total / self.hits if self.hits else None,
+                "variant_refreshes": self.variant_refreshes,
+                "evictions": self.evictions,
+            }
+
+
+def story_cache_from_env():
+    """Build the story cache configured by the STORY_CACHE_* variables, or None when disabled."""
+    if os.getenv("STORY_CACHE_ENABLED", "false").lower() != "true":
+        return None
+    return StoryCache(
+        threshold=float(os.getenv("STORY_CACHE_THRESHOLD", "0.7")),
+        max_entries=int(os.getenv("STORY_CACHE_MAX_ENTRIES", "512")),
+        ttl_seconds=float(os.getenv("STORY_CACHE_TTL_SECONDS", str(24 * 3600))),
+        max_variants=int(os.getenv("STORY_CACHE_VARIANTS", "3")),
+        variant_rate=float(os.getenv("STORY_CACHE_VARIANT_RATE", "0.0")),
+    )
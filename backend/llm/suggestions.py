@@ -0,0 +1,153 @@
+import bisect
+import csv
+import math
+import os
+import random
+import threading
+import time
+import zlib
+from itertools import accumulate
+
+from llm.cache import normalize_query
+from llm.story_cache import stopwords
+
+# Occurrence tables computed over the TinyStories dataset by the SageMaker
+# case study, see sagemaker/scripts/Metrics-TinyStories_Case_Study.py
+default_data_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'sagemaker', 'scripts')
+
+# Query words that call for a narrative feature, matched on their prefix so
+# "learns" and "learning" count as "learn"
+feature_cues = {
+    "dialogue": ["talk", "speak", "say", "chat", "conversation", "parrot", "friend", "ask"],
+    "twist": ["twist", "surpris", "funny", "unexpect", "secret", "trick", "magic"],
+    "moralvalue": ["lesson", "learn", "moral", "kind", "share", "honest", "help", "brave", "teach"],
+    "foreshadowing": ["myster", "clue", "hidden", "discover", "adventure", "treasure", "lost"],
+    "conflict": ["fight", "battle", "pirate", "villain", "monster", "problem", "rival", "dragon", "enemy"],
+    "badending": ["sad", "tragic", "bad ending", "different ending", "scary", "dark"],
+}
+
+
+def content_words(query):
+    return [word for word in normalize_query(query).split() if word not in stopwords]
+
+
+class SuggestionIndex:
+    """
+    Vocabulary and narrative features ranked from the TinyStories occurrence
+    tables. The words are kept in sorted order with a parallel array of
+    cumulative weights, so words sharing a stem with the query are found by
+    bisection and the rest are drawn by weight in a few microseconds.
+
+    The tables carry no association between words and topics, so relevance
+    to the query is lexical: table words sharing a stem with a query word come
+    first and the remaining slots are drawn with a seed taken from the query,
+    which gives the same suggestions for the same query. Less frequent words
+    weigh more, like the "not common" words the LLM prompt asks for. Only
+    English queries get relevant words.
+    """
+
+    def __init__(self, word_counts, feature_counts, min_word_length=4):
+        words = sorted(word for word in word_counts if len(word) >= min_word_length)
+        most = max(word_counts[word] for word in words)
+        self.words = words
+        self.weights = [math.log(most + 1) - math.log(word_counts[word]) + 1.0 for word in words]
+        self.cumulative = list(accumulate(self.weights))
+        total = sum(feature_counts.values())
+        self.features = sorted(feature_counts, key=feature_counts.get, reverse=True)
+        self.feature_probabilities = {feature: count / total for feature, count in feature_counts.items()}
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.lookup_seconds = 0.0
+
+    @classmethod
+    def load(cls, data_dir):
+        """Read word_occurrences.csv and feature_occurrences.csv from data_dir."""
+        start = time.perf_counter()
+        word_counts = cls._read_counts(os.path.join(data_dir, "word_occurrences.csv"))
+        feature_counts = cls._read_counts(os.path.join(data_dir, "feature_occurrences.csv"))
+        index = cls(word_counts, feature_counts)
+        print(f"Loaded {len(index.words)} suggestion words and {len(index.features)} features "
+              f"in {(time.perf_counter() - start) * 1000:.0f} ms")
+        return index
+
+    @staticmethod
+    def _read_counts(path):
+        with open(path, newline="") as f:
+            reader = csv.reader(f)
+            next(reader)
+            return {row[0].strip().lower(): int(row[1]) for row in reader if len(row) >= 2}
+
+    def _prefix_matches(self, prefix):
+        start = bisect.bisect_left(self.words, prefix)
+        end = bisect.bisect_left(self.words, prefix + "\uffff")
+        return range(start, end)
+
+    def vocabulary(self, query, count=4):
+        """Return up to count words for the query, the related ones first."""
+        start = time.perf_counter()
+        words = content_words(query)
+
+        def in_query(i):
+            # "dragon" for "dragons" adds nothing to the prompt
+            return any(word.startswith(self.words[i]) for word in words)
+
+        chosen = []
+        # Table words sharing a stem with a query word, e.g. "adventurous" for "adventure"
+        for word in words:
+            if len(word) < 4:
+                continue
+            for i in self._prefix_matches(word[:max(4, len(word) - 2)]):
+                if i not in chosen and not in_query(i):
+                    chosen.append(i)
+        chosen = sorted(chosen, key=lambda i: self.weights[i], reverse=True)[:count]
+
+        rng = random.Random(zlib.crc32(" ".join(words).encode("utf-8")))
+        total = self.cumulative[-1]
+        attempts = 0
+        while len(chosen) < count and attempts < count * 20:
+            attempts += 1
+            i = bisect.bisect_left(self.cumulative, rng.random() * total)
+            if i not in chosen and not in_query(i):
+                chosen.append(i)
+        self._count(start)
+        return [self.words[i] for i in chosen]
+
+    def narrative_features(self, query, count=3):
+        """Return count features, those cued by the query first, then drawn by how often they occur."""
+        start = time.perf_counter()
+        text = " ".join(content_words(query))
+        padded = f" {text}"
+        cued = {feature: sum(1 for cue in cues if f" {cue}" in padded)
+                for feature, cues in feature_cues.items() if feature in self.feature_probabilities}
+        chosen = sorted((feature for feature, hits in cued.items() if hits),
+                        key=lambda feature: (-cued[feature], -self.feature_probabilities[feature]))[:count]
+
+        rng = random.Random(zlib.crc32(text.encode("utf-8")))
+        remaining = [feature for feature in self.features if feature not in chosen]
+        while len(chosen) < count and remaining:
+            weights = [self.feature_probabilities[feature] for feature in remaining]
+            feature = rng.choices(remaining, weights=weights)[0]
+            chosen.append(feature)
+            remaining.remove(feature)
+        self._count(start)
+        return chosen
+
+    def _count(self, start):
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.lookups += 1
+            self.lookup_seconds += elapsed
+
+    def stats(self):
+        with self.lock:
+            return {
+                "words": len(self.words),
+                "features": len(self.features),
+                "lookups": self.lookups,
+                "mean_lookup_us": self.lookup_seconds / self.lookups * 1e6 if self.lookups else None,
+            }
+
+
+def suggestion_index_from_env():
+    """Load the suggestion index from SUGGESTION_DATA_DIR (the SageMaker scripts folder by default)."""
+    return SuggestionIndex.load(os.getenv("SUGGESTION_DATA_DIR", default_data_dir))
@@ -0,0 +1,114 @@
+import contextvars
+import time
+from contextlib import contextmanager
+
+# Stage records for the request currently being handled. Worker threads that
+# run a stage on behalf of the request share the same list by running inside
+# a copy of the request's context (see run_in_context).
+_stage_records = contextvars.ContextVar("stage_records", default=None)
+
+
+class StageRecord:
+    """Timing and token usage for a single stage (usually one LLM round-trip) of a request."""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.started_at = time.time()
+        self.elapsed_ms = 0.0
+        self.model = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def record_usage(self, completion):
+        """Copy the model and token counts reported by a chat completion."""
+        self.model = getattr(completion, "model", None)
+        usage = getattr(completion, "usage", None)
+        if usage is not None:
+            self.prompt_tokens = usage.prompt_tokens or 0
+            self.completion_tokens = usage.completion_tokens or 0
+
+    def as_dict(self):
+        return {
+            "stage": self.stage,
+            "elapsed_ms": round(self.elapsed_ms, 1),
+            "model": self.model,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+        }
+
+
+def start_request_timings():
+    """Begin collecting stage timings for the current request."""
+    _stage_records.set([])
+
+
+def request_timings():
+    """Return the stage records collected so far for the current request."""
+    return list(_stage_records.get() or [])
+
+
+@contextmanager
+def timed(stage):
+    """Time the enclosed block and record it as a stage of the current request."""
+    record = StageRecord(stage)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.elapsed_ms = (time.perf_counter() - start) * 1000
+        records = _stage_records.get()
+        if records is not None:
+            records.append(record)
+        print(f"Stage {stage} took {record.elapsed_ms:.1f} ms")
+
+
+def record_stage(stage, elapsed_ms):
+    """Record a stage that was measured by the caller, e.g. time to first token."""
+    record = StageRecord(stage)
+    record.elapsed_ms = elapsed_ms
+    records = _stage_records.get()
+    if records is not None:
+        records.append(record)
+    print(f"Stage {stage} took {elapsed_ms:.1f} ms")
+
+
+def run_in_context(executor, fn, *args, **kwargs):
+    """Submit fn to the executor so that its stage timings land on this request."""
+    context = contextvars.copy_context()
+    return executor.submit(context.run, fn, *args, **kwargs)
+
+
+def format_timings(records):
+    """Render stage records as a one-line summary for the logs."""
+    if not records:
+        return "no stages recorded"
+    return ", ".join(f"{r.stage}={r.elapsed_ms:.1f}ms" for r in records)
+
+
+@contextmanager
+def captured_stages():
+    """
+    Collect the stages recorded inside the block into the yielded list. They
+    still land on the current request; outside a request they are only
+    collected.
+    """
+    records = _stage_records.get()
+    token = None
+    if records is None:
+        records = []
+        token = _stage_records.set(records)
+    start = len(records)
+    captured = []
+    try:
+        yield captured
+    finally:
+        captured.extend(records[start:])
+        if token is not None:
+            _stage_records.reset(token)
+
+
+def percentile(values, pct):
+    """The pct percentile of values, by the nearest rank."""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
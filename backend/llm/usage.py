@@ -0,0 +1,187 @@
+import contextvars
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+# USD per million prompt / completion tokens. Returned model names carry a
+# date suffix (gpt-4o-mini-2024-07-18), so prices are matched on the longest
+# prefix. Unknown models are recorded with no cost.
+model_prices = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4.1": (2.00, 8.00),
+}
+
+# Who a request's completions are billed to, filled in while the request runs
+_request_attribution = contextvars.ContextVar("request_attribution", default=None)
+
+rollup_dimensions = ("hour", "stage", "family_id", "model")
+
+
+def start_usage_attribution():
+    """Begin collecting the attribution (conversation, user, family) of the current request."""
+    _request_attribution.set({})
+
+
+def attribute_usage(**attributes):
+    """Attach e.g. conversation_id to the LLM usage of the current request."""
+    attribution = _request_attribution.get()
+    if attribution is not None:
+        attribution.update({k: v for k, v in attributes.items() if v is not None})
+
+
+def request_attribution():
+    return dict(_request_attribution.get() or {})
+
+
+def completion_cost(model, prompt_tokens, completion_tokens):
+    """Cost in USD of a completion, or None when the model has no known price."""
+    if not model:
+        return None
+    matches = [name for name in model_prices if model.startswith(name)]
+    if not matches:
+        return None
+    prompt_price, completion_price = model_prices[max(matches, key=len)]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+class UsageStore:
+    """
+    Append-only record of every LLM completion in a SQLite file, plus an
+    hourly rollup by stage, family and model that is updated in the same
+    transaction so reports never scan the raw rows.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS llm_usage ("
+                "id INTEGER PRIMARY KEY, recorded_at REAL NOT NULL, route TEXT, "
+                "conversation_id INTEGER, user_id TEXT, family_id TEXT, "
+                "stage TEXT NOT NULL, model TEXT, prompt_tokens INTEGER NOT NULL, "
+                "completion_tokens INTEGER NOT NULL, elapsed_ms REAL NOT NULL, cost_usd REAL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_llm_usage_conversation ON llm_usage (conversation_id)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS llm_usage_hourly ("
+                "hour TEXT NOT NULL, stage TEXT NOT NULL, family_id TEXT NOT NULL, model TEXT NOT NULL, "
+                "calls INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, "
+                "completion_tokens INTEGER NOT NULL, elapsed_ms REAL NOT NULL, "
+                "max_elapsed_ms REAL NOT NULL, cost_usd REAL NOT NULL, "
+                "PRIMARY KEY (hour, stage, family_id, model))"
+            )
+
+    @contextmanager
+    def connect(self):
+        """Open a short-lived connection and commit the enclosed statements."""
+        connection = sqlite3.connect(self.path, timeout=5)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def record(self, records, route=None, conversation_id=None, user_id=None, family_id=None):
+        """Append the completion stage records of one request."""
+        now = time.time()
+        hour = time.strftime("%Y-%m-%d %H:00", time.gmtime(now))
+        rows = []
+        for record in records:
+            # Only stages that completed an upstream call carry a model
+            if record.model is None:
+                continue
+            cost = completion_cost(record.model, record.prompt_tokens, record.completion_tokens)
+            rows.append((now, route, conversation_id, user_id, family_id, record.stage, record.model,
+                         record.prompt_tokens, record.completion_tokens, record.elapsed_ms, cost))
+        if not rows:
+            return 0
+        with self.connect() as connection:
+            connection.executemany(
+                "INSERT INTO llm_usage (recorded_at, route, conversation_id, user_id, family_id, "
+                "stage, model, prompt_tokens, completion_tokens, elapsed_ms, cost_usd) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            connection.executemany(
+                "INSERT INTO llm_usage_hourly (hour, stage, family_id, model, calls, prompt_tokens, "
+                "completion_tokens, elapsed_ms, max_elapsed_ms, cost_usd) "
+                "VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (hour, stage, family_id, model) DO UPDATE SET "
+                "calls = calls + 1, "
+                "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                "elapsed_ms = elapsed_ms + excluded.elapsed_ms, "
+                "max_elapsed_ms = MAX(max_elapsed_ms, excluded.max_elapsed_ms), "
+                "cost_usd = cost_usd + excluded.cost_usd",
+                [(hour, row[5], row[4] or "", row[6] or "", row[7], row[8], row[9], row[9], row[10] or 0.0)
+                 for row in rows],
+            )
+        return len(rows)
+
+    def rollup(self, since_hours=24, group_by=("stage",), family_id=None):
+        """
+        Sum the hourly rollups of the last since_hours hours, grouped by any
+        of rollup_dimensions. Returns one dict per group, costliest first.
+        """
+        group_by = [dimension for dimension in group_by if dimension in rollup_dimensions]
+        since = time.strftime("%Y-%m-%d %H:00", time.gmtime(time.time() - since_hours * 3600))
+        columns = ", ".join(group_by)
+        query = (
+            f"SELECT {columns + ', ' if columns else ''}SUM(calls), SUM(prompt_tokens), "
+            "SUM(completion_tokens), SUM(elapsed_ms), MAX(max_elapsed_ms), SUM(cost_usd) "
+            "FROM llm_usage_hourly WHERE hour >= ?"
+        )
+        params = [since]
+        if family_id is not None:
+            query += " AND family_id = ?"
+            params.append(family_id)
+        if columns:
+            query += f" GROUP BY {columns}"
+        query += " ORDER BY SUM(cost_usd) DESC"
+        with self.connect() as connection:
+            rows = connection.execute(query, params).fetchall()
+
+        report = []
+        for row in rows:
+            group = dict(zip(group_by, row[:len(group_by)]))
+            calls, prompt_tokens, completion_tokens, elapsed_ms, max_elapsed_ms, cost = row[len(group_by):]
+            if not calls:
+                continue
+            group.update({
+                "calls": calls,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "mean_elapsed_ms": round(elapsed_ms / calls, 1),
+                "max_elapsed_ms": round(max_elapsed_ms, 1),
+                "cost_usd": round(cost, 6),
+            })
+            report.append(group)
+        return report
+
+    def conversation_usage(self, conversation_id):
+        """The raw completion records of one conversation, oldest first."""
+        with self.connect() as connection:
+            rows = connection.execute(
+                "SELECT recorded_at, route, stage, model, prompt_tokens, completion_tokens, "
+                "elapsed_ms, cost_usd FROM llm_usage WHERE conversation_id = ? ORDER BY id",
+                (conversation_id,),
+            ).fetchall()
+        keys = ("recorded_at", "route", "stage", "model", "prompt_tokens",
+                "completion_tokens", "elapsed_ms", "cost_usd")
+        return [dict(zip(keys, row)) for row in rows]
+
+
+def usage_store_from_env():
+    """Build the usage store from LLM_USAGE_ENABLED / LLM_USAGE_DB_PATH, or None when disabled."""
+    if os.getenv("LLM_USAGE_ENABLED", "true").lower() != "true":
+        return None
+    return UsageStore(os.getenv(
+        "LLM_USAGE_DB_PATH",
+        os.path.join(os.path.dirname(__file__), '..', 'llm_usage.sqlite3')))
@@ -0,0 +1,27 @@
+import argparse
+import os
+from sqlalchemy import create_engine
+from db.db import database_uri, engine_options
+from db.migrations import migrate, migration_status
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Apply the schema migrations of db/migrations.py to the database")
+    parser.add_argument("--status", action="store_true",
+                        help="list the migrations and when they were applied")
+    parser.add_argument("--target", type=int, default=None,
+                        help="stop after this migration version")
+    args = parser.parse_args()
+
+    engine = create_engine(database_uri(), **engine_options())
+    if args.status:
+        for version, name, applied_at in migration_status(engine):
+            print(f"{version:>4}  {applied_at.isoformat() if applied_at else 'pending':<26}  {name}")
+    else:
+        applied = migrate(engine, target=args.target)
+        print(f"Applied {len(applied)} migrations" if applied else "Database is up to date")
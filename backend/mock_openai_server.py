@@ -0,0 +1,315 @@
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+from flask import Flask, Response, jsonify, request
+
+# Stand-in for the OpenAI chat completions API for load tests. Point the
+# backend at it with OPENAI_BASE_URL=http://localhost:8001/v1 (any
+# OPENAI_API_KEY works) and FIREBASE_AUTH_EMULATOR_HOST=localhost:8001 to
+# accept any Firebase ID token. Replies are deterministic for a given input and
+# well-formed for every stage of llm.py; only the latency and the injected
+# errors are random.
+
+app = Flask(__name__)
+
+# Per-stage latency of a whole completion. median_ms/sigma describe a
+# lognormal, spike_rate is the chance of a tail spike that multiplies the
+# latency by spike_factor and rate_limit_rate the chance of a 429.
+latency_profiles = {
+    "instant": {
+        "default": {"median_ms": 0, "sigma": 0.0, "spike_rate": 0.0, "spike_factor": 1, "rate_limit_rate": 0.0},
+    },
+    "realistic": {
+        "default": {"median_ms": 600, "sigma": 0.35, "spike_rate": 0.02, "spike_factor": 6, "rate_limit_rate": 0.0},
+        "handler": {"median_ms": 350, "sigma": 0.3, "spike_rate": 0.02, "spike_factor": 6, "rate_limit_rate": 0.0},
+        "vocabulary": {"median_ms": 500, "sigma": 0.3, "spike_rate": 0.02, "spike_factor": 6, "rate_limit_rate": 0.0},
+        "features": {"median_ms": 500, "sigma": 0.3, "spike_rate": 0.02, "spike_factor": 6, "rate_limit_rate": 0.0},
+        "meta_prompt": {"median_ms": 1200, "sigma": 0.35, "spike_rate": 0.02, "spike_factor": 5, "rate_limit_rate": 0.0},
+        "fused_enrichment": {"median_ms": 1500, "sigma": 0.35, "spike_rate": 0.02, "spike_factor": 5, "rate_limit_rate": 0.0},
+        "story_summary": {"median_ms": 1000, "sigma": 0.3, "spike_rate": 0.02, "spike_factor": 5, "rate_limit_rate": 0.0},
+        "story": {"median_ms": 3500, "sigma": 0.3, "spike_rate": 0.02, "spike_factor": 4, "rate_limit_rate": 0.0},
+    },
+    "degraded": {
+        "default": {"median_ms": 900, "sigma": 0.6, "spike_rate": 0.1, "spike_factor": 8, "rate_limit_rate": 0.05},
+        "story": {"median_ms": 5000, "sigma": 0.5, "spike_rate": 0.1, "spike_factor": 5, "rate_limit_rate": 0.05},
+    },
+}
+latency = dict(latency_profiles["realistic"])
+# Share of the story latency spent before the first streamed token
+first_token_share = 0.15
+rng = random.Random()
+rng_lock = threading.Lock()
+
+counters_lock = threading.Lock()
+counters = {"requests": {}, "rate_limited": {}, "spikes": {}}
+
+vocabulary_words = [
+    "glimmer", "whisper", "enormous", "curious", "sparkle", "tumble", "brave", "gentle",
+    "mysterious", "giggle", "shimmer", "wander", "clever", "twinkle", "rumble", "cozy",
+    "dazzling", "nimble", "puzzled", "soar", "splendid", "timid", "wobble", "zoom",
+]
+narrative_features = [
+    "dialogue", "twist", "moralvalue", "foreshadowing", "goodending", "badending", "characterdevelopment",
+]
+story_sentences = [
+    "{hero} woke up early because today felt {word1}.",
+    "Outside, the morning light began to {word2} over the hills.",
+    "A {word1} friend appeared and asked {hero} for help.",
+    "Together they followed a path that seemed to {word2} with every step.",
+    "When the wind began to howl, {hero} remembered to stay calm and kind.",
+    "They discovered that helping each other made every problem smaller.",
+    "By sunset, {hero} and the new friend were laughing all the way home.",
+    "Everyone in town agreed it had been a truly {word1} day.",
+]
+unsafe_words = {"kill", "blood", "gun", "weapon", "murder", "hurt", "die"}
+continuation_words = {"next", "continue", "more", "then", "ending", "funny", "twist", "after"}
+new_story_words = {"story", "tell", "tale", "write", "about", "once"}
+# Questions about a detail of the story count as continuations
+question_words = {"why", "who", "what", "where", "how"}
+
+
+def stable_choice(seed, options, count):
+    """Pick count distinct options determined only by the seed text."""
+    start = zlib.crc32(seed.encode("utf-8"))
+    return [options[(start + i * 7) % len(options)] for i in range(count)]
+
+
+def count_tokens(text):
+    return max(1, math.ceil(len(re.findall(r"\w+|[^\w\s]", text)) * 1.2))
+
+
+def detect_stage(messages, body):
+    system = next((m.get("content", "") for m in messages if m.get("role") == "system"), "")
+    if body.get("response_format", {}).get("type") == "json_schema":
+        return "fused_enrichment"
+    if "handler for a storytelling" in system:
+        return "handler"
+    if "summarize children's stories" in system:
+        return "story_summary"
+    if "prompt evaluation expert" in system:
+        return "meta_prompt"
+    if "vocabulary expert" in system:
+        return "vocabulary"
+    if "narrative features expert" in system:
+        return "features"
+    if "writer for a storytelling" in system:
+        return "story"
+    return "default"
+
+
+def user_text(messages):
+    return next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+
+
+def handler_reply(query):
+    words = set(re.findall(r"\w+", query.lower()))
+    if words & unsafe_words:
+        return "1" if words & new_story_words else "0"
+    if words & continuation_words:
+        return "3"
+    if words & new_story_words:
+        return "2"
+    if words & question_words:
+        return "3"
+    return "0"
+
+
+def story_request(query):
+    request_line = query.strip().splitlines()[-1] if query.strip() else "a story"
+    request_line = request_line.replace("Story Request:", "").strip()[:200]
+    return f"Write a short, engaging children's story about {request_line}"
+
+
+def story_reply(seed, title=None):
+    vocabulary = stable_choice(seed, vocabulary_words, 2)
+    hero = stable_choice(seed, ["Pip", "Luna", "Milo", "Sparky", "Juniper", "Theo"], 1)[0]
+    sentences = [s.format(hero=hero, word1=vocabulary[0], word2=vocabulary[1]) for s in story_sentences]
+    title = title or f"{hero} and the {vocabulary[0].capitalize()} Day"
+    return f"TITLE: {title}\n\nSTORY: {' '.join(sentences)}"
+
+
+def reply_for(stage, messages):
+    query = user_text(messages)
+    if stage == "handler":
+        return handler_reply(query)
+    if stage == "vocabulary":
+        return ", ".join(stable_choice(query, vocabulary_words, 4))
+    if stage == "features":
+        return ", ".join(stable_choice(query, narrative_features, 3))
+    if stage == "meta_prompt":
+        return (
+            f"Story Request: {story_request(query)}\n\n"
+            f"Vocabulary: {', '.join(stable_choice(query, vocabulary_words, 4))}\n\n"
+            f"Narratives: {', '.join(stable_choice(query, narrative_features, 3))}"
+        )
+    if stage == "fused_enrichment":
+        return json.dumps({
+            "vocabulary": stable_choice(query, vocabulary_words, 4),
+            "narrative_features": stable_choice(query, narrative_features, 3),
+            "story_request": story_request(query),
+        })
+    if stage == "story_summary":
+        parts = query.split("New story parts:", 1)[-1].split()
+        return "The story so far: " + " ".join(parts[:60])
+    if stage == "story":
+        title = re.search(r"Existing Title: (.+)", query)
+        return story_reply(query, title.group(1).strip() if title else None)
+    return "OK"
+
+
+def sample_latency(stage):
+    """Return (seconds, spiked, rate_limited) for one completion of the stage."""
+    config = latency.get(stage) or latency.get("default") or {}
+    median_ms = config.get("median_ms", 0)
+    with rng_lock:
+        seconds = median_ms / 1000 * math.exp(rng.gauss(0, config.get("sigma", 0.0)))
+        spiked = rng.random() < config.get("spike_rate", 0.0)
+        rate_limited = rng.random() < config.get("rate_limit_rate", 0.0)
+    if spiked:
+        seconds *= config.get("spike_factor", 1)
+    return seconds, spiked, rate_limited
+
+
+def count(counter, stage):
+    with counters_lock:
+        counters[counter][stage] = counters[counter].get(stage, 0) + 1
+
+
+def completion_body(model, content, messages):
+    prompt_tokens = sum(count_tokens(m.get("content", "")) for m in messages)
+    completion_tokens = count_tokens(content)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def stream_chunks(model, content, messages, seconds, include_usage):
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    pieces = re.findall(r"\S+\s*|\s+", content)
+    time.sleep(seconds * first_token_share)
+    delay = seconds * (1 - first_token_share) / max(1, len(pieces))
+
+    def chunk(delta, finish_reason=None):
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    yield f"data: {json.dumps(chunk({'role': 'assistant', 'content': ''}))}\n\n"
+    for piece in pieces:
+        yield f"data: {json.dumps(chunk({'content': piece}))}\n\n"
+        time.sleep(delay)
+    yield f"data: {json.dumps(chunk({}, 'stop'))}\n\n"
+    if include_usage:
+        usage = completion_body(model, content, messages)["usage"]
+        yield f"data: {json.dumps({'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model, 'choices': [], 'usage': usage})}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.route('/v1/chat/completions', methods=['POST'])
+def chat_completions():
+    body = request.get_json(force=True)
+    messages = body.get("messages", [])
+    model = body.get("model", "gpt-4o-mini")
+    stage = detect_stage(messages, body)
+    count("requests", stage)
+
+    seconds, spiked, rate_limited = sample_latency(stage)
+    if spiked:
+        count("spikes", stage)
+    if rate_limited:
+        count("rate_limited", stage)
+        error = {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}}
+        return jsonify(error), 429, {"Retry-After": "1"}
+
+    content = reply_for(stage, messages)
+    if body.get("stream"):
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        return Response(stream_chunks(model, content, messages, seconds, include_usage),
+                        mimetype="text/event-stream")
+    time.sleep(seconds)
+    return jsonify(completion_body(model, content, messages))
+
+
+@app.route('/v1/models', methods=['GET'])
+def models():
+    return jsonify({"object": "list", "data": [{"id": "gpt-4o-mini", "object": "model", "owned_by": "mock"}]})
+
+
+@app.route('/identitytoolkit.googleapis.com/v1/accounts:lookup', methods=['POST'])
+def firebase_accounts_lookup():
+    """
+    Firebase Auth stand-in for FIREBASE_AUTH_EMULATOR_HOST: every ID token
+    is valid and is its own user ID, so load tests can act as many parents
+    """
+    id_token = (request.get_json(force=True) or {}).get("idToken")
+    if not id_token:
+        return jsonify({"error": {"code": 400, "message": "INVALID_ID_TOKEN"}}), 400
+    return jsonify({"users": [{"localId": id_token, "email": f"{id_token}@loadtest.invalid"}]})
+
+
+@app.route('/mock/stats', methods=['GET'])
+def stats():
+    with counters_lock:
+        return jsonify({name: dict(values) for name, values in counters.items()})
+
+
+@app.route('/mock/latency', methods=['GET', 'PUT'])
+def latency_config():
+    """Read or replace the per-stage latency configuration while running"""
+    if request.method == 'PUT':
+        latency.clear()
+        latency.update(request.get_json(force=True))
+    return jsonify(latency)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mock OpenAI chat completions server for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--profile", choices=sorted(latency_profiles), default="realistic",
+                        help="built-in per-stage latency profile")
+    parser.add_argument("--latency-config",
+                        help="JSON file of per-stage latency settings merged over the profile")
+    parser.add_argument("--rate-limit-rate", type=float,
+                        help="override the 429 probability of every stage")
+    parser.add_argument("--seed", type=int, help="seed of the latency and error sampling")
+    args = parser.parse_args()
+
+    latency.clear()
+    latency.update({stage: dict(config) for stage, config in latency_profiles[args.profile].items()})
+    if args.latency_config:
+        with open(args.latency_config) as f:
+            for stage, config in json.load(f).items():
+                latency.setdefault(stage, dict(latency.get("default", {}))).update(config)
+    if args.rate_limit_rate is not None:
+        for config in latency.values():
+            config["rate_limit_rate"] = args.rate_limit_rate
+    if args.seed is not None:
+        rng.seed(args.seed)
+
+    print(f"Mock OpenAI server on http://{args.host}:{args.port}/v1 with the {args.profile} profile")
+    app.run(host=args.host, port=args.port, threaded=True)
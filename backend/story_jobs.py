@@ -0,0 +1,226 @@
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_
+
+from db.db import db, StoryJob, JobStatus
+
+
+class StoryJobQueue:
+    """
+    Durable queue of story generations in the story_job table. Routes
+    enqueue a job and answer at once; worker threads of every process claim
+    jobs with a conditional UPDATE, so a job runs in one worker at a time, and
+    a job whose worker died is claimed again once its lease runs out. Failed
+    jobs are retried with backoff and marked dead after max_attempts.
+
+    Jobs run at least once: a worker that dies after logging the story part
+    but before marking the job succeeded leaves it to be run again.
+    """
+
+    def __init__(self, app, run_job, workers, max_attempts, lease_seconds, poll_seconds, retry_base_seconds):
+        self.app = app
+        self.run_job = run_job
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lease = timedelta(seconds=lease_seconds)
+        self.poll_seconds = poll_seconds
+        self.retry_base_seconds = retry_base_seconds
+        self.worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        self.wakeup = threading.Event()
+        self.finished = threading.Condition()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.enqueued = 0
+        self.succeeded = 0
+        self.retried = 0
+        self.dead = 0
+        self.total_queue_ms = 0.0
+        self.total_run_ms = 0.0
+
+    def start(self):
+        """Start the worker threads of this process, unless they are running already."""
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"story-job-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def enqueue(self, kind, audience, conversation_id, user_id, family_id, prompt):
+        """Store a job for the workers and return its id."""
+        now = datetime.now()
+        job = StoryJob(
+            kind=kind,
+            audience=audience,
+            conversation_id=conversation_id,
+            user_id=user_id,
+            family_id=family_id,
+            prompt=prompt,
+            status=JobStatus.QUEUED,
+            # Set here rather than by the database so it compares with the run_after clock
+            created_at=now,
+            run_after=now,
+        )
+        db.session.add(job)
+        db.session.commit()
+        with self.lock:
+            self.enqueued += 1
+        self.wakeup.set()
+        return job.id
+
+    def pending(self, conversation_id):
+        """Id of a queued or running job of the conversation, in any process, or None."""
+        row = db.session.query(StoryJob.id).filter(
+            StoryJob.conversation_id == conversation_id,
+            StoryJob.status.in_((JobStatus.QUEUED, JobStatus.RUNNING)),
+        ).first()
+        return row.id if row is not None else None
+
+    def _work(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    job = self.claim()
+                    if job is not None:
+                        self._run(job)
+                        continue
+            except Exception as e:
+                print(f"Story job worker error: {e}")
+            self.wakeup.wait(self.poll_seconds)
+            self.wakeup.clear()
+
+    def claim(self):
+        """Take the next runnable job, or None. Only one worker's conditional UPDATE can win a job."""
+        now = datetime.now()
+        candidates = StoryJob.query.filter(or_(
+            and_(StoryJob.status == JobStatus.QUEUED, StoryJob.run_after <= now),
+            and_(StoryJob.status == JobStatus.RUNNING, StoryJob.locked_until < now),
+        )).order_by(StoryJob.run_after, StoryJob.id).limit(5).all()
+        for candidate in candidates:
+            token = f"{self.worker_prefix}:{uuid.uuid4().hex[:12]}"
+            claimed = StoryJob.query.filter(
+                StoryJob.id == candidate.id,
+                StoryJob.status == candidate.status,
+                StoryJob.attempts == candidate.attempts,
+            ).update({
+                "status": JobStatus.RUNNING,
+                "locked_by": token,
+                "locked_until": now + self.lease,
+                "attempts": candidate.attempts + 1,
+            }, synchronize_session=False)
+            db.session.commit()
+            if not claimed:
+                continue
+            db.session.expire_all()
+            job = db.session.get(StoryJob, candidate.id)
+            if job.attempts > self.max_attempts:
+                # Its workers kept dying before finishing it
+                self._finish(job, JobStatus.DEAD, error="Lease expired on every attempt")
+                continue
+            return job
+        return None
+
+    def _run(self, job):
+        queued_ms = (datetime.now() - job.created_at).total_seconds() * 1000 if job.created_at else 0.0
+        start = time.perf_counter()
+        try:
+            response = self.run_job(job)
+        except Exception as e:
+            db.session.rollback()
+            print(f"Story job {job.id} failed on attempt {job.attempts}: {e}")
+            if job.attempts >= self.max_attempts:
+                self._finish(job, JobStatus.DEAD, error=str(e)[:1000])
+            else:
+                delay = self.retry_base_seconds * 2 ** (job.attempts - 1) * random.uniform(0.5, 1.5)
+                self._release(job, error=str(e)[:1000], run_after=datetime.now() + timedelta(seconds=delay))
+            return
+        self._finish(job, JobStatus.SUCCEEDED, response=response)
+        with self.lock:
+            self.total_queue_ms += queued_ms
+            self.total_run_ms += (time.perf_counter() - start) * 1000
+
+    def _release(self, job, error, run_after):
+        # Back to the queue for a retry, unless another worker took the job over
+        updated = StoryJob.query.filter_by(id=job.id, locked_by=job.locked_by).update({
+            "status": JobStatus.QUEUED,
+            "locked_by": None,
+            "locked_until": None,
+            "error": error,
+            "run_after": run_after,
+        }, synchronize_session=False)
+        db.session.commit()
+        if updated:
+            with self.lock:
+                self.retried += 1
+
+    def _finish(self, job, status, response=None, error=None):
+        updated = StoryJob.query.filter_by(id=job.id, locked_by=job.locked_by).update({
+            "status": status,
+            "locked_until": None,
+            "response": response,
+            "error": error,
+            "finished_at": datetime.now(),
+        }, synchronize_session=False)
+        db.session.commit()
+        if updated:
+            with self.lock:
+                if status == JobStatus.SUCCEEDED:
+                    self.succeeded += 1
+                else:
+                    self.dead += 1
+        with self.finished:
+            self.finished.notify_all()
+
+    def wait(self, job_id, timeout):
+        """Return the job once it succeeded or is dead, or as it is after timeout seconds."""
+        deadline = time.time() + timeout
+        while True:
+            db.session.expire_all()
+            job = db.session.get(StoryJob, job_id)
+            remaining = deadline - time.time()
+            if job is None or job.status in (JobStatus.SUCCEEDED, JobStatus.DEAD) or remaining <= 0:
+                return job
+            # Jobs finished by this process wake the waiters at once, the others are polled
+            with self.finished:
+                self.finished.wait(min(remaining, 0.25))
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                "workers": self.workers,
+                "enqueued": self.enqueued,
+                "succeeded": self.succeeded,
+                "retried": self.retried,
+                "dead": self.dead,
+                "mean_queue_ms": self.total_queue_ms / self.succeeded if self.succeeded else None,
+                "mean_run_ms": self.total_run_ms / self.succeeded if self.succeeded else None,
+            }
+        # Jobs per status across all worker processes
+        rows = db.session.query(StoryJob.status, db.func.count(StoryJob.id)).group_by(StoryJob.status).all()
+        stats["jobs"] = {status.value: count for status, count in rows}
+        return stats
+
+
+def story_jobs_from_env(app, run_job):
+    """
+    Build the story job queue configured by the STORY_JOB_* variables, or
+    None when asynchronous story requests are disabled
+    """
+    if os.getenv("STORY_JOBS_ENABLED", "false").lower() != "true":
+        return None
+    return StoryJobQueue(
+        app,
+        run_job,
+        workers=int(os.getenv("STORY_JOB_WORKERS", "2")),
+        max_attempts=int(os.getenv("STORY_JOB_MAX_ATTEMPTS", "3")),
+        lease_seconds=float(os.getenv("STORY_JOB_LEASE_SECONDS", "300")),
+        poll_seconds=float(os.getenv("STORY_JOB_POLL_SECONDS", "1")),
+        retry_base_seconds=float(os.getenv("STORY_JOB_RETRY_BASE_SECONDS", "5")),
+    )
@@ -0,0 +1,277 @@
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from db.db import db, PooledStory, StoryPoolRefill, StoryTheme
+from llm.llm import new_story_generator
+from llm.timing import start_request_timings, request_timings
+
+# Prompts behind each theme of /generate_themed_story
+themed_prompts = {
+    StoryTheme.DRAGONS: [
+        "Tell me a story about a friendly dragon who helps a village",
+        "Tell me a story about a dragon who can't breathe fire",
+        "Tell me a story about a baby dragon learning to fly"
+    ],
+    StoryTheme.SPACE: [
+        "Tell me a story about astronauts discovering a new planet",
+        "Tell me a story about aliens visiting Earth",
+        "Tell me a story about a space adventure with talking robots"
+    ],
+    StoryTheme.ANIMALS: [
+        "Tell me a story about talking animals in a forest",
+        "Tell me a story about a brave little mouse",
+        "Tell me a story about animals working together to solve a problem"
+    ],
+    StoryTheme.MAGIC: [
+        "Tell me a story about a child discovering they have magic powers",
+        "Tell me a story about a magical school",
+        "Tell me a story about a wizard's apprentice"
+    ],
+    StoryTheme.PIRATES: [
+        "Tell me a story about a kind pirate who helps others",
+        "Tell me a story about finding a treasure map",
+        "Tell me a story about a pirate adventure with a talking parrot"
+    ],
+    StoryTheme.DINOSAURS: [
+        "Tell me a story about friendly dinosaurs",
+        "Tell me a story about a time-traveling adventure to see dinosaurs",
+        "Tell me a story about a baby dinosaur finding its family"
+    ],
+    StoryTheme.FAIRY_TALE: [
+        "Tell me a fairy tale about a brave princess who saves a prince",
+        "Tell me a fairy tale with a happy ending",
+        "Tell me a fairy tale about magical creatures in an enchanted forest"
+    ],
+    StoryTheme.ADVENTURE: [
+        "Tell me an adventure story about exploring a mysterious cave",
+        "Tell me an adventure story about finding a lost city",
+        "Tell me an adventure story about a magical journey"
+    ]
+}
+
+
+class StoryPool:
+    """
+    Keeps `depth` fresh, unused stories per (theme, prompt) in the
+    pooled_story table so themed stories can be handed out without waiting
+    for the LLM pipeline. Refills run on a background thread pool; the
+    stories are stored in the database so every worker process shares them,
+    and a refill first takes the (theme, prompt) lease in story_pool_refill
+    so only one process tops up a pool at a time. The completions of the
+    refills are recorded in usage_store under the story_pool route.
+    """
+
+    def __init__(self, app, depth, ttl_seconds, refill_workers=2, lease_seconds=600, usage_store=None):
+        self.app = app
+        self.depth = depth
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.lease = timedelta(seconds=lease_seconds)
+        self.usage_store = usage_store
+        self.worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        self.executor = ThreadPoolExecutor(max_workers=refill_workers, thread_name_prefix="story-pool")
+        self.lock = threading.Lock()
+        self.warmed = False
+        self.pending = set()
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_errors = 0
+        self.refills_skipped = 0
+        self.stories_generated = 0
+        self.last_refill_lag_ms = None
+        self.max_refill_lag_ms = 0.0
+        self.total_refill_lag_ms = 0.0
+
+    def take(self, theme):
+        """
+        Claim the oldest unexpired story of the theme. Returns a dict with
+        the prompt, title and story, or None when the pool is empty.
+        """
+        for _ in range(3):
+            pooled = PooledStory.query.filter(
+                PooledStory.theme == theme,
+                PooledStory.expires_at > datetime.now()
+            ).order_by(PooledStory.created_at, PooledStory.id).first()
+            if pooled is None:
+                break
+            story = {"prompt": pooled.prompt, "title": pooled.title, "story": pooled.story}
+            # Only one worker can delete the row, the others try the next story
+            claimed = PooledStory.query.filter_by(id=pooled.id).delete()
+            db.session.commit()
+            if claimed:
+                with self.lock:
+                    self.hits += 1
+                return story
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def request_refill(self, theme, prompt):
+        """
+        Top up the pool of (theme, prompt) in the background, at most one
+        refill per key is queued at a time
+        """
+        key = (theme, prompt)
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+        self.executor.submit(self._refill, theme, prompt, time.perf_counter())
+
+    def warm(self):
+        """
+        Request a refill of every (theme, prompt) pair, once per process
+        """
+        with self.lock:
+            if self.warmed:
+                return
+            self.warmed = True
+        for theme, prompts in themed_prompts.items():
+            for prompt in prompts:
+                self.request_refill(theme, prompt)
+
+    def _refill(self, theme, prompt, requested_at):
+        try:
+            with self.app.app_context():
+                token = self._claim(theme, prompt)
+                if token is None:
+                    # Another process is refilling this pool
+                    with self.lock:
+                        self.refills_skipped += 1
+                    return
+                try:
+                    PooledStory.query.filter(PooledStory.expires_at <= datetime.now()).delete()
+                    db.session.commit()
+                    # At most depth stories per refill, even when stories expire
+                    # as fast as they are generated (a TTL shorter than a story)
+                    for _ in range(self.depth - self._available(theme, prompt)):
+                        self._add_story(theme, prompt)
+                finally:
+                    self._release(theme, prompt, token)
+            lag_ms = (time.perf_counter() - requested_at) * 1000
+            with self.lock:
+                self.refills += 1
+                self.last_refill_lag_ms = lag_ms
+                self.max_refill_lag_ms = max(self.max_refill_lag_ms, lag_ms)
+                self.total_refill_lag_ms += lag_ms
+        except Exception as e:
+            print(f"Error refilling the story pool for {theme.value}: {e}")
+            with self.lock:
+                self.refill_errors += 1
+        finally:
+            with self.lock:
+                self.pending.discard((theme, prompt))
+
+    def _claim(self, theme, prompt):
+        """Take the refill lease of (theme, prompt), returning its token or None when another worker holds it."""
+        token = f"{self.worker_prefix}:{uuid.uuid4().hex[:12]}"
+        now = datetime.now()
+        claimed = StoryPoolRefill.query.filter(
+            StoryPoolRefill.theme == theme,
+            StoryPoolRefill.prompt == prompt,
+            StoryPoolRefill.locked_until < now,
+        ).update({"locked_by": token, "locked_until": now + self.lease}, synchronize_session=False)
+        if not claimed:
+            # First refill of the pool, or its lease is held
+            db.session.add(StoryPoolRefill(theme=theme, prompt=prompt, locked_by=token,
+                                           locked_until=now + self.lease))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return None
+        return token
+
+    def _release(self, theme, prompt, token):
+        db.session.rollback()
+        StoryPoolRefill.query.filter_by(theme=theme, prompt=prompt, locked_by=token).update(
+            {"locked_by": None, "locked_until": datetime.now()}, synchronize_session=False)
+        db.session.commit()
+
+    def _available(self, theme, prompt):
+        return PooledStory.query.filter(
+            PooledStory.theme == theme,
+            PooledStory.prompt == prompt,
+            PooledStory.expires_at > datetime.now()
+        ).count()
+
+    def _add_story(self, theme, prompt):
+        # The pool wants distinct stories, not near-duplicate cache hits
+        start_request_timings()
+        try:
+            story_data = new_story_generator(prompt, use_cache=False)
+        finally:
+            self._record_usage(request_timings())
+        if isinstance(story_data, dict):
+            title, story = story_data.get("title"), story_data.get("story", "")
+        else:
+            title, story = None, story_data
+        db.session.add(PooledStory(
+            theme=theme,
+            prompt=prompt,
+            title=title,
+            story=story,
+            expires_at=datetime.now() + self.ttl
+        ))
+        db.session.commit()
+        with self.lock:
+            self.stories_generated += 1
+
+    def _record_usage(self, records):
+        if not records or self.usage_store is None:
+            return
+        try:
+            self.usage_store.record(records, route="story_pool")
+        except Exception as e:
+            print(f"Error recording LLM usage: {e}")
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "depth": self.depth,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "refills": self.refills,
+                "refill_errors": self.refill_errors,
+                "refills_skipped": self.refills_skipped,
+                "pending_refills": len(self.pending),
+                "stories_generated": self.stories_generated,
+                "last_refill_lag_ms": self.last_refill_lag_ms,
+                "max_refill_lag_ms": self.max_refill_lag_ms,
+                "mean_refill_lag_ms": self.total_refill_lag_ms / self.refills if self.refills else None,
+            }
+        # Stories ready per theme across all worker processes
+        rows = db.session.query(PooledStory.theme, db.func.count(PooledStory.id)).filter(
+            PooledStory.expires_at > datetime.now()
+        ).group_by(PooledStory.theme).all()
+        stats["available"] = {theme.value: count for theme, count in rows}
+        return stats
+
+
+def story_pool_from_env(app, usage_store=None):
+    """
+    Build the story pool configured by the STORY_POOL_* variables, or None
+    when pre-generation is disabled
+    """
+    if os.getenv("STORY_POOL_ENABLED", "false").lower() != "true":
+        return None
+    return StoryPool(
+        app,
+        depth=int(os.getenv("STORY_POOL_DEPTH", "2")),
+        ttl_seconds=int(os.getenv("STORY_POOL_TTL_SECONDS", str(24 * 3600))),
+        refill_workers=int(os.getenv("STORY_POOL_REFILL_WORKERS", "2")),
+        lease_seconds=int(os.getenv("STORY_POOL_REFILL_LEASE_SECONDS", "600")),
+        usage_store=usage_store,
+    )
+
+
+def random_prompt(theme):
+    return random.choice(themed_prompts[theme])
@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import random
+import time
+from flask import Flask
+from sqlalchemy import and_, func, not_, or_
+from db.db import db, init_db, Message, SenderType
+from db.migrations import migration_status
+from llm.intent_classifier import IntentClassifier, intent_codes
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
+
+default_model_path = os.path.join(os.path.dirname(__file__), 'intent_classifier.npz')
+default_thresholds = [0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.98]
+
+
+def load_labeled_messages():
+    """
+    Load every user message with the code the LLM handler classified it as.
+    Messages logged before handler_code was recorded (migration 3) keep
+    their Message.code when it is 0 or 1. Their 2 and 3 codes are not used:
+    the routes log a new story request in an existing conversation as a
+    continuation (3), and confirmed or themed story prompts as 2 without
+    classifying them.
+    """
+    app = Flask(__name__)
+    init_db(app)
+    with app.app_context():
+        recorded_since = {version: applied_at for version, _, applied_at in migration_status(db.engine)}[3]
+        historical = and_(
+            Message.handler_code.is_(None),
+            Message.created_at < recorded_since,
+            Message.code.in_((0, 1)),
+        )
+        rows = db.session.query(Message.content, func.coalesce(Message.handler_code, Message.code)).filter(
+            Message.sender_type == SenderType.USER,
+            or_(Message.handler_code.in_(intent_codes), historical)
+        ).all()
+        unlabeled = Message.query.filter(
+            Message.sender_type == SenderType.USER,
+            Message.handler_code.is_(None),
+            not_(historical)
+        ).count()
+    if unlabeled:
+        print(f"Skipped {unlabeled} user messages without a code of the LLM handler")
+    return [(content, code) for content, code in rows if content and content.strip()]
+
+
+def split_dataset(rows, test_size, seed):
+    """
+    Shuffle the rows and hold out test_size of them for evaluation
+    """
+    rows = list(rows)
+    random.Random(seed).shuffle(rows)
+    held_out = int(len(rows) * test_size)
+    return rows[held_out:], rows[:held_out]
+
+
+def evaluate(classifier, rows, thresholds):
+    """
+    Report accuracy, per-code accuracy, latency and for every confidence
+    threshold how much traffic would be answered locally and how accurately
+    """
+    predictions = []
+    latencies = []
+    for query, code in rows:
+        start = time.perf_counter()
+        predicted, confidence = classifier.predict(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+        predictions.append((code, predicted, confidence))
+
+    latencies.sort()
+    report = {
+        "held_out": len(rows),
+        "accuracy": sum(code == predicted for code, predicted, _ in predictions) / len(rows),
+        "per_code_accuracy": {},
+        "latency_ms": {
+            "p50": latencies[len(latencies) // 2],
+            "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        },
+        "thresholds": [],
+    }
+    for code in intent_codes:
+        subset = [p for p in predictions if p[0] == code]
+        if subset:
+            report["per_code_accuracy"][code] = sum(c == p for c, p, _ in subset) / len(subset)
+    for threshold in thresholds:
+        covered = [p for p in predictions if p[2] >= threshold]
+        report["thresholds"].append({
+            "threshold": threshold,
+            "coverage": len(covered) / len(rows),
+            "accuracy": sum(c == p for c, p, _ in covered) / len(covered) if covered else None,
+        })
+    return report
+
+
+def print_report(report):
+    print(f"Held-out messages: {report['held_out']}")
+    print(f"Accuracy: {report['accuracy']:.3f}")
+    for code, accuracy in report["per_code_accuracy"].items():
+        print(f"  code {code}: {accuracy:.3f}")
+    print(f"Latency: p50 {report['latency_ms']['p50']:.3f} ms, p99 {report['latency_ms']['p99']:.3f} ms")
+    print("Threshold  coverage  accuracy")
+    for row in report["thresholds"]:
+        accuracy = f"{row['accuracy']:.3f}" if row["accuracy"] is not None else "-"
+        print(f"{row['threshold']:>9.2f}  {row['coverage']:>8.3f}  {accuracy:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Train the local intent classifier from the handler codes logged in the message table")
+    parser.add_argument("--output", default=default_model_path, help="where to save the trained model")
+    parser.add_argument("--test-size", type=float, default=0.2, help="fraction of messages held out for the report")
+    parser.add_argument("--epochs", type=int, default=8)
+    parser.add_argument("--dims", type=int, default=2 ** 18, help="number of hashed feature buckets")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report", help="also write the evaluation report as JSON to this file")
+    args = parser.parse_args()
+
+    rows = load_labeled_messages()
+    print(f"Loaded {len(rows)} labeled user messages")
+    if len(rows) < 10:
+        print("Not enough labeled messages to train a classifier")
+        return
+    train_rows, test_rows = split_dataset(rows, args.test_size, args.seed)
+
+    start = time.perf_counter()
+    classifier = IntentClassifier.train(
+        [query for query, _ in train_rows],
+        [code for _, code in train_rows],
+        dims=args.dims,
+        epochs=args.epochs,
+        seed=args.seed,
+    )
+    print(f"Trained on {len(train_rows)} messages in {time.perf_counter() - start:.1f} s")
+
+    if test_rows:
+        report = evaluate(classifier, test_rows, default_thresholds)
+        print_report(report)
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(report, f, indent=2)
+
+    classifier.save(args.output)
+    print(f"Saved the classifier to {args.output}")
+
+
+if __name__ == '__main__':
+    main()